@@ -0,0 +1,241 @@
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import random
+import secrets
+import sys
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator
+
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from quart import Blueprint, Quart, current_app, jsonify, make_response, request
+from quart.helpers import ResponseTypes
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class FakeSettings:
+    # how long, in seconds, every envoy response takes plus up to "jitter"
+    # more seconds chosen at random
+    latency: float = 0.0
+    jitter: float = 0.0
+
+    # the fraction of envoy requests that fail with a 500 and the fraction
+    # that never get an answer until "hang_seconds" have passed
+    error_rate: float = 0.0
+    hang_rate: float = 0.0
+    hang_seconds: float = 600.0
+
+    # how big responses are. paths that the fake doesn't know about return
+    # this many bytes of json and there are this many inverters.
+    payload_size: int = 1024
+    inverters: int = 30
+
+    # how often, in seconds, the live feed sends a reading
+    stream_interval: float = 1.0
+
+    # how long, in seconds, the tokens from the fake enlighten are good for
+    token_lifetime: int = 3600
+
+
+def make_token(lifetime: int) -> str:
+    # this looks enough like a real token for the proxy to read when it
+    # expires. nothing checks the signature.
+    def encode(value: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(value).encode()).rstrip(b"=").decode()
+
+    claims = {"exp": int(time.time()) + lifetime, "jti": secrets.token_hex(8)}
+    return f"{encode({'alg': 'none'})}.{encode(claims)}.{secrets.token_hex(8)}"
+
+
+def token_expiry(token: str) -> float:
+    try:
+        payload = token.split(".")[1]
+        return float(json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return 0.0
+
+
+envoy = Blueprint("envoy", __name__)
+enlighten = Blueprint("enlighten", __name__)
+
+
+def settings() -> FakeSettings:
+    return current_app.config["FAKE_SETTINGS"]
+
+
+@envoy.before_request
+async def misbehave() -> Any:
+    # tokens must look valid and must not be expired just like on the envoy
+    authorization = request.headers.get("Authorization", "")
+    if not authorization.startswith("Bearer ") or token_expiry(authorization[7:]) < time.time():
+        return await make_response(jsonify({"status": 401, "error": "", "info": "JWT has expired"}), 401)
+
+    # the live feed is slow on purpose and never fails
+    if request.path == "/stream/meter":
+        return None
+
+    fake = settings()
+    roll = random.random()  # noqa: S311
+    if roll < fake.hang_rate:
+        await asyncio.sleep(fake.hang_seconds)
+    elif roll < fake.hang_rate + fake.error_rate:
+        return await make_response(jsonify({"error": "injected failure"}), 500)
+
+    delay = fake.latency + random.uniform(0, fake.jitter)  # noqa: S311
+    if delay > 0:
+        await asyncio.sleep(delay)
+    return None
+
+
+def reading(watts: float) -> dict[str, Any]:
+    return {
+        "type": "eim",
+        "activeCount": 1,
+        "readingTime": int(time.time()),
+        "wNow": watts,
+        "whLifetime": 12345678.9,
+        "rmsCurrent": watts / 240,
+        "rmsVoltage": 240.1,
+    }
+
+
+@envoy.route("/production.json")
+async def production() -> ResponseTypes:
+    produced = random.uniform(0, 8000)  # noqa: S311
+    consumed = random.uniform(200, 4000)  # noqa: S311
+    return jsonify(
+        {
+            "production": [
+                {
+                    "type": "inverters",
+                    "activeCount": settings().inverters,
+                    "readingTime": int(time.time()),
+                    "wNow": produced,
+                },
+                {**reading(produced), "measurementType": "production"},
+            ],
+            "consumption": [
+                {**reading(consumed), "measurementType": "total-consumption"},
+                {**reading(consumed - produced), "measurementType": "net-consumption"},
+            ],
+            "storage": [{"type": "acb", "activeCount": 0, "readingTime": 0, "wNow": 0, "whNow": 0, "state": "idle"}],
+        }
+    )
+
+
+@envoy.route("/ivp/meters/readings")
+async def meters() -> ResponseTypes:
+    return jsonify(
+        [
+            {
+                "eid": eid,
+                "timestamp": int(time.time()),
+                "actEnergyDlvd": 12345678.9,
+                "activePower": random.uniform(0, 8000),  # noqa: S311
+                "voltage": 240.1,
+                "current": random.uniform(0, 30),  # noqa: S311
+                "freq": 60.0,
+            }
+            for eid in (704643328, 704643584)
+        ]
+    )
+
+
+@envoy.route("/api/v1/production/inverters")
+async def inverters() -> ResponseTypes:
+    return jsonify(
+        [
+            {
+                "serialNumber": f"{122100000000 + index}",
+                "lastReportDate": int(time.time()),
+                "devType": 1,
+                "lastReportWatts": random.randint(0, 300),  # noqa: S311
+                "maxReportWatts": 300,
+            }
+            for index in range(settings().inverters)
+        ]
+    )
+
+
+@envoy.route("/stream/meter")
+async def stream_meter() -> ResponseTypes:
+    # the body is sent after the request is over so read this while we can
+    interval = settings().stream_interval
+
+    async def readings() -> AsyncIterator[bytes]:
+        while True:
+            record = {"production": {"ph-a": {"p": random.uniform(0, 4000)}}}  # noqa: S311
+            yield b"data: " + json.dumps(record).encode() + b"\n\n"
+            await asyncio.sleep(interval)
+
+    response = await make_response(readings(), 200)
+    response.headers["Content-Type"] = "text/event-stream"
+    response.timeout = None
+    return response
+
+
+@envoy.route("/<path:path>", methods=["HEAD", "GET", "POST"])
+async def anything(path: str) -> ResponseTypes:
+    # a json string of exactly the configured size
+    return await make_response(
+        json.dumps("x" * max(settings().payload_size - 2, 0)), 200, {"Content-Type": "application/json"}
+    )
+
+
+@enlighten.route("/login/login.json", methods=["POST"])
+async def login() -> ResponseTypes:
+    form = await request.form
+    if not form.get("user[email]") or not form.get("user[password]"):
+        return await make_response(jsonify({"message": "Login failed"}), 401)
+    return jsonify({"message": "success", "session_id": secrets.token_hex(16)})
+
+
+@enlighten.route("/entrez-auth-token")
+async def token() -> ResponseTypes:
+    if "_enlighten_4_session" not in request.cookies or not request.args.get("serial_num"):
+        return await make_response(jsonify({"message": "Unauthorized"}), 401)
+
+    lifetime = settings().token_lifetime
+    now = int(time.time())
+    return jsonify({"generation_time": now, "expires_at": now + lifetime, "token": make_token(lifetime)})
+
+
+def create_app(fake: FakeSettings) -> Quart:
+    # one server plays both parts. the envoy answers for any path so only the
+    # enlighten paths, which are more specific, are taken away from it.
+    app = Quart(__name__, static_folder=None)
+    app.config["FAKE_SETTINGS"] = fake
+    app.register_blueprint(enlighten)
+    app.register_blueprint(envoy)
+    return app
+
+
+def parse_arguments(arguments: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="fakes", description="a stand-in for an envoy and for enlighten")
+    parser.add_argument("-b", "--bind", default="127.0.0.1", help="interface to listen on")
+    parser.add_argument("-p", "--port", default=8081, type=int, help="port number to listen on")
+    for name, default in vars(FakeSettings()).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", dest=name, default=default, type=type(default))
+    return parser.parse_args(arguments)
+
+
+def main() -> int:
+    args = parse_arguments(sys.argv[1:])
+    logging.basicConfig(format="[%(asctime)s] %(levelname)-8s - %(message)s", level=logging.WARNING, stream=sys.stdout)
+
+    fake = FakeSettings(**{name: getattr(args, name) for name in vars(FakeSettings())})
+    config = Config()
+    config.bind = [f"{args.bind}:{args.port}"]
+    config.accesslog = None
+    asyncio.run(serve(create_app(fake), config))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
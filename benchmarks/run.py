@@ -0,0 +1,245 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import platform
+import socket
+import statistics
+import subprocess  # noqa: S404
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+import httpx
+
+from .fakes import FakeSettings
+
+logger = logging.getLogger(__name__)
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss(pid: int) -> dict[str, int]:
+    # this is linux only. the current and the largest resident set size of
+    # the proxy, in bytes.
+    results = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in ("VmRSS", "VmHWM"):
+                results[name] = int(value.split()[0]) * 1024
+    return {"rss_bytes": results.get("VmRSS", 0), "rss_peak_bytes": results.get("VmHWM", 0)}
+
+
+def percentile(latencies: list[float], fraction: float) -> float:
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, max(0, round(fraction * len(latencies)) - 1))]
+
+
+def commit() -> Optional[str]:
+    with contextlib.suppress(OSError, subprocess.CalledProcessError):
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()  # noqa: S603, S607
+    return None
+
+
+@contextlib.contextmanager
+def start(arguments: list[str], environment: dict[str, str], port: int) -> Iterator[subprocess.Popen]:
+    # start a server and wait until it accepts connections
+    process = subprocess.Popen(  # noqa: S603
+        arguments,
+        cwd=ROOT,
+        env={**os.environ, **environment},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            with contextlib.suppress(OSError), socket.create_connection(("127.0.0.1", port), timeout=1):
+                break
+            if process.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError(f"unable to start: {' '.join(arguments)}")
+            time.sleep(0.1)
+        yield process
+    finally:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+async def drive(url: str, paths: list[str], concurrency: int, duration: float, warmup: float) -> dict[str, Any]:
+    # every worker sends one request after another for the whole time. only
+    # the requests that start after the warm up are counted.
+    latencies: list[float] = []
+    errors = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        started = time.perf_counter()
+        counting = started + warmup
+        finished = counting + duration
+
+        async def worker(index: int) -> None:
+            nonlocal errors
+            request = index
+            while (now := time.perf_counter()) < finished:
+                path = paths[request % len(paths)]
+                request += 1
+                try:
+                    response = await client.get(path)
+                    failed = response.status_code >= 400
+                except httpx.HTTPError:
+                    failed = True
+                if now >= counting:
+                    latencies.append(time.perf_counter() - now)
+                    errors += failed
+
+        await asyncio.gather(*[worker(index) for index in range(concurrency)])
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": len(latencies) / duration,
+        "latency_p50_seconds": percentile(latencies, 0.5),
+        "latency_p99_seconds": percentile(latencies, 0.99),
+        "latency_mean_seconds": statistics.fmean(latencies) if latencies else 0.0,
+        "latency_max_seconds": latencies[-1] if latencies else 0.0,
+    }
+
+
+def compare(results: list[dict[str, Any]], baseline: dict[str, Any]) -> list[str]:
+    # say how much faster or slower each concurrency level is than it was
+    previous = {result["concurrency"]: result for result in baseline.get("results", [])}
+    lines = []
+    for result in results:
+        before = previous.get(result["concurrency"])
+        if before is None:
+            continue
+        changes = []
+        for name in ("requests_per_second", "latency_p50_seconds", "latency_p99_seconds", "rss_peak_bytes"):
+            if before.get(name):
+                changes.append(f"{name} {(result[name] - before[name]) / before[name]:+.1%}")
+        lines.append(f"concurrency {result['concurrency']}: {', '.join(changes)}")
+    return lines
+
+
+def parse_arguments(arguments: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="benchmark", description="measure the proxy against a fake envoy")
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        default="1,8,32",
+        help="comma separated list of how many requests to have in flight at once",
+    )
+    parser.add_argument("-d", "--duration", default=10.0, type=float, help="seconds to measure each level")
+    parser.add_argument("-w", "--warmup", default=2.0, type=float, help="seconds to run before measuring")
+    parser.add_argument(
+        "--path",
+        dest="paths",
+        action="append",
+        help="path to request, may be given more than once (default: /production.json)",
+    )
+    parser.add_argument(
+        "--setting",
+        dest="settings",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="proxy setting without the ENPHASE_ prefix, like CACHE_TTLS='{\"/production.json\": 1}'",
+    )
+    parser.add_argument("-o", "--output", type=Path, help="write the results as json to this file")
+    parser.add_argument("--baseline", type=Path, help="compare the results against this earlier output")
+    for name, default in vars(FakeSettings()).items():
+        parser.add_argument(
+            f"--envoy-{name.replace('_', '-')}",
+            dest=name,
+            default=default,
+            type=type(default),
+            help="fake envoy setting",
+        )
+    return parser.parse_args(arguments)
+
+
+def main() -> int:
+    args = parse_arguments(sys.argv[1:])
+    logging.basicConfig(format="[%(asctime)s] %(levelname)-8s - %(message)s", level=logging.INFO, stream=sys.stderr)
+    # every request would be logged otherwise
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    fake = {name: getattr(args, name) for name in vars(FakeSettings())}
+    levels = [int(level) for level in args.concurrency.split(",")]
+    paths = args.paths or ["/production.json"]
+    settings = dict(setting.split("=", 1) for setting in args.settings)
+
+    fake_port, proxy_port = free_port(), free_port()
+    fake_url = f"http://127.0.0.1:{fake_port}/"
+    environment = {
+        "PYTHONPATH": os.pathsep.join([str(ROOT / "src"), str(ROOT), os.environ.get("PYTHONPATH", "")]),
+        "ENVIRONMENT": "development",
+        # the proxy logs in to the fake enlighten just like it would the real one
+        "ENPHASE_LOCAL_API_URL": fake_url,
+        "ENPHASE_REMOTE_API_URL": fake_url,
+        "ENPHASE_REMOTE_API_USERNAME": "benchmark@example.com",
+        "ENPHASE_REMOTE_API_PASSWORD": "benchmark",  # noqa: S105
+        "ENPHASE_REMOTE_API_SERIALNO": "123456789012",
+        **{f"ENPHASE_{name}": value for name, value in settings.items()},
+    }
+    fake_arguments = [f"--{name.replace('_', '-')}={value}" for name, value in fake.items()]
+
+    results = []
+    with (
+        start(
+            [sys.executable, "-m", "benchmarks.fakes", f"--port={fake_port}", *fake_arguments], environment, fake_port
+        ),
+        start(
+            [sys.executable, "-m", "hypercorn", "enphase_proxy.asgi:app", "-b", f"127.0.0.1:{proxy_port}"],
+            environment,
+            proxy_port,
+        ) as proxy,
+    ):
+        for level in levels:
+            logger.info("measuring %d requests at once for %g seconds", level, args.duration)
+            result = asyncio.run(drive(f"http://127.0.0.1:{proxy_port}", paths, level, args.duration, args.warmup))
+            result.update(rss(proxy.pid))
+            results.append(result)
+
+    output = {
+        "commit": commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "paths": paths,
+        "duration": args.duration,
+        "envoy": fake,
+        "settings": settings,
+        "results": results,
+    }
+
+    text = json.dumps(output, indent=2)
+    print(text)
+    if args.output is not None:
+        args.output.write_text(text + "\n")
+    if args.baseline is not None:
+        for line in compare(results, json.loads(args.baseline.read_text())):
+            logger.info(line)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,9 @@
-import importlib.metadata
+import time
+
+# this is when we started loading so that we can say how long starting took
+STARTED_AT = time.perf_counter()
+
+import importlib.metadata  # noqa: E402
 
 
 def version(package: str) -> str:
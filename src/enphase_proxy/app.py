@@ -1,25 +1,282 @@
+import asyncio
+import json
 import logging
+import math
+import time
+from datetime import datetime
+from typing import Any, AsyncIterable, AsyncIterator, Callable, Optional
 from urllib.parse import urlencode
 
 import httpx
-from quart import Quart, jsonify, make_response, request
+from quart import Quart, Response, jsonify, make_response, request, websocket
 from quart.helpers import ResponseTypes
 
-from enphase_proxy import __version__
+from enphase_proxy import STARTED_AT, __version__
 
-from .tools import load_configuration
+from .breaker import OPEN, CircuitOpen
+from .cache import CachedResponse
+from .encoding import negotiate
+from .export import Exporter
+from .gateway import Gateway, UnknownGateway
+from .limiter import UpstreamOverloaded
+from .metrics import REGISTRY, REQUESTS, Gauge
+from .poller import normalize
+from .projection import InvalidProjection, Projection, projection_for
+from .ratelimit import RateLimited, RateLimiter
+from .shared import SharedCache
+from .tools import load_configuration, load_gateways
+from .tracing import RequestTracer
 from .updater import CredentialsUpdater
+from .upstream import select_headers
+
+# these are the methods that are passed through to the envoy. options is
+# listed so that it goes to the envoy instead of being answered by quart.
+PROXY_METHODS = ["HEAD", "GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"]
 
 
 def load() -> Quart:
+    # this is how long, in seconds, each part of starting up took. importing
+    # is everything from when our package was first imported until now.
+    started = time.perf_counter()
+    startup = {"import": started - STARTED_AT}
+
     app = Quart(__name__, static_folder=None)
     environment = load_configuration(app, package="configurations")
     app.config.from_prefixed_env("ENPHASE")
+    startup["config"] = time.perf_counter() - started
     app.logger.info("starting web application in '%s' mode with version %s", environment, __version__)
 
-    # initialize the system that fetches the enphase jwt
+    # initialize the system that times each request and tells the client
+    RequestTracer(app)
+
+    # initialize the system that tells clients apart and limits how often
+    # each of them may ask for things
+    rate_limiter = RateLimiter(app)
+
+    # initialize the system that fetches the enphase jwt for every gateway
     credentials_updater = CredentialsUpdater(app)
 
+    # initialize the cache that worker processes share snapshots through
+    shared_cache = SharedCache(app)
+
+    # initialize everything that talks to each enphase envoy. the first one is
+    # used for any request that doesn't say which gateway it is for.
+    gateways = {
+        configuration.name: Gateway(app, configuration, credentials_updater, shared_cache)
+        for configuration in load_gateways(app)
+    }
+    default_gateway = next(iter(gateways.values()))
+
+    # initialize the system that sends readings from every gateway somewhere
+    # else. it asks for them the same way that a client would.
+    exporter = Exporter(app, {name: gateway.get for name, gateway in gateways.items()})
+
+    def find_gateway(name: Optional[str]) -> Gateway:
+        if name is None:
+            return default_gateway
+        if name not in gateways:
+            raise UnknownGateway(name)
+        return gateways[name]
+
+    # this is how long, in seconds, an aggregate request waits on each gateway
+    aggregate_timeout = float(app.config.get("AGGREGATE_TIMEOUT", 10))
+
+    # this is the most paths that one batch request may ask for and how long,
+    # in seconds, each of them may take
+    batch_max_paths = int(app.config.get("BATCH_MAX_PATHS", 32))
+    batch_timeout = float(app.config.get("BATCH_TIMEOUT", 30))
+
+    async def collect(gateway: Gateway, destination: str, timeout: float, route: str) -> dict[str, Any]:
+        # fetch one path for a request that asks for many of them. anything
+        # that goes wrong is reported for this path instead of failing them all.
+        # it counts against the rate limits as if it had been asked for at the
+        # route that the proxy has for it.
+        stale = False
+        try:
+            rate_limiter.charge(route)
+            entry = await asyncio.wait_for(gateway.get("GET", destination), timeout)
+        except RateLimited as e:
+            return {"status": 429, "error": str(e), "retry_after": e.retry_after}
+        except asyncio.TimeoutError:
+            return {"status": 504, "error": f"timed out after {timeout:g} seconds"}
+        except (CircuitOpen, httpx.HTTPError) as e:
+            entry, stale = gateway.fallback("GET", destination), True
+            if entry is None:
+                return {"status": 503 if isinstance(e, CircuitOpen) else 502, "error": str(e) or type(e).__name__}
+        except UpstreamOverloaded as e:
+            return {"status": 503, "error": str(e)}
+        except httpx.InvalidURL as e:
+            # this isn't an http error so it has to be caught on its own
+            return {"status": 400, "error": str(e)}
+        except Exception as e:
+            app.logger.exception("unable to fetch %s: %s", destination, str(e))
+            return {"status": 500, "error": "unable to fetch this path"}
+
+        try:
+            body = json.loads(entry.content)
+        except ValueError:
+            body = entry.content.decode(errors="replace")
+
+        result = {"status": entry.status_code, "headers": entry.headers, "body": body}
+        if stale:
+            result["stale"] = True
+        return result
+
+    # responses that we have in hand are compressed with the first of these
+    # that the client accepts. anything smaller than the minimum size isn't
+    # worth compressing.
+    compression_encodings = list(app.config.get("COMPRESSION_ENCODINGS") or ["zstd", "br", "gzip"])
+    compression_min_size = int(app.config.get("COMPRESSION_MIN_SIZE", 1024))
+
+    async def respond(entry: CachedResponse, projection: Optional[Projection] = None) -> Response:
+        if projection is not None and entry.status_code == 200:
+            # the projection is kept with the response so every client that
+            # asks for the same fields from it shares the work
+            try:
+                content = entry.project(projection)
+            except ValueError as e:
+                app.logger.warning("unable to project response for %s: %s", request.path, str(e))
+                message = "unable to read the response from the envoy as json"
+                return await make_response(jsonify({"status": "fail", "message": message}), 502)
+            headers = {**entry.headers, "content-type": "application/json"}
+            entry = CachedResponse(entry.status_code, headers, content, entry.fetched_at)
+
+        # only a response to reading something is conditional or compressed.
+        # anything else has already happened by the time that we get here.
+        if entry.status_code != 200 or request.method not in ("HEAD", "GET"):
+            response = await make_response(entry.content, entry.status_code)
+            response.headers.update(entry.headers)
+            return response
+
+        encoding = None
+        if len(entry.content) >= compression_min_size:
+            encoding = negotiate(request.headers.get("Accept-Encoding"), compression_encodings)
+
+        # each encoding of the response is a different representation so each
+        # one gets its own strong etag
+        etag = entry.etag if encoding is None else f"{entry.etag}-{encoding}"
+
+        # the client already has this exact response, in some encoding, so
+        # don't send it again. it gets back the tag that it sent us.
+        candidates = [etag, entry.etag, *(f"{entry.etag}-{name}" for name in compression_encodings)]
+        matched = next((tag for tag in candidates if request.if_none_match.contains_weak(tag)), None)
+        if matched is not None:
+            response = await make_response(b"", 304)
+            etag = matched
+        else:
+            content = entry.content if encoding is None else entry.encode(encoding)
+            response = await make_response(content, 200)
+            response.headers.update(entry.headers)
+            if encoding is not None:
+                response.headers["Content-Encoding"] = encoding
+
+        response.set_etag(etag)
+        response.vary.add("Accept-Encoding")
+        return response
+
+    def credentials_expiry() -> dict[tuple[str, ...], float]:
+        results = {}
+        for name, manager in credentials_updater.data_managers.items():
+            expires_at = manager.expires_at
+            if expires_at is not None:
+                results[(name,)] = (expires_at - datetime.now()).total_seconds()
+        return results
+
+    def per_gateway(function: Callable[[Gateway], float]) -> Callable[[], dict[tuple[str, ...], float]]:
+        return lambda: {(name,): function(gateway) for name, gateway in gateways.items()}
+
+    # these are read when the metrics are rendered so they cost nothing until then
+    REGISTRY.register(
+        Gauge(
+            "enphase_proxy_upstream_in_flight",
+            "Requests currently sent to the envoy.",
+            per_gateway(lambda gateway: gateway.limiter.in_flight),
+            ("gateway",),
+        )
+    )
+    REGISTRY.register(
+        Gauge(
+            "enphase_proxy_upstream_queued",
+            "Requests waiting for their turn.",
+            per_gateway(lambda gateway: gateway.limiter.queued),
+            ("gateway",),
+        )
+    )
+    REGISTRY.register(
+        Gauge(
+            "enphase_proxy_upstream_wait_seconds_total",
+            "Time requests have spent waiting for their turn.",
+            per_gateway(lambda gateway: gateway.limiter.wait_seconds_total),
+            ("gateway",),
+        )
+    )
+    REGISTRY.register(
+        Gauge(
+            "enphase_proxy_cache",
+            "Response cache entries and lookups.",
+            lambda: {
+                (name, stat): value for name, gateway in gateways.items() for stat, value in gateway.cache.stats.items()
+            },
+            ("gateway", "stat"),
+        )
+    )
+    REGISTRY.register(
+        Gauge(
+            "enphase_proxy_circuit_open",
+            "Whether requests to the envoy are being refused.",
+            per_gateway(lambda gateway: 1 if gateway.breaker.state == OPEN else 0),
+            ("gateway",),
+        )
+    )
+    REGISTRY.register(
+        Gauge(
+            "enphase_proxy_upstream_timeout_seconds",
+            "How long a request to the envoy may take right now.",
+            per_gateway(lambda gateway: gateway.breaker.timeout),
+            ("gateway",),
+        )
+    )
+
+    def startup_seconds() -> dict[str, float]:
+        results = dict(startup)
+        if credentials_updater.startup_seconds is not None:
+            results["credentials"] = credentials_updater.startup_seconds
+        return results
+
+    REGISTRY.register(
+        Gauge(
+            "enphase_proxy_startup_seconds",
+            "Seconds that each part of starting up took.",
+            lambda: {(phase,): seconds for phase, seconds in startup_seconds().items()},
+            ("phase",),
+        )
+    )
+    REGISTRY.register(
+        Gauge(
+            "enphase_proxy_credentials_expiry_seconds",
+            "Seconds until the current token expires.",
+            credentials_expiry,
+            ("gateway",),
+        )
+    )
+
+    # the number of distinct paths that we will count requests for. anything
+    # past this is counted together so that a misbehaving client can't make
+    # the metrics grow forever.
+    metrics_max_paths = int(app.config.get("METRICS_MAX_PATHS", 100))
+    metrics_paths: set[str] = set()
+
+    @app.after_request
+    async def count(response: Response) -> Response:
+        path = request.path
+        if path not in metrics_paths:
+            if len(metrics_paths) < metrics_max_paths:
+                metrics_paths.add(path)
+            else:
+                path = "other"
+        REQUESTS.labels(path, str(response.status_code)).inc()
+        return response
+
     @app.route("/_/health")
     async def health() -> ResponseTypes:
         return await make_response(
@@ -28,37 +285,261 @@ def load() -> Quart:
                     "status": "pass",
                     "message": "flux capacitor is fluxing",
                     "version": __version__,
+                    "ready": credentials_updater.is_ready,
+                    "startup": {f"{phase}_seconds": seconds for phase, seconds in startup_seconds().items()},
+                    "gateways": {name: gateway.stats for name, gateway in gateways.items()},
+                    "shared": shared_cache.stats,
+                    "rate_limit": rate_limiter.stats,
+                    "export": exporter.stats,
                 }
             ),
             200,
         )
 
-    @app.route("/", defaults={"path": ""}, methods=["HEAD", "GET", "POST"])
-    @app.route("/<path:path>", methods=["HEAD", "GET", "POST"])
-    async def proxy(path: str) -> ResponseTypes:
+    @app.route("/_/live")
+    async def live() -> ResponseTypes:
+        # if we can answer at all then we are alive
+        return await make_response(jsonify({"status": "pass"}), 200)
+
+    @app.route("/_/ready")
+    async def ready() -> ResponseTypes:
+        # we are ready once every gateway has credentials. until then requests
+        # to the envoy wait for them.
+        if not credentials_updater.is_ready:
+            return await make_response(jsonify({"status": "fail", "message": "still fetching credentials"}), 503)
+        return await make_response(jsonify({"status": "pass"}), 200)
+
+    @app.route("/_/metrics")
+    async def metrics() -> ResponseTypes:
+        response = await make_response(REGISTRY.render(), 200)
+        response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+        return response
+
+    @app.route("/_/stream/meter", defaults={"name": None})
+    @app.route("/_/stream/meter/<name>")
+    async def stream_meter(name: Optional[str]) -> ResponseTypes:
+        meter_stream = find_gateway(name).meter_stream
+
+        async def events() -> AsyncIterator[bytes]:
+            async with meter_stream.subscribe() as subscription:
+                async for record in subscription:
+                    yield b"data: " + record + b"\n\n"
+
+        response = await make_response(events(), 200)
+        response.headers["Content-Type"] = "text/event-stream"
+        response.headers["Cache-Control"] = "no-cache"
+        # this response never ends so it must never time out
+        response.timeout = None
+        return response
+
+    @app.websocket("/_/ws/meter", defaults={"name": None})
+    @app.websocket("/_/ws/meter/<name>")
+    async def websocket_meter(name: Optional[str]) -> None:
+        async with find_gateway(name).meter_stream.subscribe() as subscription:
+            async for record in subscription:
+                await websocket.send(record.decode())
+
+    @app.route("/_/history", defaults={"name": None})
+    @app.route("/_/history/<name>")
+    async def history(name: Optional[str]) -> ResponseTypes:
+        # series may be given more than once or separated with commas
+        names = [series for value in request.args.getlist("series") for series in value.split(",") if series]
+        try:
+            start, end, resolution = (
+                float(request.args[argument]) if argument in request.args else None
+                for argument in ("start", "end", "resolution")
+            )
+            if not all(math.isfinite(value) for value in (start, end, resolution) if value is not None):
+                raise ValueError("start, end, and resolution must be numbers")
+            if resolution is not None and resolution <= 0:
+                raise ValueError("resolution must be greater than zero")
+        except ValueError as e:
+            return await make_response(jsonify({"status": "fail", "message": str(e)}), 400)
+
+        return await make_response(jsonify(find_gateway(name).history.query(names, start, end, resolution)), 200)
+
+    @app.route("/_/summary", defaults={"name": None})
+    @app.route("/_/summary/<name>")
+    async def summary(name: Optional[str]) -> ResponseTypes:
+        try:
+            return await respond(await find_gateway(name).summary())
+        except (KeyError, TypeError, ValueError) as e:
+            app.logger.warning("unable to summarize production: %s", str(e))
+            message = "unable to read production from the envoy"
+            return await make_response(jsonify({"status": "fail", "message": message}), 502)
+
+    @app.route("/_/aggregate/<path:path>")
+    async def aggregate(path: str) -> ResponseTypes:
+        # every gateway gets the same amount of time. one that doesn't answer
+        # in time is reported as such and doesn't hold up the rest.
+        destination = build_destination(path)
+        results = await asyncio.gather(
+            *[
+                collect(gateway, destination, aggregate_timeout, f"/gw/{name}/{path}")
+                for name, gateway in gateways.items()
+            ]
+        )
+        return await make_response(jsonify({"path": destination, "gateways": dict(zip(gateways, results))}), 200)
+
+    @app.route("/_/batch", methods=["POST"])
+    async def batch() -> ResponseTypes:
+        # this is a list of paths or of objects with a path and a gateway
+        items = await request.get_json(force=True, silent=True)
+        if not isinstance(items, list) or not items:
+            return await make_response(jsonify({"status": "fail", "message": "expected a list of paths"}), 400)
+        if len(items) > batch_max_paths:
+            message = f"expected at most {batch_max_paths} paths"
+            return await make_response(jsonify({"status": "fail", "message": message}), 400)
+
+        async def run(item: Any) -> dict[str, Any]:
+            path, name = (item, None) if not isinstance(item, dict) else (item.get("path"), item.get("gateway"))
+            if not isinstance(path, str) or not path.startswith("/"):
+                return {"path": path, "status": 400, "error": "expected a path that starts with '/'"}
+
+            destination = normalize(path)
+            try:
+                gateway = find_gateway(None if name is None else str(name))
+            except UnknownGateway as e:
+                return {"path": destination, "status": 404, "error": str(e)}
+            route = destination.partition("?")[0]
+            route = route if name is None else f"/gw/{gateway.name}{route}"
+            result = await collect(gateway, destination, batch_timeout, route)
+            return {"path": destination, "gateway": gateway.name, **result}
+
+        results = await asyncio.gather(*[run(item) for item in items])
+        return await make_response(jsonify({"responses": results}), 200)
+
+    @app.errorhandler(UpstreamOverloaded)
+    async def overloaded(e: UpstreamOverloaded) -> ResponseTypes:
+        app.logger.warning("rejecting request for %s: %s", request.path, str(e))
+        response = await make_response(jsonify({"status": "fail", "message": str(e)}), 503)
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response
+
+    @app.errorhandler(RateLimited)
+    async def rate_limited(e: RateLimited) -> ResponseTypes:
+        response = await make_response(jsonify({"status": "fail", "message": str(e)}), 429)
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response
+
+    @app.errorhandler(httpx.HTTPError)
+    async def unavailable(e: httpx.HTTPError) -> ResponseTypes:
+        app.logger.warning("unable to send request for %s: %s", request.path, str(e) or type(e).__name__)
+        status = 504 if isinstance(e, httpx.TimeoutException) else 502
+        return await make_response(jsonify({"status": "fail", "message": str(e) or type(e).__name__}), status)
+
+    @app.errorhandler(InvalidProjection)
+    async def invalid_projection(e: InvalidProjection) -> ResponseTypes:
+        return await make_response(jsonify({"status": "fail", "message": str(e)}), 400)
+
+    @app.errorhandler(UnknownGateway)
+    async def unknown_gateway(e: UnknownGateway) -> ResponseTypes:
+        return await make_response(jsonify({"status": "fail", "message": str(e)}), 404)
+
+    def build_destination(path: str) -> str:
         destination = f"/{path}"
-        args = dict(request.args.lists())
+        # sort the arguments so that the same request always has the same
+        # destination no matter what order the client put the arguments in.
+        # arguments that start with "_" are for us and never go to the envoy.
+        args = dict(sorted((name, values) for name, values in request.args.lists() if not name.startswith("_")))
         if len(args):
             destination = f"{destination}?{urlencode(args, doseq=True)}"
-        app.logger.debug("sending request for: %s", destination)
-
-        async with httpx.AsyncClient(
-            verify=False,  # noqa S501
-            timeout=300,
-            base_url=app.config["LOCAL_API_URL"],
-        ) as client:
-            result = await client.request(
-                request.method,
-                destination,
-                headers={"Authorization": f"Bearer {credentials_updater.credentials}"},
-            )
-            content = result.text
-            status_code = result.status_code
+        return destination
+
+    async def forward(gateway: Gateway, path: str) -> ResponseTypes:
+        destination = build_destination(path)
+        app.logger.debug("sending request to %s for: %s", gateway.name, destination)
 
-            response = await make_response(content, status_code)
-            response.headers["Content-Type"] = result.headers.get("content-type")
+        # only the fields that the client asked for are sent back to it. they
+        # can only be picked out of a whole response so a HEAD request gets
+        # the headers of what a GET request would have gotten.
+        method = request.method
+        projection = projection_for(request.args.get("_fields")) if method in ("HEAD", "GET") else None
+        if projection is not None:
+            method = "GET"
+        try:
+            return await send(gateway, method, path, destination, projection)
+        except (CircuitOpen, httpx.HTTPError) as e:
+            # the envoy isn't answering. if we have ever had a good answer for
+            # this then give that back and say how old it is.
+            entry = gateway.fallback(method, destination) if method in ("HEAD", "GET") else None
+            if entry is None:
+                raise
+
+            app.logger.warning("sending stale response for %s: %s", destination, str(e) or type(e).__name__)
+            response = await respond(entry, projection)
+            response.headers["Age"] = str(int(entry.age))
+            response.headers["Warning"] = '110 - "Response is Stale"'
             return response
 
+    def request_body() -> Optional[AsyncIterable[bytes]]:
+        # the body is passed to the envoy a piece at a time as it arrives and
+        # is never held in memory. a request without a body doesn't get one.
+        if request.content_length or "chunked" in request.headers.get("Transfer-Encoding", "").lower():
+            return request.body
+        return None
+
+    async def send(
+        gateway: Gateway,
+        method: str,
+        path: str,
+        destination: str,
+        projection: Optional[Projection],
+    ) -> ResponseTypes:
+        if method in ("HEAD", "GET"):
+            # anything that is being polled is answered right away from the
+            # latest snapshot and never waits on the envoy
+            snapshot = gateway.poller.get(destination)
+            if snapshot is not None:
+                response = await respond(snapshot, projection)
+                response.headers["Age"] = str(int(snapshot.age))
+                return response
+
+            # a cached response is shared by every client so nothing that one
+            # client sent is passed along to the envoy for it
+            if gateway.cache.ttl(f"/{path}") is not None:
+                return await respond(await gateway.get(method, destination), projection)
+
+        # a projection needs the whole response so it is never streamed
+        headers = select_headers(request.headers, gateway.upstream.request_headers)
+        if projection is not None or not app.config.get("LOCAL_API_STREAMING", True):
+            return await respond(await gateway.fetch(method, destination, headers, request_body()), projection)
+
+        # the body is passed through without being decoded so we need to make
+        # sure that the envoy only uses an encoding that the client accepts.
+        headers["Accept-Encoding"] = request.headers.get("Accept-Encoding", "identity")
+        result = await gateway.stream(method, destination, headers, request_body())
+
+        # the body is made into a response directly because quart only takes
+        # generators. the server closes the body when it is done with it, even
+        # if it never started sending it, which gives back our slot.
+        response = app.response_class(gateway.iterate(result), result.status_code)
+        response.headers.update(select_headers(result.headers, gateway.upstream.response_headers))
+        return response
+
+    @app.route("/gw/<name>/", defaults={"path": ""}, methods=PROXY_METHODS)
+    @app.route("/gw/<name>/<path:path>", methods=PROXY_METHODS)
+    async def proxy_gateway(name: str, path: str) -> ResponseTypes:
+        return await forward(find_gateway(name), path)
+
+    @app.route("/", defaults={"path": ""}, methods=PROXY_METHODS)
+    @app.route("/<path:path>", methods=PROXY_METHODS)
+    async def proxy(path: str) -> ResponseTypes:
+        return await forward(default_gateway, path)
+
+    # this runs after everything else that happens before we start serving,
+    # like fetching credentials if we wait for them
+    @app.before_serving
+    async def serving() -> None:
+        startup["serving"] = time.perf_counter() - STARTED_AT
+        app.logger.info(
+            "ready to serve after %.3f seconds: %s",
+            startup["serving"],
+            ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in startup.items()),
+        )
+
+    startup["load"] = time.perf_counter() - started
+
     # tell ourselves what we've mapped
     if app.logger.isEnabledFor(logging.DEBUG):
         for url in app.url_map.iter_rules():
@@ -0,0 +1,152 @@
+import logging
+import math
+import time
+from collections import deque
+from typing import Optional
+
+from quart import Quart
+
+from .limiter import UpstreamOverloaded
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpen(UpstreamOverloaded):
+    pass
+
+
+class CircuitBreaker:
+
+    def __init__(self: "CircuitBreaker", app: Optional[Quart] = None, name: str = "envoy") -> None:
+        # the circuit opens when at least this fraction of the most recent
+        # requests failed. a request fails if it raised an error, if the envoy
+        # answered with a 5xx, or if it took longer than "slow_seconds".
+        self.window = 20
+        self.min_requests = 5
+        self.error_rate = 0.5
+        self.slow_seconds = 30.0
+
+        # once open, everything is rejected right away for this many seconds.
+        # then this many requests are let through to see if the envoy is back.
+        self.open_seconds = 30.0
+        self.half_open_requests = 1
+
+        # requests time out after a multiple of how long recent requests took
+        # but never sooner than the minimum or later than the maximum. until
+        # there are enough samples the maximum is used.
+        self.timeout_percentile = 0.99
+        self.timeout_multiplier = 3.0
+        self.timeout_min = 30.0
+        self.timeout_max = 300.0
+
+        self.name = name
+        self.state = CLOSED
+        self.outcomes: deque[bool] = deque(maxlen=self.window)
+        self.latencies: deque[float] = deque(maxlen=100)
+        self.opened_at = 0.0
+        self.probes = 0
+
+        # these are for monitoring
+        self.opened = 0
+        self.rejected = 0
+
+        self.app: Optional[Quart] = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self: "CircuitBreaker", app: Quart) -> None:
+        self.app = app
+        self.window = int(app.config.get("BREAKER_WINDOW", self.window))
+        self.min_requests = int(app.config.get("BREAKER_MIN_REQUESTS", self.min_requests))
+        self.error_rate = float(app.config.get("BREAKER_ERROR_RATE", self.error_rate))
+        self.slow_seconds = float(app.config.get("BREAKER_SLOW_SECONDS", self.slow_seconds))
+        self.open_seconds = float(app.config.get("BREAKER_OPEN_SECONDS", self.open_seconds))
+        self.half_open_requests = int(app.config.get("BREAKER_HALF_OPEN_REQUESTS", self.half_open_requests))
+        self.timeout_percentile = float(app.config.get("BREAKER_TIMEOUT_PERCENTILE", self.timeout_percentile))
+        self.timeout_multiplier = float(app.config.get("BREAKER_TIMEOUT_MULTIPLIER", self.timeout_multiplier))
+        self.timeout_min = float(app.config.get("BREAKER_TIMEOUT_MIN", self.timeout_min))
+        self.timeout_max = float(app.config.get("BREAKER_TIMEOUT_MAX", app.config.get("LOCAL_API_TIMEOUT", 300)))
+        self.outcomes = deque(maxlen=self.window)
+
+    def allow(self: "CircuitBreaker") -> bool:
+        # raise if the request may not be sent. otherwise say whether it is
+        # one of the requests that decides if the circuit closes again.
+        if self.state == OPEN:
+            remaining = self.opened_at + self.open_seconds - time.monotonic()
+            if remaining > 0:
+                self.rejected += 1
+                raise CircuitOpen(f"envoy {self.name} is unavailable", math.ceil(remaining))
+
+            logger.info("circuit for envoy %s is half-open", self.name)
+            self.state = HALF_OPEN
+            self.probes = 0
+
+        if self.state == HALF_OPEN:
+            if self.probes >= self.half_open_requests:
+                self.rejected += 1
+                raise CircuitOpen(f"envoy {self.name} is unavailable", math.ceil(self.open_seconds))
+            self.probes += 1
+            return True
+
+        return False
+
+    def record(self: "CircuitBreaker", probe: bool, success: bool, seconds: float) -> None:
+        if success:
+            self.latencies.append(seconds)
+        failed = not success or seconds > self.slow_seconds
+
+        if probe:
+            if self.state == HALF_OPEN:
+                self.probes -= 1
+                if failed:
+                    self._open()
+                else:
+                    self._close()
+            return
+
+        # results that come back after the circuit opened don't count
+        if self.state != CLOSED:
+            return
+
+        self.outcomes.append(failed)
+        if len(self.outcomes) >= self.min_requests and sum(self.outcomes) / len(self.outcomes) >= self.error_rate:
+            self._open()
+
+    def abandon(self: "CircuitBreaker", probe: bool) -> None:
+        # the request went away before we learned anything from it
+        if probe and self.state == HALF_OPEN:
+            self.probes -= 1
+
+    def _open(self: "CircuitBreaker") -> None:
+        logger.warning("circuit for envoy %s is open for %g seconds", self.name, self.open_seconds)
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.outcomes.clear()
+        self.opened += 1
+
+    def _close(self: "CircuitBreaker") -> None:
+        logger.info("circuit for envoy %s is closed", self.name)
+        self.state = CLOSED
+        self.outcomes.clear()
+
+    @property
+    def timeout(self: "CircuitBreaker") -> float:
+        if len(self.latencies) < self.min_requests:
+            return self.timeout_max
+
+        latencies = sorted(self.latencies)
+        index = max(0, math.ceil(self.timeout_percentile * len(latencies)) - 1)
+        return min(max(latencies[index] * self.timeout_multiplier, self.timeout_min), self.timeout_max)
+
+    @property
+    def stats(self: "CircuitBreaker") -> dict[str, object]:
+        return {
+            "state": self.state,
+            "timeout": self.timeout,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
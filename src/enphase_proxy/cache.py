@@ -0,0 +1,194 @@
+import asyncio
+import fnmatch
+import functools
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Iterable, Optional, TypeVar
+
+import httpx
+from quart import Quart
+
+from .encoding import compute_etag, encoder
+
+logger = logging.getLogger(__name__)
+
+# these are the headers from the envoy that are kept with a cached response.
+# the body is stored decoded so nothing about its encoding or length is kept.
+CACHED_HEADERS = ("content-type", "cache-control", "last-modified")
+
+T = TypeVar("T")
+
+# this is the most projections of one response that are kept with it. anyone
+# can ask for any fields so this has to be small.
+MAX_PROJECTIONS = 16
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    status_code: int
+    headers: dict[str, str]
+    content: bytes
+    fetched_at: float = field(default_factory=time.monotonic)
+
+    # the content in each encoding that it has been asked for. a response
+    # that is served over and over is only ever compressed once.
+    encoded: dict[str, bytes] = field(default_factory=dict, compare=False, repr=False)
+
+    # the content read into each model that it has been asked for. everything
+    # that reads the same response shares what it was read into.
+    parsed: dict[Callable[[bytes], Any], Any] = field(default_factory=dict, compare=False, repr=False)
+
+    # the content cut down to each set of fields that it has been asked for,
+    # least recently used first. these aren't kept when the response is
+    # fetched again.
+    projected: OrderedDict[Callable[[bytes], bytes], bytes] = field(
+        default_factory=OrderedDict, compare=False, repr=False
+    )
+
+    @classmethod
+    def from_response(
+        cls: type["CachedResponse"],
+        response: httpx.Response,
+        names: Iterable[str] = CACHED_HEADERS,
+    ) -> "CachedResponse":
+        return cls(
+            status_code=response.status_code,
+            headers={name: response.headers[name] for name in names if name in response.headers},
+            content=response.content,
+        )
+
+    @property
+    def age(self: "CachedResponse") -> float:
+        return time.monotonic() - self.fetched_at
+
+    @functools.cached_property
+    def etag(self: "CachedResponse") -> str:
+        return compute_etag(self.content)
+
+    def inherit(self: "CachedResponse", previous: Optional["CachedResponse"]) -> None:
+        # when a response is fetched again and nothing changed then keep the
+        # work that we already did on the last one
+        if previous is not None and previous.content == self.content:
+            self.encoded.update(previous.encoded)
+            self.parsed.update(previous.parsed)
+
+    def parse(self: "CachedResponse", loader: Callable[[bytes], T]) -> T:
+        # the models are never changed by whoever asked for them so they are
+        # safe to share
+        if loader not in self.parsed:
+            self.parsed[loader] = loader(self.content)
+        return self.parsed[loader]
+
+    def project(self: "CachedResponse", projection: Callable[[bytes], bytes]) -> bytes:
+        content = self.projected.get(projection)
+        if content is None:
+            content = self.projected[projection] = projection(self.content)
+            while len(self.projected) > MAX_PROJECTIONS:
+                self.projected.popitem(last=False)
+        else:
+            self.projected.move_to_end(projection)
+        return content
+
+    def encode(self: "CachedResponse", encoding: str) -> bytes:
+        content = self.encoded.get(encoding)
+        if content is None:
+            content = self.encoded[encoding] = encoder(encoding)(self.content)
+        return content
+
+
+class ResponseCache:
+
+    def __init__(self: "ResponseCache", app: Optional[Quart] = None) -> None:
+        # these are the paths that may be cached and how long, in seconds, a
+        # response for each of them is good for. the first pattern that
+        # matches a path wins. paths that match nothing are never cached.
+        self.rules: list[tuple[str, float]] = []
+
+        # this is the most responses that we will keep around. when we have
+        # too many then the least recently used ones are thrown away.
+        self.max_entries = 256
+
+        # this is the cache itself, in least recently used order, and all of
+        # the fetches that are currently waiting on the envoy. when a fetch is
+        # already running then everyone else asking for it waits on that one.
+        self.entries: OrderedDict[tuple[str, str], CachedResponse] = OrderedDict()
+        self.pending: dict[tuple[str, str], asyncio.Task] = {}
+
+        # these are for monitoring
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        self.app: Optional[Quart] = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self: "ResponseCache", app: Quart) -> None:
+        self.app = app
+        self.rules = [(pattern, float(ttl)) for pattern, ttl in (app.config.get("CACHE_TTLS") or {}).items()]
+        self.max_entries = int(app.config.get("CACHE_MAX_ENTRIES", self.max_entries))
+
+    def ttl(self: "ResponseCache", path: str) -> Optional[float]:
+        for pattern, ttl in self.rules:
+            if fnmatch.fnmatchcase(path, pattern):
+                return ttl
+        return None
+
+    async def fetch(
+        self: "ResponseCache",
+        method: str,
+        destination: str,
+        ttl: float,
+        loader: Callable[[], Awaitable[CachedResponse]],
+    ) -> CachedResponse:
+        key = (method, destination)
+
+        entry = self.entries.get(key)
+        if entry is not None and entry.age < ttl:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        task = self.pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.create_task(self._load(key, loader))
+            self.pending[key] = task
+        else:
+            self.coalesced += 1
+
+        # the fetch runs in its own task so that if the client that started it
+        # goes away then everyone else who is waiting on it still gets a result
+        return await asyncio.shield(task)
+
+    async def _load(
+        self: "ResponseCache",
+        key: tuple[str, str],
+        loader: Callable[[], Awaitable[CachedResponse]],
+    ) -> CachedResponse:
+        try:
+            entry = await loader()
+            if entry.status_code == 200:
+                self.store(key, entry)
+            return entry
+        finally:
+            self.pending.pop(key, None)
+
+    def store(self: "ResponseCache", key: tuple[str, str], entry: CachedResponse) -> None:
+        entry.inherit(self.entries.get(key))
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            evicted, _ = self.entries.popitem(last=False)
+            logger.debug("evicted cached response for: %s %s", *evicted)
+
+    @property
+    def stats(self: "ResponseCache") -> dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
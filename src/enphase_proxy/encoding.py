@@ -0,0 +1,82 @@
+import gzip
+import hashlib
+import importlib
+import logging
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _gzip() -> Callable[[bytes], bytes]:
+    return lambda content: gzip.compress(content, compresslevel=6, mtime=0)
+
+
+def _brotli() -> Callable[[bytes], bytes]:
+    brotli = importlib.import_module("brotli")
+    return lambda content: brotli.compress(content, quality=5)
+
+
+def _zstd() -> Callable[[bytes], bytes]:
+    # this is in the standard library starting with python 3.14 and before
+    # that it is available from the "zstandard" package
+    try:
+        zstd = importlib.import_module("compression.zstd")
+        return lambda content: zstd.compress(content, level=3)
+    except ImportError:
+        zstandard = importlib.import_module("zstandard")
+        compressor = zstandard.ZstdCompressor(level=3)
+        return compressor.compress
+
+
+# these are all of the encodings that we know how to make and how to load the
+# thing that makes them. an encoding whose module isn't installed is skipped.
+LOADERS: dict[str, Callable[[], Callable[[bytes], bytes]]] = {
+    "zstd": _zstd,
+    "br": _brotli,
+    "gzip": _gzip,
+}
+
+_encoders: dict[str, Optional[Callable[[bytes], bytes]]] = {}
+
+
+def encoder(encoding: str) -> Optional[Callable[[bytes], bytes]]:
+    # encoders are loaded the first time that they are asked for so that we
+    # never import a compression library that nobody uses
+    if encoding not in _encoders:
+        try:
+            _encoders[encoding] = LOADERS[encoding]()
+        except (ImportError, KeyError):
+            logger.info("content encoding '%s' is not available", encoding)
+            _encoders[encoding] = None
+    return _encoders[encoding]
+
+
+def negotiate(accept_encoding: Optional[str], preferences: list[str]) -> Optional[str]:
+    # pick the first of our preferred encodings that the client will take.
+    # None means that the content should be sent as it is.
+    if not accept_encoding:
+        return None
+
+    accepted: dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, parameters = item.partition(";")
+        quality = 1.0
+        parameter = parameters.strip()
+        if parameter.startswith("q="):
+            try:
+                quality = float(parameter[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    wildcard = accepted.get("*", 0.0)
+    for encoding in preferences:
+        if accepted.get(encoding, wildcard) > 0 and encoder(encoding) is not None:
+            return encoding
+    return None
+
+
+def compute_etag(content: bytes) -> str:
+    # this doesn't need to be secure. it only needs to be fast and to change
+    # whenever the content changes.
+    return hashlib.blake2b(content, digest_size=12).hexdigest()
@@ -0,0 +1,463 @@
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Mapping, Optional
+
+import httpx
+from quart import Quart
+
+from .cache import CachedResponse
+from .history import PARSERS, take_samples
+
+logger = logging.getLogger(__name__)
+
+Loader = Callable[[str, str], Awaitable[CachedResponse]]
+
+
+def _escape(value: str) -> str:
+    # commas, spaces, and equals signs are special in tags and field names
+    return value.replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def influx_line(measurement: str, gateway: str, name: str, timestamp: float, value: float) -> str:
+    # one reading in the influxdb line protocol with the time in nanoseconds
+    return f"{_escape(measurement)},gateway={_escape(gateway)} {_escape(name)}={value!r} {round(timestamp * 1e9)}\n"
+
+
+def csv_line(measurement: str, gateway: str, name: str, timestamp: float, value: float) -> str:
+    # gateway names are serial numbers and reading names never have commas
+    return f"{timestamp!r},{gateway},{name},{value!r}\n"
+
+
+@dataclass(frozen=True)
+class ExportFormat:
+    line: Callable[[str, str, str, float, float], str]
+    content_type: str
+    extension: str
+
+    # this goes at the top of every file and every batch, if there is one
+    header: str = ""
+
+
+# these are the formats that readings may be exported in
+FORMATS = {
+    "influx": ExportFormat(influx_line, "text/plain; charset=utf-8", "lp"),
+    "csv": ExportFormat(csv_line, "text/csv; charset=utf-8", "csv", "timestamp,gateway,name,value\n"),
+}
+
+
+class ExportSink:
+    # this is where batches of readings go. it raises if a batch couldn't be
+    # written so that the batch can be kept and written later. the base class
+    # throws every batch away.
+
+    async def startup(self: "ExportSink") -> None:
+        return None
+
+    async def shutdown(self: "ExportSink") -> None:
+        return None
+
+    async def write(self: "ExportSink", payload: bytes) -> None:
+        return None
+
+
+class HttpExportSink(ExportSink):
+
+    def __init__(
+        self: "HttpExportSink",
+        url: str,
+        export_format: ExportFormat,
+        headers: Optional[Mapping[str, str]] = None,
+        timeout: float = 10.0,
+    ) -> None:
+        self.url = url
+        self.export_format = export_format
+        self.headers = {"Content-Type": export_format.content_type, **(headers or {})}
+        self.timeout = timeout
+        self.client: Optional[httpx.AsyncClient] = None
+
+    async def startup(self: "HttpExportSink") -> None:
+        self.client = httpx.AsyncClient(timeout=self.timeout)
+
+    async def shutdown(self: "HttpExportSink") -> None:
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def write(self: "HttpExportSink", payload: bytes) -> None:
+        if self.client is None:
+            raise RuntimeError("export client is not open")
+
+        response = await self.client.post(
+            self.url, content=self.export_format.header.encode() + payload, headers=self.headers
+        )
+        response.raise_for_status()
+
+
+class FileExportSink(ExportSink):
+
+    def __init__(
+        self: "FileExportSink",
+        path: str,
+        export_format: ExportFormat,
+        max_bytes: int = 10 * 1024 * 1024,
+        backups: int = 5,
+    ) -> None:
+        # when the file gets bigger than "max_bytes" it is renamed to end with
+        # ".1", what was ".1" becomes ".2", and so on, keeping "backups" of them
+        self.path = path
+        self.export_format = export_format
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    async def write(self: "FileExportSink", payload: bytes) -> None:
+        await asyncio.to_thread(self._write, payload)
+
+    def _write(self: "FileExportSink", payload: bytes) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            if os.path.getsize(self.path) + len(payload) > self.max_bytes:
+                self._rotate()
+
+        with open(self.path, "ab") as f:
+            if f.tell() == 0:
+                f.write(self.export_format.header.encode())
+            f.write(payload)
+
+    def _rotate(self: "FileExportSink") -> None:
+        for index in range(self.backups - 1, 0, -1):
+            with contextlib.suppress(FileNotFoundError):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+
+class SpillDirectory:
+
+    def __init__(self: "SpillDirectory", path: str, extension: str, max_bytes: int) -> None:
+        # batches that couldn't be written are kept here, one per file, until
+        # they can be. when there are more than "max_bytes" of them then the
+        # oldest ones are thrown away to make room.
+        self.path = path
+        self.extension = extension
+        self.max_bytes = max_bytes
+        self.sequence = 0
+
+    async def push(self: "SpillDirectory", payload: bytes) -> int:
+        return await asyncio.to_thread(self._push, payload)
+
+    def _push(self: "SpillDirectory", payload: bytes) -> int:
+        # gives back how many readings were thrown away to make room
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+
+        dropped = 0
+        files = self._files()
+        total = sum(size for _, size in files)
+        while files and total + len(payload) > self.max_bytes:
+            path, size = files.pop(0)
+            with open(path, "rb") as f:
+                dropped += f.read().count(b"\n")
+            os.remove(path)
+            total -= size
+
+        if len(payload) > self.max_bytes:
+            return dropped + payload.count(b"\n")
+
+        # names sort in the order that they were written. the batch is written
+        # to a hidden file first so that nothing ever reads half of one.
+        self.sequence += 1
+        name = f"{time.time_ns():020d}-{os.getpid()}-{self.sequence:06d}.{self.extension}"
+        temporary_path = os.path.join(self.path, f".{name}")
+        with open(temporary_path, "wb") as f:
+            f.write(payload)
+        os.replace(temporary_path, os.path.join(self.path, name))
+        return dropped
+
+    def _files(self: "SpillDirectory") -> list[tuple[str, int]]:
+        try:
+            names = sorted(name for name in os.listdir(self.path) if name.endswith(f".{self.extension}"))
+        except FileNotFoundError:
+            return []
+
+        files = []
+        for name in names:
+            path = os.path.join(self.path, name)
+            with contextlib.suppress(FileNotFoundError):
+                files.append((path, os.path.getsize(path)))
+        return files
+
+    async def oldest(self: "SpillDirectory") -> Optional[tuple[str, bytes]]:
+        return await asyncio.to_thread(self._oldest)
+
+    def _oldest(self: "SpillDirectory") -> Optional[tuple[str, bytes]]:
+        for path, _ in self._files():
+            with contextlib.suppress(FileNotFoundError), open(path, "rb") as f:
+                return path, f.read()
+        return None
+
+    async def remove(self: "SpillDirectory", path: str) -> None:
+        await asyncio.to_thread(self._remove, path)
+
+    def _remove(self: "SpillDirectory", path: str) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+
+class Exporter:
+
+    def __init__(self: "Exporter", app: Optional[Quart] = None, loaders: Optional[dict[str, Loader]] = None) -> None:
+        # this is how often, in seconds, readings are taken from each gateway
+        self.export_interval = 5.0
+
+        # readings are sent in batches of this many. a batch that isn't full is
+        # sent anyway after this many seconds.
+        self.export_batch_size = 1000
+        self.export_flush_interval = 10.0
+
+        # this is the most readings that are kept in memory waiting to be
+        # written. when there are this many then no more readings are taken
+        # until some of them have been written.
+        self.export_max_buffer = 100_000
+
+        # if this is set to true then we are trying to exit. use an Event
+        # instead of a flag so that we can wait on it and exit more quickly.
+        self.export_canceled = asyncio.Event()
+
+        # the flusher is woken up by this when a full batch is waiting and the
+        # sampler waits on this when there is no more room
+        self.flush_requested = asyncio.Event()
+        self.room = asyncio.Event()
+        self.room.set()
+
+        # these are the systems for fetching readings from each gateway and
+        # for writing them out, and where batches wait while it is down
+        self.loaders: dict[str, Loader] = {}
+        self.export_format = FORMATS["influx"]
+        self.measurement = "enphase"
+        self.sink: Optional[ExportSink] = None
+        self.spill: Optional[SpillDirectory] = None
+
+        # readings waiting to be written and the time of the last reading that
+        # was taken for each gateway and name so nothing is written twice
+        self.buffer: list[str] = []
+        self.latest: dict[tuple[str, str], float] = {}
+
+        # these are for monitoring
+        self.exported = 0
+        self.dropped = 0
+        self.failures = 0
+
+        self.app: Optional[Quart] = None
+        if app is not None and loaders is not None:
+            self.init_app(app, loaders)
+
+    def init_app(self: "Exporter", app: Quart, loaders: dict[str, Loader]) -> None:
+        self.app = app
+        self.loaders = loaders
+        self.export_interval = float(app.config.get("EXPORT_INTERVAL", self.export_interval))
+        self.export_batch_size = int(app.config.get("EXPORT_BATCH_SIZE", self.export_batch_size))
+        self.export_flush_interval = float(app.config.get("EXPORT_FLUSH_INTERVAL", self.export_flush_interval))
+        self.export_max_buffer = int(app.config.get("EXPORT_MAX_BUFFER", self.export_max_buffer))
+        self.measurement = str(app.config.get("EXPORT_MEASUREMENT", self.measurement))
+
+        export_format = app.config.get("EXPORT_FORMAT", "influx")
+        if export_format not in FORMATS:
+            raise ValueError(f"unknown export format: {export_format}")
+        self.export_format = FORMATS[export_format]
+
+        if app.config.get("EXPORT_URL"):
+            self.sink = HttpExportSink(
+                app.config["EXPORT_URL"],
+                self.export_format,
+                headers=app.config.get("EXPORT_HEADERS"),
+                timeout=float(app.config.get("EXPORT_TIMEOUT", 10)),
+            )
+        elif app.config.get("EXPORT_FILE"):
+            self.sink = FileExportSink(
+                app.config["EXPORT_FILE"],
+                self.export_format,
+                max_bytes=int(app.config.get("EXPORT_FILE_MAX_BYTES", 10 * 1024 * 1024)),
+                backups=int(app.config.get("EXPORT_FILE_BACKUPS", 5)),
+            )
+
+        if app.config.get("EXPORT_SPILL_PATH"):
+            self.spill = SpillDirectory(
+                app.config["EXPORT_SPILL_PATH"],
+                self.export_format.extension,
+                int(app.config.get("EXPORT_SPILL_MAX_BYTES", 100 * 1024 * 1024)),
+            )
+
+        # nothing to do if there is nowhere to send readings
+        if self.sink is None:
+            return
+
+        @app.before_serving
+        async def startup() -> None:
+            logger.info("registering export background tasks for %d gateways", len(self.loaders))
+            await self.sink.startup()
+            app.add_background_task(self._background_looper)
+            app.add_background_task(self._flush_looper)
+
+        @app.after_serving
+        async def shutdown() -> None:
+            logger.info("signaling export background tasks to stop")
+            self.export_canceled.set()
+
+    async def _background_waiter(
+        self: "Exporter",
+        event: asyncio.Event,
+        timeout: Optional[float] = 0,
+    ) -> bool:
+        # suppress TimeoutError because we'll return False in case of timeout
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(event.wait(), timeout)
+        return event.is_set()
+
+    async def _background_looper(self: "Exporter") -> None:
+        with contextlib.suppress(asyncio.CancelledError):
+            while True:
+                # don't take any more readings until there is room for them
+                while not self.room.is_set():
+                    if await self._background_waiter(self.export_canceled, self.export_interval):
+                        break
+                else:
+                    await self._background_task()
+
+                if await self._background_waiter(self.export_canceled, self.export_interval):
+                    break
+
+        logger.info("export background task shutting down")
+
+    async def _flush_looper(self: "Exporter") -> None:
+        with contextlib.suppress(asyncio.CancelledError):
+            while not self.export_canceled.is_set():
+                await self._background_waiter(self.flush_requested, self.export_flush_interval)
+                self.flush_requested.clear()
+                # nothing that goes wrong with one flush may stop the next one
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logger.exception("unable to flush readings: %s", str(e))
+
+        # write out whatever is left, or spill it, before we go
+        with contextlib.suppress(asyncio.CancelledError):
+            await self.flush()
+            await self.sink.shutdown()
+
+        logger.info("export flush task shutting down")
+
+    async def _background_task(self: "Exporter") -> None:
+        await asyncio.gather(
+            *[self._sample(gateway, loader, path) for gateway, loader in self.loaders.items() for path in PARSERS]
+        )
+
+    async def _sample(self: "Exporter", gateway: str, loader: Loader, destination: str) -> None:
+        try:
+            entry = await loader("GET", destination)
+            if entry.status_code != 200:
+                logger.warning("unable to export %s from %s: status %d", destination, gateway, entry.status_code)
+                return
+            samples = take_samples(entry, destination)
+        except Exception as e:
+            logger.warning("unable to export %s from %s: %s", destination, gateway, str(e))
+            return
+
+        for name, (timestamp, value) in samples.items():
+            self.add(gateway, name, timestamp, value)
+
+    def add(self: "Exporter", gateway: str, name: str, timestamp: float, value: float) -> None:
+        # the same reading may be seen more than once, like when it comes from
+        # a snapshot, so anything that isn't newer than what we have is ignored
+        key = (gateway, name)
+        if timestamp <= self.latest.get(key, float("-inf")):
+            return
+        self.latest[key] = timestamp
+
+        self.buffer.append(self.export_format.line(self.measurement, gateway, name, timestamp, value))
+        if len(self.buffer) >= self.export_batch_size:
+            self.flush_requested.set()
+        if len(self.buffer) >= self.export_max_buffer:
+            self.room.clear()
+
+    async def flush(self: "Exporter") -> None:
+        # anything that was spilled goes first so that readings are written in
+        # the order that they were taken
+        if not await self._replay():
+            await self._spill()
+            return
+
+        while self.buffer:
+            batch = self.buffer[: self.export_batch_size]
+            if not await self._write("".join(batch).encode()):
+                await self._spill()
+                return
+            del self.buffer[: len(batch)]
+            self.exported += len(batch)
+            self._update_room()
+
+    async def _write(self: "Exporter", payload: bytes) -> bool:
+        try:
+            await self.sink.write(payload)
+        except Exception as e:
+            self.failures += 1
+            logger.warning("unable to export readings: %s", str(e) or type(e).__name__)
+            return False
+        return True
+
+    async def _replay(self: "Exporter") -> bool:
+        if self.spill is None:
+            return True
+
+        # when the spill directory can't be read then everything in it stays
+        # there until it can be
+        try:
+            while (spilled := await self.spill.oldest()) is not None:
+                path, payload = spilled
+                if not await self._write(payload):
+                    return False
+                await self.spill.remove(path)
+                self.exported += payload.count(b"\n")
+        except OSError as e:
+            logger.warning("unable to read spilled readings: %s", str(e))
+            return False
+        return True
+
+    async def _spill(self: "Exporter") -> None:
+        # the sink is down. with somewhere to spill to everything waiting is
+        # moved out of memory. otherwise it stays here until it can be written
+        # and only the oldest readings past the limit are thrown away.
+        if self.spill is not None and self.buffer:
+            # readings that come in while we are writing stay for next time
+            batch = self.buffer[:]
+            try:
+                self.dropped += await self.spill.push("".join(batch).encode())
+                del self.buffer[: len(batch)]
+            except OSError as e:
+                logger.warning("unable to spill readings to %s: %s", self.spill.path, str(e))
+
+        excess = len(self.buffer) - self.export_max_buffer
+        if excess > 0:
+            logger.warning("throwing away %d readings that couldn't be exported", excess)
+            del self.buffer[:excess]
+            self.dropped += excess
+        self._update_room()
+
+    def _update_room(self: "Exporter") -> None:
+        if len(self.buffer) < self.export_max_buffer:
+            self.room.set()
+        else:
+            self.room.clear()
+
+    @property
+    def stats(self: "Exporter") -> dict[str, object]:
+        return {
+            "enabled": self.sink is not None,
+            "buffered": len(self.buffer),
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "failures": self.failures,
+        }
@@ -0,0 +1,262 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import AsyncIterable, Awaitable, Callable, Optional
+from urllib.parse import urlsplit
+
+import httpx
+from quart import Quart
+
+from .breaker import CircuitBreaker
+from .cache import CACHED_HEADERS, CachedResponse, ResponseCache
+from .history import History
+from .limiter import UpstreamLimiter
+from .models import ProductionReport
+from .poller import SnapshotPoller
+from .shared import SharedCache
+from .streaming import MeterStream
+from .tools import GatewayConfiguration
+from .tracing import record
+from .updater import CredentialsUpdater
+from .upstream import StreamedBody, UpstreamClient
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownGateway(LookupError):
+
+    def __init__(self: "UnknownGateway", name: str) -> None:
+        super().__init__(name)
+        self.name = name
+
+    def __str__(self: "UnknownGateway") -> str:
+        return f"unknown gateway: {self.name}"
+
+
+class Gateway:
+
+    def __init__(
+        self: "Gateway",
+        app: Quart,
+        configuration: GatewayConfiguration,
+        credentials: CredentialsUpdater,
+        shared: Optional[SharedCache] = None,
+    ) -> None:
+        # this is everything that we keep for one envoy. each envoy has its
+        # own connections, its own limits, and its own cache so that a slow
+        # envoy can't hold up any of the others. the credentials for every
+        # envoy are kept up to date by the one credentials updater.
+        self.name = configuration.name
+        self.credentials = credentials
+
+        # initialize the shared connection pool to the enphase envoy
+        self.upstream = UpstreamClient(app, configuration.url)
+
+        # initialize the system that limits how much we ask of the envoy at once
+        self.limiter = UpstreamLimiter(app)
+
+        # initialize the cache that sits in front of the enphase envoy
+        self.cache = ResponseCache(app)
+
+        # initialize the system that stops sending requests to an envoy that
+        # isn't answering. while it isn't answering the last good response for
+        # each path is given back instead, if there is one.
+        self.breaker = CircuitBreaker(app, self.name)
+        self.fallbacks: OrderedDict[tuple[str, str], CachedResponse] = OrderedDict()
+        self.fallback_max_entries = int(app.config.get("BREAKER_FALLBACK_ENTRIES", 64))
+
+        # initialize the system that keeps snapshots of popular paths up to date.
+        # when there is more than one worker process they share the snapshots.
+        if shared is not None and not shared.enabled:
+            shared = None
+        self.poller = SnapshotPoller(app, self.fetch, shared, self.name)
+
+        # initialize the system that keeps a history of readings. it asks for
+        # them the same way that a client would so that it uses a snapshot or
+        # the cache when it can.
+        self.history = History(app, self.get)
+
+        # this is the summary of the last production report that we read and
+        # the response that it was read from
+        self.summary_source: Optional[CachedResponse] = None
+        self.summary_entry: Optional[CachedResponse] = None
+
+        # initialize the system that shares one live stream from the envoy with
+        # every client. this doesn't go through the limiter because the stream
+        # stays open forever and would hold on to a slot for all of that time.
+        self.meter_stream = MeterStream(
+            app,
+            lambda path: self.authorized(lambda headers: self.upstream.stream("GET", path, headers=headers)),
+        )
+
+    async def authorized(
+        self: "Gateway",
+        send: Callable[[dict[str, str]], Awaitable[httpx.Response]],
+        retry: bool = True,
+    ) -> httpx.Response:
+        # when we start without waiting for credentials then everyone waits
+        # here until we have them, but not forever
+        await self.credentials.wait_ready(self.name)
+
+        token = self.credentials.credentials_for(self.name)
+        result = await send({"Authorization": f"Bearer {token}"})
+        if result.status_code != 401:
+            return result
+
+        # the envoy didn't like our token. get a new one and try exactly once
+        # more. everyone else who was rejected at the same time will wait on
+        # the same renewal instead of starting their own. a request body that
+        # was streamed to the envoy is gone so that request can't be sent
+        # again. the client gets the rejection and the next one will work.
+        logger.warning("envoy %s rejected our credentials -- renewing credentials", self.name)
+        started = time.perf_counter()
+        try:
+            token = await self.credentials.renew(self.name, token)
+        except Exception as e:
+            logger.exception("unable to renew credentials for %s: %s", self.name, str(e))
+            return result
+        finally:
+            record("credentials", time.perf_counter() - started)
+
+        if not retry:
+            return result
+
+        await result.aclose()
+        return await send({"Authorization": f"Bearer {token}"})
+
+    async def guarded(
+        self: "Gateway",
+        send: Callable[[dict[str, str], httpx.Timeout], Awaitable[httpx.Response]],
+        retry: bool = True,
+    ) -> httpx.Response:
+        # everything that a client is waiting on goes through the circuit
+        # breaker. when the envoy is down we fail right away instead of making
+        # everyone wait for it to time out.
+        probe = self.breaker.allow()
+        timeout = self.timeout()
+        started = time.monotonic()
+        try:
+            result = await self.authorized(lambda headers: send(headers, timeout), retry)
+        except httpx.HTTPError:
+            self.breaker.record(probe, False, time.monotonic() - started)
+            raise
+        except BaseException:
+            self.breaker.abandon(probe)
+            raise
+
+        self.breaker.record(probe, result.status_code < 500, time.monotonic() - started)
+        return result
+
+    def timeout(self: "Gateway") -> httpx.Timeout:
+        # only the time spent waiting on the envoy itself adapts. connecting
+        # and waiting for a connection from the pool keep their own limits.
+        seconds = self.breaker.timeout
+        if self.upstream.client is None:
+            return httpx.Timeout(seconds)
+        configured = self.upstream.client.timeout
+        return httpx.Timeout(connect=configured.connect, read=seconds, write=seconds, pool=configured.pool)
+
+    async def fetch(
+        self: "Gateway",
+        method: str,
+        destination: str,
+        headers: Optional[dict[str, str]] = None,
+        content: Optional[AsyncIterable[bytes]] = None,
+    ) -> CachedResponse:
+        # the body of the response is read and decoded here so only the headers
+        # that still make sense for it are kept, if they are allowed at all
+        names = [name for name in CACHED_HEADERS if name in self.upstream.response_headers]
+        async with self.limiter.slot(destination):
+            result = await self.guarded(
+                lambda authorization, timeout: self.upstream.request(
+                    method,
+                    destination,
+                    headers={**(headers or {}), **authorization},
+                    content=content,
+                    timeout=timeout,
+                ),
+                retry=content is None,
+            )
+            entry = CachedResponse.from_response(result, names)
+
+        # keep the last good response for every path that we've fetched whole
+        # so that there is something to give back if the envoy goes away
+        if entry.status_code == 200 and method in ("HEAD", "GET"):
+            key = (method, destination)
+            self.fallbacks[key] = entry
+            self.fallbacks.move_to_end(key)
+            while len(self.fallbacks) > self.fallback_max_entries:
+                self.fallbacks.popitem(last=False)
+
+        return entry
+
+    def fallback(self: "Gateway", method: str, destination: str) -> Optional[CachedResponse]:
+        return self.fallbacks.get((method, destination))
+
+    async def get(self: "Gateway", method: str, destination: str) -> CachedResponse:
+        # answer from the latest snapshot or from the cache if we can and only
+        # go to the envoy if we have to. this may outlive the request that
+        # asked for it so it must not touch the request context.
+        snapshot = self.poller.get(destination)
+        if snapshot is not None:
+            return snapshot
+
+        ttl = self.cache.ttl(urlsplit(destination).path)
+        if ttl is not None:
+            return await self.cache.fetch(method, destination, ttl, lambda: self.fetch(method, destination))
+
+        return await self.fetch(method, destination)
+
+    async def summary(self: "Gateway") -> CachedResponse:
+        # the summary is worked out once for each production report and every
+        # request until the next one gets the same bytes. poll production.json
+        # and requests for this never wait on the envoy.
+        entry = await self.get("GET", "/production.json")
+        if entry.status_code != 200:
+            return entry
+
+        source = self.summary_source
+        if source is None or (entry is not source and entry.content != source.content):
+            summary = {"gateway": self.name, **entry.parse(ProductionReport.from_content).summary}
+            self.summary_entry = CachedResponse(
+                status_code=200,
+                headers={"content-type": "application/json"},
+                content=json.dumps(summary).encode(),
+            )
+        self.summary_source = entry
+        return self.summary_entry
+
+    async def stream(
+        self: "Gateway",
+        method: str,
+        destination: str,
+        headers: dict[str, str],
+        content: Optional[AsyncIterable[bytes]] = None,
+    ) -> httpx.Response:
+        # the slot is held until the body has been completely sent so the body
+        # must be sent with "iterate" to give the slot back
+        await self.limiter.acquire(destination)
+        try:
+            return await self.guarded(
+                lambda authorization, timeout: self.upstream.stream(
+                    method, destination, headers={**headers, **authorization}, content=content, timeout=timeout
+                ),
+                retry=content is None,
+            )
+        except BaseException:
+            self.limiter.release()
+            raise
+
+    def iterate(self: "Gateway", response: httpx.Response) -> StreamedBody:
+        return StreamedBody(response, self.limiter.release)
+
+    @property
+    def stats(self: "Gateway") -> dict[str, dict]:
+        return {
+            "breaker": self.breaker.stats,
+            "cache": self.cache.stats,
+            "limiter": self.limiter.stats,
+            "stream": self.meter_stream.stats,
+            "history": self.history.stats,
+        }
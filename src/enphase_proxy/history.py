@@ -0,0 +1,260 @@
+import asyncio
+import bisect
+import contextlib
+import logging
+import math
+import time
+from array import array
+from typing import Any, Awaitable, Callable, Optional
+
+from quart import Quart
+
+from .cache import CachedResponse
+from .models import MeterReading, ProductionReport, load_meters
+
+logger = logging.getLogger(__name__)
+
+Loader = Callable[[str, str], Awaitable[CachedResponse]]
+
+# one sample is a time, in seconds since the epoch, and a value
+Sample = tuple[float, float]
+
+
+def parse_production(report: ProductionReport) -> dict[str, Sample]:
+    samples: dict[str, Sample] = {}
+    for name, reading in [
+        ("production_watts", report.production),
+        ("consumption_watts", report.consumption),
+        ("net_consumption_watts", report.net_consumption),
+    ]:
+        if reading is not None:
+            samples[name] = (reading.timestamp, reading.watts)
+    return samples
+
+
+def parse_meters(meters: tuple[MeterReading, ...]) -> dict[str, Sample]:
+    samples: dict[str, Sample] = {}
+    for meter in meters:
+        for unit, value in [
+            ("watts", meter.watts),
+            ("volts", meter.volts),
+            ("amps", meter.amps),
+            ("hertz", meter.hertz),
+        ]:
+            if value is not None:
+                samples[f"meter_{meter.eid}_{unit}"] = (meter.timestamp, value)
+    return samples
+
+
+# these are the paths on the envoy that samples are taken from, what to read
+# what comes back into, and how to turn that into samples
+PARSERS: dict[str, tuple[Callable[[bytes], Any], Callable[[Any], dict[str, Sample]]]] = {
+    "/production.json": (ProductionReport.from_content, parse_production),
+    "/ivp/meters/readings": (load_meters, parse_meters),
+}
+
+
+def take_samples(entry: CachedResponse, destination: str) -> dict[str, Sample]:
+    loader, parser = PARSERS[destination]
+    return parser(entry.parse(loader))
+
+
+class Series:
+
+    def __init__(self: "Series", capacity: int) -> None:
+        # samples are kept in two fixed size columns that are used as a ring.
+        # all of the memory is taken up front so that it never grows and a
+        # sample costs sixteen bytes no matter how many there are.
+        self.capacity = capacity
+        self.timestamps = array("d", bytes(8 * capacity))
+        self.values = array("d", bytes(8 * capacity))
+
+        # this is where the oldest sample is and how many samples there are
+        self.first = 0
+        self.size = 0
+
+    def __len__(self: "Series") -> int:
+        return self.size
+
+    def _at(self: "Series", index: int) -> int:
+        return (self.first + index) % self.capacity
+
+    def append(self: "Series", timestamp: float, value: float) -> bool:
+        # the same reading may be seen more than once, like when it comes from
+        # a snapshot, so anything that isn't newer than what we have is ignored
+        if self.size and timestamp <= self.timestamps[self._at(self.size - 1)]:
+            return False
+
+        index = self._at(self.size)
+        self.timestamps[index] = timestamp
+        self.values[index] = value
+        if self.size == self.capacity:
+            self.first = (self.first + 1) % self.capacity
+        else:
+            self.size += 1
+        return True
+
+    def _search(self: "Series", timestamp: float) -> int:
+        # the samples are in order so this is a binary search for the first
+        # sample at or after the given time
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamps[self._at(middle)] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def window(self: "Series", start: float, end: float) -> tuple[array, array]:
+        # copy out the samples from "start" up to but not including "end" so
+        # that they are in one piece instead of wrapped around the ring
+        first, last = self._search(start), self._search(end)
+        if first >= last:
+            return array("d"), array("d")
+
+        begin, finish = self._at(first), self._at(last - 1) + 1
+        if begin < finish:
+            return self.timestamps[begin:finish], self.values[begin:finish]
+        return (
+            self.timestamps[begin:] + self.timestamps[:finish],
+            self.values[begin:] + self.values[:finish],
+        )
+
+
+def downsample(timestamps: array, values: array, resolution: float) -> list[tuple[float, float, float, float]]:
+    # put the samples into buckets that are "resolution" seconds wide and
+    # report the minimum, maximum, and mean of each one. the edge of each
+    # bucket is found with a binary search and the work on each bucket is done
+    # on a slice of the column so the cost is per bucket and not per sample.
+    results = []
+    index = 0
+    while index < len(timestamps):
+        bucket = math.floor(timestamps[index] / resolution) * resolution
+        end = bisect.bisect_left(timestamps, bucket + resolution, index)
+        chunk = values[index:end]
+        results.append((bucket, min(chunk), max(chunk), sum(chunk) / len(chunk)))
+        index = end
+    return results
+
+
+class History:
+
+    def __init__(self: "History", app: Optional[Quart] = None, loader: Optional[Loader] = None) -> None:
+        # this is how often, in seconds, a sample is taken and how long, in
+        # seconds, samples are kept. together they decide how big each series
+        # is and so how much memory is used.
+        self.history_interval = 5.0
+        self.history_retention = 7 * 24 * 60 * 60.0
+
+        # this is the most buckets that a query may ask for. a query that asks
+        # for more gets bigger buckets instead.
+        self.history_max_points = 1000
+
+        # if this is set to true then we are trying to exit. use an Event
+        # instead of a flag so that we can wait on it and exit more quickly.
+        self.history_canceled = asyncio.Event()
+
+        # this is every series that we've seen and the system for fetching the
+        # readings that go into them
+        self.series: dict[str, Series] = {}
+        self.loader: Optional[Loader] = None
+
+        self.app: Optional[Quart] = None
+        if app is not None and loader is not None:
+            self.init_app(app, loader)
+
+    def init_app(self: "History", app: Quart, loader: Loader) -> None:
+        self.app = app
+        self.loader = loader
+        self.history_interval = float(app.config.get("HISTORY_INTERVAL", self.history_interval))
+        self.history_retention = float(app.config.get("HISTORY_RETENTION", self.history_retention))
+        self.history_max_points = int(app.config.get("HISTORY_MAX_POINTS", self.history_max_points))
+
+        # nothing to do if we weren't asked to keep anything
+        if not app.config.get("HISTORY_ENABLED", False):
+            return
+
+        @app.before_serving
+        async def startup() -> None:
+            logger.info("registering history background task keeping %d samples per series", self.capacity)
+            app.add_background_task(self._background_looper)
+
+        @app.after_serving
+        async def shutdown() -> None:
+            logger.info("signaling history background task to stop")
+            self.history_canceled.set()
+
+    @property
+    def capacity(self: "History") -> int:
+        return max(1, math.ceil(self.history_retention / self.history_interval))
+
+    async def _background_waiter(
+        self: "History",
+        event: asyncio.Event,
+        timeout: Optional[float] = 0,
+    ) -> bool:
+        # suppress TimeoutError because we'll return False in case of timeout
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(event.wait(), timeout)
+        return event.is_set()
+
+    async def _background_looper(self: "History") -> None:
+        with contextlib.suppress(asyncio.CancelledError):
+            while True:
+                await self._background_task()
+                if await self._background_waiter(self.history_canceled, self.history_interval):
+                    break
+
+        logger.info("history background task shutting down")
+
+    async def _background_task(self: "History") -> None:
+        await asyncio.gather(*[self._sample(path) for path in PARSERS])
+
+    async def _sample(self: "History", destination: str) -> None:
+        try:
+            entry = await self.loader("GET", destination)
+            if entry.status_code != 200:
+                logger.warning("unable to sample %s: status %d", destination, entry.status_code)
+                return
+            samples = take_samples(entry, destination)
+        except Exception as e:
+            logger.warning("unable to sample %s: %s", destination, str(e))
+            return
+
+        for name, (timestamp, value) in samples.items():
+            self.record(name, timestamp, value)
+
+    def record(self: "History", name: str, timestamp: float, value: float) -> None:
+        series = self.series.get(name)
+        if series is None:
+            series = self.series[name] = Series(self.capacity)
+        series.append(timestamp, value)
+
+    def query(
+        self: "History",
+        names: Optional[list[str]] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        resolution: Optional[float] = None,
+    ) -> dict[str, Any]:
+        # by default give back the last hour of everything at the resolution
+        # that it was sampled at
+        end = time.time() if end is None else end
+        start = end - 3600 if start is None else start
+        resolution = max(resolution or self.history_interval, (end - start) / self.history_max_points, 0.001)
+
+        series = {}
+        for name in names or sorted(self.series):
+            if name in self.series:
+                series[name] = downsample(*self.series[name].window(start, end), resolution)
+
+        return {"start": start, "end": end, "resolution": resolution, "series": series}
+
+    @property
+    def stats(self: "History") -> dict[str, int]:
+        return {
+            "series": len(self.series),
+            "samples": sum(len(series) for series in self.series.values()),
+            "capacity": self.capacity,
+        }
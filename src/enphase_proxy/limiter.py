@@ -0,0 +1,168 @@
+import asyncio
+import contextlib
+import fnmatch
+import heapq
+import itertools
+import logging
+import time
+from typing import AsyncIterator, Optional
+
+from quart import Quart
+
+from .ratelimit import CLIENT
+from .tracing import record
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamOverloaded(Exception):
+
+    def __init__(self: "UpstreamOverloaded", message: str, retry_after: int) -> None:
+        super().__init__(message, retry_after)
+        self.message = message
+        self.retry_after = retry_after
+
+    def __str__(self: "UpstreamOverloaded") -> str:
+        return self.message
+
+
+class UpstreamLimiter:
+
+    def __init__(self: "UpstreamLimiter", app: Optional[Quart] = None) -> None:
+        # the envoy can only handle a few requests at once before it starts
+        # timing out. this is how many we will let it have at the same time.
+        # everything else waits in a queue of limited size for a limited time.
+        self.max_in_flight = 4
+        self.max_queued = 64
+        self.queue_timeout = 30.0
+
+        # this is what we tell clients when we won't make them wait any more
+        self.retry_after = 5
+
+        # waiting requests are let through lowest priority number first. the
+        # first pattern that matches the path wins and everything else gets
+        # the default priority. requests with the same priority are first in
+        # first out.
+        self.priorities: list[tuple[str, int]] = []
+        self.default_priority = 1
+
+        # clients with the same priority take turns. each waiter gets a turn
+        # number that is one past the last one its client was given, but never
+        # behind the turn that is being served now, so a client with a lot of
+        # requests waiting can't make everyone else wait behind all of them.
+        # requests from the same client stay first in first out.
+        self.turn = 0
+        self.turns: dict[Optional[str], int] = {}
+
+        # this is the queue itself. cancelled waiters are left in the heap and
+        # skipped when they come up so "queued" is the real depth.
+        self.waiters: list[tuple[int, int, int, asyncio.Future]] = []
+        self.sequence = itertools.count()
+        self.in_flight = 0
+        self.queued = 0
+
+        # these are for monitoring
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+        self.app: Optional[Quart] = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self: "UpstreamLimiter", app: Quart) -> None:
+        self.app = app
+        self.max_in_flight = int(app.config.get("LIMITER_MAX_IN_FLIGHT", self.max_in_flight))
+        self.max_queued = int(app.config.get("LIMITER_MAX_QUEUED", self.max_queued))
+        self.queue_timeout = float(app.config.get("LIMITER_QUEUE_TIMEOUT", self.queue_timeout))
+        self.retry_after = int(app.config.get("LIMITER_RETRY_AFTER", self.retry_after))
+        self.priorities = [
+            (pattern, int(priority)) for pattern, priority in (app.config.get("LIMITER_PRIORITIES") or {}).items()
+        ]
+        self.default_priority = int(app.config.get("LIMITER_DEFAULT_PRIORITY", self.default_priority))
+
+    def priority(self: "UpstreamLimiter", destination: str) -> int:
+        path = destination.partition("?")[0]
+        for pattern, priority in self.priorities:
+            if fnmatch.fnmatchcase(path, pattern):
+                return priority
+        return self.default_priority
+
+    async def acquire(self: "UpstreamLimiter", destination: str) -> None:
+        # go right through if there is room and nobody is already waiting
+        if self.in_flight < self.max_in_flight and not self.queued:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+
+        if self.queued >= self.max_queued:
+            self.rejected += 1
+            raise UpstreamOverloaded("too many requests are waiting on the envoy", self.retry_after)
+
+        client = CLIENT.get()
+        turn = max(self.turns.get(client, 0), self.turn)
+        self.turns[client] = turn + 1
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (self.priority(destination), turn, next(self.sequence), future))
+        self.queued += 1
+
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # we might have been handed a slot right as we gave up on it. if so
+            # then pass it along to the next in line so that it isn't lost.
+            if future.done() and not future.cancelled():
+                self.release()
+
+            if isinstance(e, asyncio.TimeoutError):
+                self.expired += 1
+                raise UpstreamOverloaded("timed out waiting on the envoy", self.retry_after) from e
+            raise
+        finally:
+            self.queued -= 1
+            # nobody's turn matters once nobody is waiting
+            if not self.queued:
+                self.turns.clear()
+            waited = time.monotonic() - started
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+            record("queue", waited)
+
+        # the slot was handed to us by release so in_flight is already counted
+        self.admitted += 1
+
+    def release(self: "UpstreamLimiter") -> None:
+        # hand our slot directly to the next waiter instead of giving it up so
+        # that nobody can jump the queue in between
+        while self.waiters:
+            _, turn, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                self.turn = turn
+                future.set_result(None)
+                return
+
+        self.in_flight -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self: "UpstreamLimiter", destination: str) -> AsyncIterator[None]:
+        await self.acquire(destination)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @property
+    def stats(self: "UpstreamLimiter") -> dict[str, float]:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "expired": self.expired,
+            "wait_seconds_total": round(self.wait_seconds_total, 6),
+            "wait_seconds_max": round(self.wait_seconds_max, 6),
+        }
@@ -0,0 +1,283 @@
+import bisect
+import contextlib
+import functools
+import math
+import time
+from typing import Callable, Iterator, Optional, Union
+
+from .tracing import record
+
+# these are in seconds and cover everything from a cached connection on the
+# local network to an envoy that is about to time out
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values, strict=True)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self: "_CounterChild") -> None:
+        self.value = 0.0
+
+    def inc(self: "_CounterChild", amount: float = 1) -> None:
+        self.value += amount
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self: "_HistogramChild", buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        # one count for each bucket plus one for everything larger. these are
+        # not cumulative. they are only added up when they are rendered.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self: "_HistogramChild", value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self: "Metric", name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+    def render(self: "Metric") -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+
+
+class _LabeledMetric(Metric):
+    # a metric that keeps a child for each set of labels. each kind of metric
+    # says how to make its children.
+
+    def __init__(
+        self: "_LabeledMetric",
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...],
+        child: Callable[[], object],
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.child = child
+        self.children: dict[tuple[str, ...], object] = {}
+
+    def labels(self: "_LabeledMetric", *values: str) -> object:
+        # children are created once and then reused. hot paths should hold on
+        # to the child so that they don't even pay for the lookup.
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self.children[values] = self.child()
+        return child
+
+
+class Counter(_LabeledMetric):
+    kind = "counter"
+
+    def __init__(self: "Counter", name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames, _CounterChild)
+
+    def labels(self: "Counter", *values: str) -> _CounterChild:
+        return super().labels(*values)  # type: ignore[return-value]
+
+    def inc(self: "Counter", amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def render(self: "Counter") -> Iterator[str]:
+        yield from super().render()
+        for values, child in self.children.items():
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+
+class Histogram(_LabeledMetric):
+    kind = "histogram"
+
+    def __init__(
+        self: "Histogram",
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, functools.partial(_HistogramChild, self.buckets))
+
+    def labels(self: "Histogram", *values: str) -> _HistogramChild:
+        return super().labels(*values)  # type: ignore[return-value]
+
+    def observe(self: "Histogram", value: float) -> None:
+        self.labels().observe(value)
+
+    def render(self: "Histogram") -> Iterator[str]:
+        yield from super().render()
+        for values, child in self.children.items():
+            total = 0
+            for bound, count in zip((*self.buckets, math.inf), child.counts, strict=True):
+                total += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {total}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, values)} {_format_value(child.sum)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, values)} {total}"
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(
+        self: "Gauge",
+        name: str,
+        documentation: str,
+        function: Callable[[], Union[Optional[float], dict[tuple[str, ...], float]]],
+        labelnames: tuple[str, ...] = (),
+    ) -> None:
+        # gauges are read when they are rendered so that nothing is spent on
+        # keeping them up to date. the function may return one value, a value
+        # for each set of labels, or None if there is nothing to report.
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def render(self: "Gauge") -> Iterator[str]:
+        value = self.function()
+        if value is None:
+            return
+
+        yield from super().render()
+        values = value if isinstance(value, dict) else {(): value}
+        for labels, sample in values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(sample)}"
+
+
+class Registry:
+
+    def __init__(self: "Registry") -> None:
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self: "Registry", metric: Metric) -> Metric:
+        # registering a metric with the same name replaces the old one. this
+        # lets the application be loaded more than once in the same process.
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self: "Registry") -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(
+    Counter("enphase_proxy_requests_total", "Requests answered by the proxy.", ("path", "status"))
+)
+UPSTREAM_PHASES = REGISTRY.register(
+    Histogram(
+        "enphase_proxy_upstream_phase_seconds",
+        "Time spent in each phase of a request to the envoy.",
+        ("phase",),
+    )
+)
+UPSTREAM_BYTES = REGISTRY.register(
+    Counter("enphase_proxy_upstream_bytes_total", "Bytes received from the envoy and passed along.")
+)
+CREDENTIALS_REFRESHES = REGISTRY.register(
+    Counter("enphase_proxy_credentials_refreshes_total", "Background credentials refreshes.", ("result",))
+)
+CREDENTIALS_REFRESH_SECONDS = REGISTRY.register(
+    Histogram("enphase_proxy_credentials_refresh_seconds", "Time spent on background credentials refreshes.")
+)
+CREDENTIALS_FETCHES = REGISTRY.register(
+    Counter("enphase_proxy_credentials_fetches_total", "Logins to enphase to fetch a new token.", ("result",))
+)
+CREDENTIALS_FETCH_SECONDS = REGISTRY.register(
+    Histogram("enphase_proxy_credentials_fetch_seconds", "Time spent logging in to enphase to fetch a new token.")
+)
+
+# the hot path holds on to these directly so that it never looks anything up
+UPSTREAM_CONNECT = UPSTREAM_PHASES.labels("connect")
+UPSTREAM_TLS = UPSTREAM_PHASES.labels("tls")
+UPSTREAM_TTFB = UPSTREAM_PHASES.labels("ttfb")
+UPSTREAM_BODY = UPSTREAM_PHASES.labels("body")
+UPSTREAM_TOTAL = UPSTREAM_PHASES.labels("total")
+UPSTREAM_BYTES_TOTAL = UPSTREAM_BYTES.labels()
+
+
+@contextlib.contextmanager
+def timed(counter: Counter, histogram: Histogram) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        counter.labels("failure").inc()
+        raise
+    else:
+        counter.labels("success").inc()
+    finally:
+        histogram.observe(time.perf_counter() - started)
+
+
+class UpstreamTracer:
+    # one of these is made for each request to the envoy and given to httpx as
+    # the "trace" extension. httpx calls it at the start and end of each phase
+    # of the request and the phases are recorded as they complete.
+    __slots__ = ("connect", "tls", "request", "body")
+
+    def __init__(self: "UpstreamTracer") -> None:
+        self.connect = 0.0
+        self.tls = 0.0
+        self.request = 0.0
+        self.body = 0.0
+
+    async def __call__(self: "UpstreamTracer", event: str, info: dict) -> None:
+        now = time.perf_counter()
+
+        # events look like "connection.connect_tcp.started" or like
+        # "http11.receive_response_headers.complete"
+        _, _, event = event.partition(".")
+        # and each phase is also added to the timing of the client request
+        # that is waiting on it, if there is one
+        if event == "connect_tcp.started":
+            self.connect = now
+        elif event == "connect_tcp.complete":
+            UPSTREAM_CONNECT.observe(now - self.connect)
+            record("connect", now - self.connect)
+        elif event == "start_tls.started":
+            self.tls = now
+        elif event == "start_tls.complete":
+            UPSTREAM_TLS.observe(now - self.tls)
+            record("tls", now - self.tls)
+        elif event == "send_request_headers.started":
+            self.request = now
+        elif event == "receive_response_headers.complete":
+            UPSTREAM_TTFB.observe(now - self.request)
+            record("envoy", now - self.request)
+        elif event == "receive_response_body.started":
+            self.body = now
+        elif event == "receive_response_body.complete":
+            UPSTREAM_BODY.observe(now - self.body)
+            UPSTREAM_TOTAL.observe(now - self.request)
+            record("body", now - self.body)
@@ -0,0 +1,94 @@
+import json
+import time
+from typing import Any, Optional
+
+
+def _number(value: Any) -> Optional[float]:
+    return None if value is None else float(value)
+
+
+class ProductionReading:
+    # one line from the production or consumption section of production.json
+    __slots__ = ("timestamp", "watts", "today_wh", "lifetime_wh")
+
+    def __init__(self: "ProductionReading", reading: dict[str, Any]) -> None:
+        self.timestamp = float(reading.get("readingTime") or time.time())
+        self.watts = float(reading["wNow"])
+        self.today_wh = _number(reading.get("whToday"))
+        self.lifetime_wh = _number(reading.get("whLifetime"))
+
+
+class ProductionReport:
+    # everything that we use from production.json. the envoy sends a lot more
+    # than this and it is only read once no matter how many times it is used.
+    __slots__ = ("production", "consumption", "net_consumption", "battery_percent", "battery_watts")
+
+    def __init__(self: "ProductionReport", payload: dict[str, Any]) -> None:
+        readings: dict[tuple[str, str], ProductionReading] = {}
+        for section in ("production", "consumption"):
+            for reading in payload.get(section) or []:
+                if reading.get("wNow") is not None:
+                    readings[(section, reading.get("measurementType") or reading.get("type"))] = ProductionReading(
+                        reading
+                    )
+
+        # the production meter is preferred over the inverters because it is
+        # measured more often and more accurately. the net meter is negative
+        # when power is being sent to the grid.
+        self.production = readings.get(("production", "production")) or readings.get(("production", "inverters"))
+        self.consumption = readings.get(("consumption", "total-consumption"))
+        self.net_consumption = readings.get(("consumption", "net-consumption"))
+
+        # only some batteries say how full they are
+        self.battery_percent: Optional[float] = None
+        self.battery_watts: Optional[float] = None
+        for storage in payload.get("storage") or []:
+            if storage.get("percentFull") is not None and self.battery_percent is None:
+                self.battery_percent = float(storage["percentFull"])
+            if storage.get("activeCount") and storage.get("wNow") is not None:
+                self.battery_watts = (self.battery_watts or 0.0) + float(storage["wNow"])
+
+    @classmethod
+    def from_content(cls: type["ProductionReport"], content: bytes) -> "ProductionReport":
+        payload = json.loads(content)
+        if not isinstance(payload, dict):
+            raise ValueError("production is not an object")
+        return cls(payload)
+
+    @property
+    def summary(self: "ProductionReport") -> dict[str, Optional[float]]:
+        def watts(reading: Optional[ProductionReading]) -> Optional[float]:
+            return None if reading is None else reading.watts
+
+        today_wh = None if self.production is None else self.production.today_wh
+        return {
+            "reading_time": max(
+                (reading.timestamp for reading in (self.production, self.consumption, self.net_consumption) if reading),
+                default=None,
+            ),
+            "production_watts": watts(self.production),
+            "consumption_watts": watts(self.consumption),
+            "net_consumption_watts": watts(self.net_consumption),
+            "production_today_kwh": None if today_wh is None else today_wh / 1000,
+            "battery_percent": self.battery_percent,
+            "battery_watts": self.battery_watts,
+        }
+
+
+class MeterReading:
+    # one meter from /ivp/meters/readings. there is no way to know which meter
+    # is which without asking the envoy for something else so they only have
+    # their ids.
+    __slots__ = ("eid", "timestamp", "watts", "volts", "amps", "hertz")
+
+    def __init__(self: "MeterReading", meter: dict[str, Any]) -> None:
+        self.eid = meter["eid"]
+        self.timestamp = float(meter.get("timestamp") or time.time())
+        self.watts = _number(meter.get("activePower"))
+        self.volts = _number(meter.get("voltage"))
+        self.amps = _number(meter.get("current"))
+        self.hertz = _number(meter.get("freq"))
+
+
+def load_meters(content: bytes) -> tuple[MeterReading, ...]:
+    return tuple(MeterReading(meter) for meter in json.loads(content) or [])
@@ -0,0 +1,131 @@
+import asyncio
+import contextlib
+import logging
+from typing import Awaitable, Callable, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from quart import Quart
+
+from .cache import CachedResponse
+from .shared import SharedCache
+
+logger = logging.getLogger(__name__)
+
+Loader = Callable[[str, str], Awaitable[CachedResponse]]
+
+
+def normalize(destination: str) -> str:
+    # put the query arguments into the same order that the proxy route does
+    # so that a configured path matches no matter how it was written
+    parts = urlsplit(destination)
+    if not parts.query:
+        return parts.path
+    return f"{parts.path}?{urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))}"
+
+
+class SnapshotPoller:
+
+    def __init__(
+        self: "SnapshotPoller",
+        app: Optional[Quart] = None,
+        loader: Optional[Loader] = None,
+        shared: Optional[SharedCache] = None,
+        name: str = "default",
+    ) -> None:
+        # these are the paths on the envoy that we will fetch on our own
+        # schedule and how often, in seconds, we will fetch them.
+        self.poller_paths: list[str] = []
+        self.poller_refresh = 5.0
+
+        # if this is set to true then we are trying to exit. use an Event
+        # instead of a flag so that we can wait on it and exit more quickly.
+        self.poller_canceled = asyncio.Event()
+
+        # this is the most recent successful response for each path and the
+        # system for fetching new ones. a snapshot is only ever replaced by a
+        # newer successful response so it is served even when it is stale.
+        self.snapshots: dict[str, CachedResponse] = {}
+        self.loader: Optional[Loader] = None
+
+        # when this is set the snapshots are shared with every other worker
+        # process. only the process that leads fetches them and everyone else
+        # reads what it fetched. they are shared under the name of the gateway.
+        self.shared = shared
+        self.name = name
+
+        self.app: Optional[Quart] = None
+        if app is not None and loader is not None:
+            self.init_app(app, loader)
+
+    def init_app(self: "SnapshotPoller", app: Quart, loader: Loader) -> None:
+        self.app = app
+        self.loader = loader
+        self.poller_paths = [normalize(path) for path in app.config.get("POLLER_PATHS") or []]
+        self.poller_refresh = float(app.config.get("POLLER_INTERVAL", self.poller_refresh))
+
+        # nothing to do if we weren't asked to poll anything
+        if not self.poller_paths:
+            return
+
+        @app.before_serving
+        async def startup() -> None:
+            logger.info("registering snapshot poller background task for %d paths", len(self.poller_paths))
+            app.add_background_task(self._background_looper)
+
+        @app.after_serving
+        async def shutdown() -> None:
+            logger.info("signaling snapshot poller background task to stop")
+            self.poller_canceled.set()
+
+    async def _background_waiter(
+        self: "SnapshotPoller",
+        event: asyncio.Event,
+        timeout: Optional[float] = 0,
+    ) -> bool:
+        # suppress TimeoutError because we'll return False in case of timeout
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(event.wait(), timeout)
+        return event.is_set()
+
+    async def _background_looper(self: "SnapshotPoller") -> None:
+        with contextlib.suppress(asyncio.CancelledError):
+            # unlike the credentials updater we want our first snapshots right
+            # away so fetch first and then wait.
+            while True:
+                await self._background_task()
+                if await self._background_waiter(self.poller_canceled, self.poller_refresh):
+                    break
+
+        logger.info("snapshot poller background task shutting down")
+
+    async def _background_task(self: "SnapshotPoller") -> None:
+        # some other process is fetching these for us
+        if self.shared is not None and not self.shared.elect():
+            return
+
+        # fetch everything at once. a path that fails keeps its old snapshot
+        # and will be tried again on the next round.
+        await asyncio.gather(*[self._refresh(path) for path in self.poller_paths])
+
+    async def _refresh(self: "SnapshotPoller", destination: str) -> None:
+        try:
+            entry = await self.loader("GET", destination)
+        except Exception as e:
+            logger.warning("unable to refresh snapshot for %s: %s", destination, str(e))
+            return
+
+        if entry.status_code != 200:
+            logger.warning("unable to refresh snapshot for %s: status %d", destination, entry.status_code)
+            return
+
+        entry.inherit(self.get(destination))
+        if self.shared is not None:
+            self.shared.publish(f"{self.name}:{destination}", entry)
+        self.snapshots[destination] = entry
+
+    def get(self: "SnapshotPoller", destination: str) -> Optional[CachedResponse]:
+        if self.shared is not None:
+            entry = self.shared.get(f"{self.name}:{destination}")
+            if entry is not None:
+                return entry
+        return self.snapshots.get(destination)
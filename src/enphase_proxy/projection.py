@@ -0,0 +1,114 @@
+import functools
+import importlib
+import json
+import re
+from typing import Any, Callable, Optional, Union
+
+# a field is a name followed by any number of names after a dot or indexes in
+# brackets, like "production[0].wNow" or "consumption[*].wNow". "*" takes every
+# item in a list. a field that starts with an index, like "[0].eid", is for a
+# response that is a list.
+STEP = re.compile(r"(?:^|\.)([^.\[\],]+)|\[(\*|-?\d+)\]")
+
+# a projection that asks for more than this is refused
+MAX_FIELDS = 32
+MAX_LENGTH = 1024
+
+# this stands for "*" in a compiled field
+EVERY = None
+
+Step = Union[str, int, None]
+
+
+class InvalidProjection(ValueError):
+    pass
+
+
+def _codec() -> tuple[Callable[[bytes], Any], Callable[[Any], bytes]]:
+    # orjson is a lot faster at reading the large responses that the envoy
+    # sends. it is used if it is installed and otherwise the standard library.
+    try:
+        orjson = importlib.import_module("orjson")
+        return orjson.loads, orjson.dumps
+    except ImportError:
+        return json.loads, lambda value: json.dumps(value, separators=(",", ":")).encode()
+
+
+loads, dumps = _codec()
+
+
+def _compile(field: str) -> tuple[Step, ...]:
+    steps: list[Step] = []
+    position = 0
+    while position < len(field):
+        match = STEP.match(field, position)
+        if match is None:
+            raise InvalidProjection(f"unable to understand field '{field}'")
+        name, index = match.groups()
+        if name is not None:
+            steps.append(name)
+        else:
+            steps.append(EVERY if index == "*" else int(index))
+        position = match.end()
+    return tuple(steps)
+
+
+def _select(value: Any, steps: tuple[Step, ...]) -> Any:
+    # anything that isn't there is null instead of an error because the envoy
+    # leaves out sections that it has nothing for
+    for position, step in enumerate(steps):
+        if step is EVERY:
+            if not isinstance(value, list):
+                return None
+            return [_select(item, steps[position + 1 :]) for item in value]
+        if isinstance(step, int):
+            if not isinstance(value, list) or not -len(value) <= step < len(value):
+                return None
+            value = value[step]
+        else:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(step)
+    return value
+
+
+class Projection:
+    # a compiled list of fields. calling it with a json response gives back a
+    # json object that maps each field, as it was asked for, to its value.
+    # projections of the same fields are equal so what one makes from a
+    # response can be kept with that response and used by the others.
+    __slots__ = ("source", "fields")
+
+    def __init__(self: "Projection", fields: str) -> None:
+        names = [name.strip() for name in fields.split(",") if name.strip()]
+        if not names:
+            raise InvalidProjection("expected at least one field")
+        if len(names) > MAX_FIELDS:
+            raise InvalidProjection(f"expected at most {MAX_FIELDS} fields")
+        self.source = fields
+        self.fields = {name: _compile(name) for name in names}
+
+    def __eq__(self: "Projection", other: object) -> bool:
+        return isinstance(other, Projection) and other.source == self.source
+
+    def __hash__(self: "Projection") -> int:
+        return hash(self.source)
+
+    def __call__(self: "Projection", content: bytes) -> bytes:
+        document = loads(content)
+        return dumps({name: _select(document, steps) for name, steps in self.fields.items()})
+
+
+@functools.lru_cache(maxsize=256)
+def _projection(fields: str) -> Projection:
+    return Projection(fields)
+
+
+def projection_for(fields: Optional[str]) -> Optional[Projection]:
+    # the same fields always give back the same projection so that responses
+    # only have to be projected once for each set of fields
+    if fields is None:
+        return None
+    if len(fields) > MAX_LENGTH:
+        raise InvalidProjection(f"expected at most {MAX_LENGTH} characters of fields")
+    return _projection(fields)
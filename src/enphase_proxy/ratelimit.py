@@ -0,0 +1,193 @@
+import collections
+import contextvars
+import fnmatch
+import logging
+import math
+import time
+from typing import Any, Optional
+
+from quart import Quart, request
+
+logger = logging.getLogger(__name__)
+
+# this is who sent the request that is running right now. it is copied into
+# any task that the request starts, like fetches, so that the queue in front
+# of the envoy can take turns between clients.
+CLIENT: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("client", default=None)
+
+# these are never limited. whatever is watching the proxy must always be able
+# to tell whether it is alive and ready no matter how busy a client is.
+EXEMPT_PATHS = frozenset(["/_/health", "/_/live", "/_/ready", "/_/metrics"])
+
+# these ask for envoy paths on behalf of the client. each of those is charged
+# instead of the request as a whole.
+ITEMIZED_PREFIXES = ("/_/batch", "/_/aggregate/")
+
+
+class RateLimited(Exception):
+
+    def __init__(self: "RateLimited", message: str, retry_after: int) -> None:
+        super().__init__(message, retry_after)
+        self.message = message
+        self.retry_after = retry_after
+
+    def __str__(self: "RateLimited") -> str:
+        return self.message
+
+
+class RateLimit:
+    # one configured limit. it applies to a request when its pattern matches
+    # the path and its clients include the client. each client gets its own
+    # bucket for each limit.
+    __slots__ = ("pattern", "rate", "burst", "clients", "interval", "tolerance", "buckets")
+
+    def __init__(self: "RateLimit", rule: dict[str, Any]) -> None:
+        self.pattern = str(rule.get("path") or "*")
+        self.rate = float(rule["rate"])
+        self.burst = max(int(rule.get("burst") or math.ceil(self.rate)), 1)
+        self.clients = frozenset(str(client) for client in rule["clients"]) if rule.get("clients") else None
+        if self.rate <= 0:
+            raise ValueError(f"rate limit for {self.pattern} must be greater than zero")
+
+        # this is a token bucket that is kept as one number per client: the
+        # time at which its bucket will be full again. a request takes one
+        # token by pushing that time one interval later and is turned away if
+        # that would put it more than a full bucket ahead of now. clients are
+        # kept in the order that they were last seen so that the ones that
+        # went away are at the front.
+        self.interval = 1 / self.rate
+        self.tolerance = self.interval * self.burst
+        self.buckets: collections.OrderedDict[str, float] = collections.OrderedDict()
+
+    def matches(self: "RateLimit", path: str, client: str) -> bool:
+        return (self.clients is None or client in self.clients) and fnmatch.fnmatchcase(path, self.pattern)
+
+    def wait(self: "RateLimit", client: str, now: float) -> float:
+        # how many seconds the client has to wait, or zero if it may go now
+        full_at = max(self.buckets.get(client, now), now) + self.interval
+        return max(full_at - now - self.tolerance, 0.0)
+
+    def take(self: "RateLimit", client: str, now: float) -> float:
+        # the same as wait but a client that may go uses up a token
+        wait = self.wait(client, now)
+        if wait:
+            return wait
+
+        full_at = max(self.buckets.get(client, now), now) + self.interval
+
+        self.buckets[client] = full_at
+        self.buckets.move_to_end(client)
+        return 0.0
+
+    def evict(self: "RateLimit", now: float, limit: int) -> int:
+        # a client whose bucket is full again is the same as one that we have
+        # never seen so forgetting it changes nothing. past the limit the
+        # clients that were seen longest ago are forgotten anyway.
+        evicted = 0
+        while self.buckets:
+            client, full_at = next(iter(self.buckets.items()))
+            if full_at > now and len(self.buckets) <= limit:
+                break
+            del self.buckets[client]
+            evicted += 1
+        return evicted
+
+
+class RateLimiter:
+
+    def __init__(self: "RateLimiter", app: Optional[Quart] = None) -> None:
+        # this is how a client is told apart from the others. each source is
+        # tried in order and the first one that has a value is used:
+        #   "ip" is the address that the request came from
+        #   "forwarded" is the first address in the X-Forwarded-For header
+        #   "header:<name>" is the value of that header, like an api key
+        self.client_sources = ["ip"]
+
+        # these are the limits in the order that they are checked. every one
+        # that matches a request applies, except that of the limits with the
+        # same path only the first one that matches does. that way some
+        # clients can be given their own limit for a path. requests that don't
+        # match any of them aren't limited.
+        self.limits: list[RateLimit] = []
+
+        # this is the most clients that we keep a bucket for in each limit
+        self.max_clients = 10000
+
+        # these are for monitoring
+        self.allowed = 0
+        self.limited = 0
+        self.evicted = 0
+
+        self.app: Optional[Quart] = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self: "RateLimiter", app: Quart) -> None:
+        self.app = app
+        self.client_sources = list(app.config.get("RATE_LIMIT_CLIENT") or self.client_sources)
+        self.limits = [RateLimit(rule) for rule in app.config.get("RATE_LIMITS") or []]
+        self.max_clients = int(app.config.get("RATE_LIMIT_MAX_CLIENTS", self.max_clients))
+
+        @app.before_request
+        async def limit_client() -> None:
+            client = self.identify()
+            CLIENT.set(client)
+            if self.limits and request.path not in EXEMPT_PATHS and not request.path.startswith(ITEMIZED_PREFIXES):
+                self.check(request.path, client)
+
+    def identify(self: "RateLimiter") -> str:
+        for source in self.client_sources:
+            if source == "ip":
+                value = request.remote_addr
+            elif source == "forwarded":
+                value = request.headers.get("X-Forwarded-For", "").partition(",")[0].strip()
+            elif source.startswith("header:"):
+                value = request.headers.get(source[7:])
+            else:
+                value = None
+            if value:
+                return value
+        return "unknown"
+
+    def charge(self: "RateLimiter", path: str) -> None:
+        # this is for a request that asks for envoy paths on behalf of the
+        # client, like a batch. each one counts as if it had been asked for
+        # by itself.
+        if self.limits:
+            self.check(path, CLIENT.get() or "unknown")
+
+    def check(self: "RateLimiter", path: str, client: str, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        limits: dict[str, RateLimit] = {}
+        for limit in self.limits:
+            if limit.pattern not in limits and limit.matches(path, client):
+                limits[limit.pattern] = limit
+        if not limits:
+            return
+
+        # the request only goes if every limit has room for it. otherwise it
+        # doesn't use up anything so that it can't be held back by one limit
+        # and still count against the others.
+        wait, limit = max(((limit.wait(client, now), limit) for limit in limits.values()), key=lambda pair: pair[0])
+        if not wait:
+            for limit in limits.values():
+                limit.take(client, now)
+
+                # forgetting idle clients as we go keeps this from growing
+                # forever without ever having to look at all of them at once
+                self.evicted += limit.evict(now, self.max_clients)
+            self.allowed += 1
+            return
+
+        self.limited += 1
+        logger.debug("rate limiting a client for %s", path)
+        raise RateLimited(f"too many requests for {limit.pattern}", max(math.ceil(wait), 1))
+
+    @property
+    def stats(self: "RateLimiter") -> dict[str, int]:
+        return {
+            "clients": sum(len(limit.buckets) for limit in self.limits),
+            "allowed": self.allowed,
+            "limited": self.limited,
+            "evicted": self.evicted,
+        }
@@ -0,0 +1,257 @@
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from typing import Optional
+
+from quart import Quart
+
+from .cache import CachedResponse
+
+logger = logging.getLogger(__name__)
+
+# every slot starts with this. the sequence is odd while the slot is being
+# written and goes up every time that it is. then comes when the response was
+# fetched, in seconds since the epoch, its status, and how long its key, its
+# headers, and its body are. they follow one after another. a status of zero
+# means that the slot no longer has a response for its key.
+HEADER = struct.Struct("<QdIIII")
+
+# this is how many times a reader tries again when it catches a slot while it
+# is being written before it gives up and asks the envoy itself
+READ_ATTEMPTS = 3
+
+
+class SharedCache:
+
+    def __init__(self: "SharedCache", app: Optional[Quart] = None) -> None:
+        # this is the file that responses are shared through. it should be on a
+        # file system that is backed by memory, like /dev/shm. every worker
+        # process maps the same file so they all see the same responses.
+        # nothing is shared if this isn't set.
+        self.shared_path: Optional[str] = None
+
+        # the file is cut into this many slots of this many bytes. each slot
+        # holds the latest response for one path. a response that doesn't fit
+        # in a slot isn't shared.
+        self.shared_slots = 64
+        self.shared_slot_size = 256 * 1024
+
+        # the memory that every process shares and the lock file. whichever
+        # process holds the lock is the leader and is the only one that writes.
+        self.memory: Optional[mmap.mmap] = None
+        self.lock: Optional[int] = None
+        self.leading = False
+
+        # this is the last response that we read from each slot and what its
+        # sequence was. as long as the slot doesn't change we hand back the
+        # same response and everything that was done with it, like compressing
+        # it, is done once per process and not once per request.
+        self.views: dict[str, tuple[int, CachedResponse]] = {}
+
+        # these are for monitoring
+        self.published = 0
+        self.oversized = 0
+        self.retries = 0
+
+        self.app: Optional[Quart] = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self: "SharedCache", app: Quart) -> None:
+        self.app = app
+        self.shared_path = app.config.get("SHARED_CACHE_PATH") or None
+        self.shared_slots = int(app.config.get("SHARED_CACHE_SLOTS", self.shared_slots))
+        self.shared_slot_size = int(app.config.get("SHARED_CACHE_SLOT_SIZE", self.shared_slot_size))
+
+        # nothing to do if we weren't asked to share anything
+        if not self.enabled:
+            return
+
+        # the file is opened by each worker process once it is running and not
+        # when the application is loaded
+        @app.before_serving
+        async def startup() -> None:
+            logger.info("opening shared cache at %s with %d slots", self.shared_path, self.shared_slots)
+            self.attach()
+
+        @app.after_serving
+        async def shutdown() -> None:
+            self.detach()
+
+    @property
+    def enabled(self: "SharedCache") -> bool:
+        return self.shared_path is not None
+
+    def attach(self: "SharedCache") -> None:
+        size = self.shared_slots * self.shared_slot_size
+        descriptor = os.open(self.shared_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # every process does this but they all make it the same size
+            if os.fstat(descriptor).st_size < size:
+                os.ftruncate(descriptor, size)
+            self.memory = mmap.mmap(descriptor, size)
+        finally:
+            os.close(descriptor)
+
+        self.lock = os.open(f"{self.shared_path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+
+    def detach(self: "SharedCache") -> None:
+        # closing the lock file gives up the lead if we had it
+        if self.lock is not None:
+            os.close(self.lock)
+            self.lock = None
+        if self.memory is not None:
+            self.memory.close()
+            self.memory = None
+        self.leading = False
+        self.views.clear()
+
+    def elect(self: "SharedCache") -> bool:
+        # try to become the leader. the lock is let go by the operating system
+        # when the leader goes away, even if it crashed, so everyone else keeps
+        # trying and one of them takes over on its next try.
+        if self.leading:
+            return True
+        if self.lock is None:
+            return False
+
+        try:
+            fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+
+        logger.info("process %d is now the leader for the shared cache at %s", os.getpid(), self.shared_path)
+        self.leading = True
+        return True
+
+    def _find(self: "SharedCache", key: bytes, writing: bool = False) -> Optional[int]:
+        # a key always goes in the first slot after its hash that is free or
+        # already has it. slots are never emptied so a reader can stop looking
+        # as soon as it finds a free one.
+        first = zlib.crc32(key) % self.shared_slots
+        for probe in range(self.shared_slots):
+            offset = ((first + probe) % self.shared_slots) * self.shared_slot_size
+            length = HEADER.unpack_from(self.memory, offset)[3]
+            if length == 0:
+                return offset if writing else None
+            start = offset + HEADER.size
+            if length == len(key) and self.memory[start : start + length] == key:
+                return offset
+        return None
+
+    def publish(self: "SharedCache", key: str, entry: CachedResponse) -> bool:
+        # only the leader may call this
+        if self.memory is None:
+            return False
+
+        encoded_key = key.encode()
+        headers = json.dumps(entry.headers).encode()
+        if HEADER.size + len(encoded_key) + len(headers) + len(entry.content) > self.shared_slot_size:
+            self.oversized += 1
+            logger.warning("response for %s is too big to share", key)
+            # the response that we shared before is out of date now and
+            # everyone has to go back to their own
+            self._invalidate(key, encoded_key)
+            return False
+
+        offset = self._find(encoded_key, writing=True)
+        if offset is None:
+            logger.warning("no room to share the response for %s", key)
+            return False
+
+        # readers that see an odd sequence or a sequence that changed while
+        # they were reading know to try again
+        sequence = HEADER.unpack_from(self.memory, offset)[0] | 1
+        struct.pack_into("<Q", self.memory, offset, sequence)
+
+        start = offset + HEADER.size
+        for part in (encoded_key, headers, entry.content):
+            self.memory[start : start + len(part)] = part
+            start += len(part)
+
+        fetched_at = time.time() - entry.age
+        HEADER.pack_into(
+            self.memory,
+            offset,
+            sequence + 1,
+            fetched_at,
+            entry.status_code,
+            len(encoded_key),
+            len(headers),
+            len(entry.content),
+        )
+
+        # the leader already has this response so it never reads it back
+        self.views[key] = (sequence + 1, entry)
+        self.published += 1
+        return True
+
+    def _invalidate(self: "SharedCache", key: str, encoded_key: bytes) -> None:
+        # the slot keeps its key, since slots are never emptied, but loses its
+        # response
+        offset = self._find(encoded_key)
+        if offset is None:
+            return
+
+        sequence = HEADER.unpack_from(self.memory, offset)[0] | 1
+        HEADER.pack_into(self.memory, offset, sequence + 1, 0.0, 0, len(encoded_key), 0, 0)
+        self.views.pop(key, None)
+
+    def get(self: "SharedCache", key: str) -> Optional[CachedResponse]:
+        if self.memory is None:
+            return None
+
+        encoded_key = key.encode()
+        for _ in range(READ_ATTEMPTS):
+            offset = self._find(encoded_key)
+            if offset is None:
+                return None
+
+            sequence, fetched_at, status_code, key_length, headers_length, content_length = HEADER.unpack_from(
+                self.memory, offset
+            )
+            if sequence & 1:
+                self.retries += 1
+                continue
+            if status_code == 0:
+                self.views.pop(key, None)
+                return None
+
+            # nothing changed since the last time that we looked
+            view = self.views.get(key)
+            if view is not None and view[0] == sequence:
+                return view[1]
+
+            start = offset + HEADER.size + key_length
+            headers = self.memory[start : start + headers_length]
+            content = self.memory[start + headers_length : start + headers_length + content_length]
+            if HEADER.unpack_from(self.memory, offset)[0] != sequence:
+                self.retries += 1
+                continue
+
+            entry = CachedResponse(
+                status_code=status_code,
+                headers=json.loads(headers),
+                content=content,
+                fetched_at=time.monotonic() - max(time.time() - fetched_at, 0.0),
+            )
+            entry.inherit(view[1] if view is not None else None)
+            self.views[key] = (sequence, entry)
+            return entry
+
+        return None
+
+    @property
+    def stats(self: "SharedCache") -> dict[str, object]:
+        return {
+            "enabled": self.enabled,
+            "leader": self.leading,
+            "published": self.published,
+            "oversized": self.oversized,
+            "retries": self.retries,
+        }
@@ -0,0 +1,107 @@
+import asyncio
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime
+from typing import AsyncIterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class FetchedCredentials:
+    expires_at: datetime
+    fetched_at: datetime
+    token: str
+
+
+class TokenStore:
+    # this is where credentials are kept so that they can be shared with every
+    # worker and survive a restart. the base class keeps nothing and every
+    # lock is granted immediately.
+
+    async def load(self: "TokenStore") -> Optional[FetchedCredentials]:
+        return None
+
+    async def save(self: "TokenStore", credentials: FetchedCredentials) -> None:
+        return None
+
+    @contextlib.asynccontextmanager
+    async def lock(self: "TokenStore") -> AsyncIterator[None]:
+        yield
+
+
+class FileTokenStore(TokenStore):
+
+    def __init__(self: "FileTokenStore", path: str) -> None:
+        self.path = path
+
+        # the lock is kept on its own file because the credentials file itself
+        # is replaced every time that it is saved
+        self.lock_path = f"{path}.lock"
+
+    async def load(self: "FileTokenStore") -> Optional[FetchedCredentials]:
+        return await asyncio.to_thread(self._load)
+
+    def _load(self: "FileTokenStore") -> Optional[FetchedCredentials]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+
+            return FetchedCredentials(
+                fetched_at=datetime.fromtimestamp(float(data["fetched_at"])),
+                expires_at=datetime.fromtimestamp(float(data["expires_at"])),
+                token=str(data["token"]),
+            )
+        except FileNotFoundError:
+            return None
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning("ignoring unreadable credentials in %s: %s", self.path, str(e))
+            return None
+
+    async def save(self: "FileTokenStore", credentials: FetchedCredentials) -> None:
+        await asyncio.to_thread(self._save, credentials)
+
+    def _save(self: "FileTokenStore", credentials: FetchedCredentials) -> None:
+        data = {
+            "fetched_at": credentials.fetched_at.timestamp(),
+            "expires_at": credentials.expires_at.timestamp(),
+            "token": credentials.token,
+        }
+
+        # write everything to a temporary file next to the real one and then
+        # move it into place so that nobody ever reads half of a file. the
+        # temporary file is only readable by us because it holds a secret.
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temporary_path = tempfile.mkstemp(dir=directory, prefix=".credentials.")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary_path, self.path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(temporary_path)
+            raise
+
+        logger.info("saved credentials to %s", self.path)
+
+    @contextlib.asynccontextmanager
+    async def lock(self: "FileTokenStore") -> AsyncIterator[None]:
+        # this is shared by every process on the host so that only one of them
+        # logs in to enphase at a time. waiting on the lock blocks so it is
+        # done in a thread to keep the event loop running.
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            await asyncio.to_thread(fcntl.flock, fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
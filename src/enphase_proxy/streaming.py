@@ -0,0 +1,170 @@
+import asyncio
+import contextlib
+import logging
+import random
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+import httpx
+from quart import Quart
+
+logger = logging.getLogger(__name__)
+
+Opener = Callable[[str], Awaitable[httpx.Response]]
+
+
+class Subscription:
+
+    def __init__(self: "Subscription", size: int) -> None:
+        # records waiting to be sent to this client. if the client can't keep
+        # up and this fills then the client is dropped instead of holding up
+        # everyone else.
+        self.queue: asyncio.Queue[Optional[bytes]] = asyncio.Queue(maxsize=size)
+        self.closed = False
+
+    async def __aiter__(self: "Subscription") -> AsyncIterator[bytes]:
+        while not self.closed:
+            record = await self.queue.get()
+            if record is None:
+                break
+            yield record
+
+    def close(self: "Subscription") -> None:
+        self.closed = True
+        # wake up the client if it is waiting. if its queue is full then it
+        # isn't waiting and it will see that it is closed when it next looks.
+        with contextlib.suppress(asyncio.QueueFull):
+            self.queue.put_nowait(None)
+
+
+def parse_records(buffer: bytearray, chunk: bytes) -> list[bytes]:
+    # the envoy sends one record per line like a server-sent event, e.g.
+    # 'data: {"production": ...}'. lines can be split across chunks so the
+    # incomplete end of the last line is left in the buffer for next time.
+    buffer.extend(chunk)
+    *lines, remainder = buffer.split(b"\n")
+    buffer[:] = remainder
+
+    records = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith(b"data:"):
+            line = line[5:].strip()
+        if line.startswith(b"{"):
+            records.append(line)
+    return records
+
+
+class MeterStream:
+
+    def __init__(self: "MeterStream", app: Optional[Quart] = None, opener: Optional[Opener] = None) -> None:
+        # this is the path to the live feed on the envoy and how many records
+        # each client may fall behind before it is dropped.
+        self.stream_path = "/stream/meter"
+        self.stream_queue_size = 16
+
+        # when the envoy connection fails then wait a random amount of time,
+        # starting with up to the minimum and doubling up to the maximum,
+        # before connecting again.
+        self.stream_backoff_min = 1.0
+        self.stream_backoff_max = 60.0
+
+        # there is only ever one connection to the envoy no matter how many
+        # clients there are. it is only open while there are clients.
+        self.subscribers: set[Subscription] = set()
+        self.reader: Optional[asyncio.Task] = None
+        self.opener: Optional[Opener] = None
+
+        # these are for monitoring
+        self.records = 0
+        self.dropped = 0
+        self.connections = 0
+
+        self.app: Optional[Quart] = None
+        if app is not None and opener is not None:
+            self.init_app(app, opener)
+
+    def init_app(self: "MeterStream", app: Quart, opener: Opener) -> None:
+        self.app = app
+        self.opener = opener
+        self.stream_path = app.config.get("STREAM_PATH", self.stream_path)
+        self.stream_queue_size = int(app.config.get("STREAM_QUEUE_SIZE", self.stream_queue_size))
+        self.stream_backoff_min = float(app.config.get("STREAM_BACKOFF_MIN", self.stream_backoff_min))
+        self.stream_backoff_max = float(app.config.get("STREAM_BACKOFF_MAX", self.stream_backoff_max))
+
+        @app.after_serving
+        async def shutdown() -> None:
+            logger.info("closing live stream for %d clients", len(self.subscribers))
+            for subscription in list(self.subscribers):
+                subscription.close()
+            self.subscribers.clear()
+            await self._stop()
+
+    @contextlib.asynccontextmanager
+    async def subscribe(self: "MeterStream") -> AsyncIterator[Subscription]:
+        subscription = Subscription(self.stream_queue_size)
+        self.subscribers.add(subscription)
+        if self.reader is None:
+            self.reader = asyncio.create_task(self._read())
+
+        try:
+            yield subscription
+        finally:
+            subscription.close()
+            self.subscribers.discard(subscription)
+            if not self.subscribers:
+                await self._stop()
+
+    async def _stop(self: "MeterStream") -> None:
+        reader, self.reader = self.reader, None
+        if reader is not None:
+            reader.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await reader
+
+    async def _read(self: "MeterStream") -> None:
+        backoff = self.stream_backoff_min
+        while self.subscribers:
+            try:
+                response = await self.opener(self.stream_path)
+                try:
+                    response.raise_for_status()
+                    logger.info("connected to live stream at %s", self.stream_path)
+                    self.connections += 1
+
+                    buffer = bytearray()
+                    async for chunk in response.aiter_bytes():
+                        # we got something so the connection is good again
+                        backoff = self.stream_backoff_min
+                        for record in parse_records(buffer, chunk):
+                            self.broadcast(record)
+                finally:
+                    await response.aclose()
+
+                logger.warning("live stream at %s ended", self.stream_path)
+            except Exception as e:
+                logger.warning("live stream at %s failed: %s", self.stream_path, str(e))
+
+            delay = random.uniform(0, backoff)  # noqa: S311
+            logger.info("reconnecting to live stream in %.1f seconds", delay)
+            await asyncio.sleep(delay)
+            backoff = min(backoff * 2, self.stream_backoff_max)
+
+    def broadcast(self: "MeterStream", record: bytes) -> None:
+        self.records += 1
+        for subscription in list(self.subscribers):
+            try:
+                subscription.queue.put_nowait(record)
+            except asyncio.QueueFull:
+                logger.warning("dropping live stream client that fell %d records behind", self.stream_queue_size)
+                self.dropped += 1
+                subscription.close()
+                self.subscribers.discard(subscription)
+
+    @property
+    def stats(self: "MeterStream") -> dict[str, int]:
+        return {
+            "subscribers": len(self.subscribers),
+            "records": self.records,
+            "dropped": self.dropped,
+            "connections": self.connections,
+        }
@@ -1,6 +1,7 @@
 import importlib.resources
 import logging
 import os
+from dataclasses import dataclass
 from typing import Optional
 
 from quart import Quart
@@ -33,3 +34,56 @@ def load_configuration(
             app.config.from_pyfile(path)
 
     return environment
+
+
+@dataclass(frozen=True)
+class GatewayConfiguration:
+    name: str
+    url: str
+    serialno: Optional[str] = None
+    jwt: Optional[str] = None
+    token_store: Optional[str] = None
+
+
+def load_gateways(app: Quart) -> list[GatewayConfiguration]:
+    # without a list of gateways there is just the one that is configured the
+    # same way that it always has been
+    gateways = app.config.get("GATEWAYS")
+    if not gateways:
+        # a serial number from the environment is read as json and so it is
+        # usually a number but a name is always a string
+        serialno = app.config.get("REMOTE_API_SERIALNO")
+        return [
+            GatewayConfiguration(
+                name=str(serialno) if serialno else "default",
+                url=app.config["LOCAL_API_URL"],
+                serialno=serialno,
+                jwt=app.config.get("LOCAL_API_JWT"),
+                token_store=app.config.get("REMOTE_API_TOKEN_STORE"),
+            )
+        ]
+
+    # every gateway shares one token store setting so it has to say where
+    # each gateway's credentials go or they will overwrite each other
+    token_store = app.config.get("REMOTE_API_TOKEN_STORE")
+    if token_store and len(gateways) > 1 and "{serial}" not in token_store:
+        raise ValueError("REMOTE_API_TOKEN_STORE must contain '{serial}' when there is more than one gateway")
+
+    results = []
+    for gateway in gateways:
+        serialno = str(gateway["serial"])
+        results.append(
+            GatewayConfiguration(
+                name=serialno,
+                url=gateway["url"],
+                serialno=serialno,
+                jwt=gateway.get("jwt"),
+                token_store=gateway.get("token_store")
+                or (token_store.format(serial=serialno) if token_store else None),
+            )
+        )
+
+    if len({gateway.name for gateway in results}) != len(results):
+        raise ValueError("every gateway in GATEWAYS must have a different serial")
+
+    return results
@@ -0,0 +1,163 @@
+import contextvars
+import importlib
+import json
+import logging
+import random
+import re
+import secrets
+import time
+from typing import Callable, Optional
+
+from quart import Quart, Response, request
+
+logger = logging.getLogger(__name__)
+
+# a w3c trace context header like "00-<trace id>-<parent id>-<flags>"
+TRACEPARENT = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+
+class Timing:
+    # one of these is made for each request that is being timed. anything
+    # that the request waits on adds how long it waited to one of the phases.
+    __slots__ = ("started", "started_at", "phases", "sampled", "traceparent")
+
+    def __init__(self: "Timing", sampled: bool = False, traceparent: Optional[str] = None) -> None:
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.phases: dict[str, float] = {}
+        self.sampled = sampled
+        self.traceparent = traceparent
+
+    def add(self: "Timing", phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @property
+    def elapsed(self: "Timing") -> float:
+        return time.perf_counter() - self.started
+
+    def header(self: "Timing") -> str:
+        timings = [*self.phases.items(), ("total", self.elapsed)]
+        return ", ".join(f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in timings)
+
+
+# this is the timing for the request that is running right now, if it is being
+# timed. it is copied into any task that the request starts so the time spent
+# by a fetch that is shared with other requests goes to the one that started it.
+CURRENT: contextvars.ContextVar[Optional[Timing]] = contextvars.ContextVar("timing", default=None)
+
+
+def record(phase: str, seconds: float) -> None:
+    timing = CURRENT.get()
+    if timing is not None:
+        timing.add(phase, seconds)
+
+
+Emitter = Callable[[str, Timing, int], None]
+
+
+def _log_emitter() -> Emitter:
+    def emit(name: str, timing: Timing, status: int) -> None:
+        trace_id, parent_id = secrets.token_hex(16), None
+        match = TRACEPARENT.match(timing.traceparent or "")
+        if match is not None:
+            trace_id, parent_id = match.groups()
+
+        span = {
+            "name": name,
+            "trace_id": trace_id,
+            "span_id": secrets.token_hex(8),
+            "parent_id": parent_id,
+            "start_time": timing.started_at,
+            "duration_ms": round(timing.elapsed * 1000, 3),
+            "status": status,
+            "phases_ms": {phase: round(seconds * 1000, 3) for phase, seconds in timing.phases.items()},
+        }
+        logger.info(json.dumps(span))
+
+    return emit
+
+
+def _otel_emitter() -> Emitter:
+    # this is only used if the opentelemetry api is installed and configured
+    # by whoever is running the proxy, like with "opentelemetry-instrument"
+    trace = importlib.import_module("opentelemetry.trace")
+    propagate = importlib.import_module("opentelemetry.propagate")
+    tracer = trace.get_tracer("enphase_proxy")
+
+    def emit(name: str, timing: Timing, status: int) -> None:
+        context = propagate.extract({"traceparent": timing.traceparent}) if timing.traceparent else None
+        started = int(timing.started_at * 1e9)
+        span = tracer.start_span(name, context=context, start_time=started, kind=trace.SpanKind.SERVER)
+        span.set_attribute("http.response.status_code", status)
+        for phase, seconds in timing.phases.items():
+            span.set_attribute(f"enphase_proxy.{phase}_ms", seconds * 1000)
+        span.end(end_time=started + int(timing.elapsed * 1e9))
+
+    return emit
+
+
+# these are all of the span emitters and how to make them
+EMITTERS: dict[str, Callable[[], Emitter]] = {
+    "log": _log_emitter,
+    "otel": _otel_emitter,
+}
+
+
+class RequestTracer:
+
+    def __init__(self: "RequestTracer", app: Optional[Quart] = None) -> None:
+        # the time spent on each phase of a request is sent back to the client
+        # in a "Server-Timing" header if this is set. this tells anyone who can
+        # reach us how long our own requests to the envoy take so it is only
+        # for debugging.
+        self.server_timing = False
+
+        # a span is sent to this for this fraction of requests. if there is no
+        # emitter or the request isn't sampled then no span is made.
+        self.emitter: Optional[Emitter] = None
+        self.sample_rate = 1.0
+
+        self.app: Optional[Quart] = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self: "RequestTracer", app: Quart) -> None:
+        self.app = app
+        self.server_timing = bool(app.config.get("TRACING_SERVER_TIMING", self.server_timing))
+        self.sample_rate = float(app.config.get("TRACING_SAMPLE_RATE", self.sample_rate))
+
+        exporter = app.config.get("TRACING_EXPORTER")
+        if exporter:
+            try:
+                self.emitter = EMITTERS[exporter]()
+            except (ImportError, KeyError):
+                logger.warning("tracing exporter '%s' is not available", exporter)
+
+        # when nothing is wanted then don't even look at requests
+        if not self.server_timing and (self.emitter is None or self.sample_rate <= 0):
+            return
+
+        @app.before_request
+        async def start() -> None:
+            sampled = self.emitter is not None and random.random() < self.sample_rate  # noqa: S311
+            if sampled or self.server_timing:
+                CURRENT.set(Timing(sampled, request.headers.get("traceparent")))
+
+        @app.after_request
+        async def finish(response: Response) -> Response:
+            timing = CURRENT.get()
+            if timing is None:
+                return response
+
+            if self.server_timing:
+                response.headers["Server-Timing"] = timing.header()
+            if timing.sampled:
+                self._emit(f"{request.method} {request.path}", timing, response.status_code)
+            return response
+
+    def _emit(self: "RequestTracer", name: str, timing: Timing, status: int) -> None:
+        # tracing must never break a request
+        try:
+            self.emitter(name, timing, status)
+        except Exception as e:
+            logger.warning("unable to emit span for %s: %s", name, str(e))
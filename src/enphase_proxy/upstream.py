@@ -0,0 +1,207 @@
+import asyncio
+import contextlib
+import logging
+from typing import Any, AsyncIterator, Callable, Iterable, Mapping, Optional
+
+import httpx
+from quart import Quart
+
+from .metrics import UPSTREAM_BYTES_TOTAL, UpstreamTracer
+
+logger = logging.getLogger(__name__)
+
+# these are the headers from the envoy that are passed through to the client
+# when a response is streamed. anything describing the connection itself, like
+# transfer-encoding, is left to the server that is talking to the client.
+RESPONSE_HEADERS = (
+    "content-type",
+    "content-length",
+    "content-encoding",
+    "content-disposition",
+    "cache-control",
+    "etag",
+    "last-modified",
+    "expires",
+    "vary",
+    "allow",
+)
+
+# these are the headers from the client that are passed through to the envoy
+REQUEST_HEADERS = (
+    "accept",
+    "accept-language",
+    "content-type",
+    "content-length",
+)
+
+# these describe the connection and not the request so they never go from one
+# side of the proxy to the other no matter what is configured
+HOP_BY_HOP_HEADERS = frozenset(
+    (
+        "connection",
+        "keep-alive",
+        "proxy-authenticate",
+        "proxy-authorization",
+        "te",
+        "trailer",
+        "transfer-encoding",
+        "upgrade",
+    )
+)
+
+# and these are never sent to the envoy either. we send our own credentials,
+# the host is the envoy's, and the encodings that we accept depend on what we
+# are going to do with the body.
+EXCLUDED_REQUEST_HEADERS = HOP_BY_HOP_HEADERS | {"authorization", "host", "accept-encoding"}
+
+# the event loop only keeps a weak reference to a task so the tasks that close
+# bodies that were thrown away are kept here until they are done
+CLOSING: set[asyncio.Task] = set()
+
+
+def allowlist(names: Iterable[str], excluded: frozenset[str]) -> tuple[str, ...]:
+    return tuple(dict.fromkeys(name.lower() for name in names if name.lower() not in excluded))
+
+
+def select_headers(headers: Mapping[str, str], names: Iterable[str]) -> dict[str, str]:
+    return {name: headers[name] for name in names if name in headers}
+
+
+def create_client(config: Mapping[str, Any], url: str) -> httpx.AsyncClient:
+    # the envoy has a very small cpu and a new tls handshake is the most
+    # expensive thing that we can ask of it. so everything here is about
+    # keeping connections open and reusing them for as long as possible.
+    timeout = httpx.Timeout(
+        config.get("LOCAL_API_TIMEOUT", 300),
+        connect=config.get("LOCAL_API_CONNECT_TIMEOUT", 10),
+        pool=config.get("LOCAL_API_POOL_TIMEOUT", 300),
+    )
+    limits = httpx.Limits(
+        max_connections=config.get("LOCAL_API_MAX_CONNECTIONS", 10),
+        max_keepalive_connections=config.get("LOCAL_API_MAX_KEEPALIVE_CONNECTIONS", 10),
+        keepalive_expiry=config.get("LOCAL_API_KEEPALIVE_EXPIRY", 60),
+    )
+
+    return httpx.AsyncClient(
+        verify=False,  # noqa S501
+        timeout=timeout,
+        limits=limits,
+        http2=bool(config.get("LOCAL_API_HTTP2", False)),
+        base_url=url,
+    )
+
+
+class UpstreamClient:
+
+    def __init__(self: "UpstreamClient", app: Optional[Quart] = None, url: Optional[str] = None) -> None:
+        # this is the one client that every request to the envoy goes through.
+        # it is created when the application starts serving and closed when
+        # the application stops so that the connection pool lives for the
+        # entire life of the application.
+        self.client: Optional[httpx.AsyncClient] = None
+
+        # this is the envoy that the client talks to. if it isn't given then
+        # it comes from the configuration.
+        self.url = url
+
+        # these are the headers that are passed from the client to the envoy
+        # and from the envoy back to the client. everything else is dropped.
+        self.request_headers = REQUEST_HEADERS
+        self.response_headers = RESPONSE_HEADERS
+
+        self.app: Optional[Quart] = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self: "UpstreamClient", app: Quart) -> None:
+        self.app = app
+        self.url = self.url or app.config["LOCAL_API_URL"]
+        self.request_headers = allowlist(
+            app.config.get("FORWARD_REQUEST_HEADERS") or REQUEST_HEADERS, EXCLUDED_REQUEST_HEADERS
+        )
+        self.response_headers = allowlist(
+            app.config.get("FORWARD_RESPONSE_HEADERS") or RESPONSE_HEADERS, HOP_BY_HOP_HEADERS
+        )
+
+        @app.before_serving
+        async def startup() -> None:
+            logger.info("opening connection pool to %s", self.url)
+            self.client = create_client(app.config, self.url)
+
+        @app.after_serving
+        async def shutdown() -> None:
+            logger.info("closing connection pool to %s", self.url)
+            if self.client is not None:
+                await self.client.aclose()
+                self.client = None
+
+    async def request(self: "UpstreamClient", method: str, url: str, **kwargs: Any) -> httpx.Response:
+        if self.client is None:
+            raise RuntimeError("upstream client is not open")
+
+        response = await self.client.request(method, url, extensions={"trace": UpstreamTracer()}, **kwargs)
+        UPSTREAM_BYTES_TOTAL.inc(response.num_bytes_downloaded)
+        return response
+
+    async def stream(self: "UpstreamClient", method: str, url: str, **kwargs: Any) -> httpx.Response:
+        if self.client is None:
+            raise RuntimeError("upstream client is not open")
+
+        # the body of the response has not been read when this returns. the
+        # caller is responsible for closing the response when it is finished.
+        request = self.client.build_request(method, url, extensions={"trace": UpstreamTracer()}, **kwargs)
+        return await self.client.send(request, stream=True)
+
+
+class StreamedBody:
+    # send the bytes exactly as they came from the envoy. there is no decoding
+    # or decompressing done here so the content-length and content-encoding
+    # headers from the envoy remain correct.
+    #
+    # this isn't a generator because a generator that was never started never
+    # runs its cleanup, like when the client goes away before we start sending
+    # the body. closing this always gives back the connection and calls
+    # "on_close" whether or not anything was read.
+
+    def __init__(self: "StreamedBody", response: httpx.Response, on_close: Optional[Callable[[], None]] = None) -> None:
+        self.response = response
+        self.on_close = on_close
+        self.chunks: Optional[AsyncIterator[bytes]] = None
+        self.closed = False
+
+    def __aiter__(self: "StreamedBody") -> "StreamedBody":
+        return self
+
+    async def __anext__(self: "StreamedBody") -> bytes:
+        if self.closed:
+            raise StopAsyncIteration
+        if self.chunks is None:
+            self.chunks = self.response.aiter_raw()
+        try:
+            return await self.chunks.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+
+    def _finish(self: "StreamedBody") -> bool:
+        # this part can't wait on anything so that it is also safe from __del__
+        if self.closed:
+            return False
+        self.closed = True
+        if self.on_close is not None:
+            self.on_close()
+        return True
+
+    async def aclose(self: "StreamedBody") -> None:
+        if self._finish():
+            await self.response.aclose()
+            UPSTREAM_BYTES_TOTAL.inc(self.response.num_bytes_downloaded)
+
+    def __del__(self: "StreamedBody") -> None:
+        # the server never even got to the body so nobody closed it. give the
+        # slot back now and close the connection as soon as we can.
+        if self._finish():
+            with contextlib.suppress(RuntimeError):
+                task = asyncio.get_running_loop().create_task(self.response.aclose())
+                CLOSING.add(task)
+                task.add_done_callback(CLOSING.discard)
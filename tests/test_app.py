@@ -0,0 +1,754 @@
+import asyncio
+import gzip
+import inspect
+import json
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Union
+
+import httpx
+import pytest
+from quart import Quart
+
+from enphase_proxy import upstream
+from enphase_proxy.app import load
+from enphase_proxy.updater import CredentialsManager, FetchedCredentials
+
+
+class FakeEnvoy:
+    def __init__(self) -> None:
+        # every request that makes it to the fake envoy is recorded here
+        self.requests: list[httpx.Request] = []
+
+        # responses for specific paths. anything else just echoes the path.
+        self.responses: dict[str, Callable[[httpx.Request], Union[httpx.Response, Awaitable[httpx.Response]]]] = {}
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if request.url.path in self.responses:
+            response = self.responses[request.url.path](request)
+            if inspect.isawaitable(response):
+                response = await response
+        else:
+            response = httpx.Response(200, json={"path": request.url.path})
+
+        # responses built from content are already marked as read. send the
+        # raw stream instead so it looks like it came from a real connection.
+        return httpx.Response(response.status_code, headers=response.headers, stream=response.stream)
+
+
+@pytest.fixture
+def envoy() -> FakeEnvoy:
+    return FakeEnvoy()
+
+
+@pytest.fixture
+def settings() -> dict:
+    # override this with parametrize to configure the application
+    return {}
+
+
+@pytest.fixture
+def app(monkeypatch: pytest.MonkeyPatch, envoy: FakeEnvoy, settings: dict) -> Quart:
+    monkeypatch.setenv("ENPHASE_LOCAL_API_URL", "https://envoy.local/")
+    monkeypatch.setenv("ENPHASE_LOCAL_API_JWT", "test_jwt")
+    for name, value in settings.items():
+        monkeypatch.setenv(f"ENPHASE_{name}", json.dumps(value))
+
+    def create_client(config: dict, url: str) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=httpx.MockTransport(envoy), base_url=url)
+
+    monkeypatch.setattr(upstream, "create_client", create_client)
+    app = load()
+
+    # don't wait around for background tasks when the test app shuts down
+    app.config["BACKGROUND_TASK_SHUTDOWN_TIMEOUT"] = 0
+    return app
+
+
+@pytest.mark.asyncio
+async def test_health(app: Quart):
+    async with app.test_app() as test_app:
+        response = await test_app.test_client().get("/_/health")
+        assert response.status_code == 200
+        assert (await response.get_json())["status"] == "pass"
+
+
+@pytest.mark.asyncio
+async def test_proxy_streams_response(app: Quart, envoy: FakeEnvoy):
+    async with app.test_app() as test_app:
+        response = await test_app.test_client().get("/production.json", query_string={"details": "1"})
+        assert response.status_code == 200
+        assert await response.get_json() == {"path": "/production.json"}
+        assert response.headers["Content-Type"] == "application/json"
+
+    assert len(envoy.requests) == 1
+    assert envoy.requests[0].url.path == "/production.json"
+    assert envoy.requests[0].url.params["details"] == "1"
+    assert envoy.requests[0].headers["Authorization"] == "Bearer test_jwt"
+    assert envoy.requests[0].headers["Accept-Encoding"] == "identity"
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [{}, {"FORWARD_REQUEST_HEADERS": ["Content-Type", "X-Request-Id", "Authorization"]}],
+)
+@pytest.mark.parametrize("streaming", [True, False])
+@pytest.mark.parametrize("method", ["POST", "PUT", "PATCH", "DELETE"])
+@pytest.mark.asyncio
+async def test_proxy_sends_request_body(app: Quart, envoy: FakeEnvoy, settings: dict, streaming: bool, method: str):
+    app.config["LOCAL_API_STREAMING"] = streaming
+    envoy.responses["/ivp/ss/dpel"] = lambda request: httpx.Response(
+        201, content=request.content, headers={"Content-Type": "application/json", "X-Envoy-Secret": "hidden"}
+    )
+
+    body = json.dumps({"dynamic_pel_settings": {"enable": True}}).encode()
+    async with app.test_app() as test_app:
+        response = await test_app.test_client().open(
+            "/ivp/ss/dpel",
+            method=method,
+            data=body,
+            headers={
+                "Content-Type": "application/json",
+                "Content-Length": str(len(body)),
+                "X-Request-Id": "abc",
+                "Authorization": "Basic secret",
+            },
+        )
+        assert response.status_code == 201
+        assert await response.get_data() == body
+        assert response.headers["Content-Type"] == "application/json"
+        assert "X-Envoy-Secret" not in response.headers
+
+    request = envoy.requests[0]
+    assert request.method == method
+    assert request.content == body
+    assert request.headers["Content-Type"] == "application/json"
+    assert request.headers["Authorization"] == "Bearer test_jwt"
+    assert ("X-Request-Id" in request.headers) == bool(settings)
+
+
+@pytest.mark.parametrize("settings", [{"FORWARD_RESPONSE_HEADERS": ["Allow"]}])
+@pytest.mark.asyncio
+async def test_proxy_options(app: Quart, envoy: FakeEnvoy):
+    envoy.responses["/ivp/ss/dpel"] = lambda request: httpx.Response(
+        204, headers={"Allow": "GET, PUT", "Content-Type": "text/plain"}
+    )
+
+    async with app.test_app() as test_app:
+        response = await test_app.test_client().options("/ivp/ss/dpel")
+        assert response.status_code == 204
+        assert response.headers["Allow"] == "GET, PUT"
+        assert response.headers.get("Content-Type") != "text/plain"
+
+    # nothing was sent so the envoy isn't told that something was
+    assert envoy.requests[0].method == "OPTIONS"
+    assert "Content-Length" not in envoy.requests[0].headers
+    assert "Transfer-Encoding" not in envoy.requests[0].headers
+
+
+@pytest.mark.asyncio
+async def test_proxy_streams_encoded_response(app: Quart, envoy: FakeEnvoy):
+    body = gzip.compress(b'{"production": []}')
+    envoy.responses["/production.json"] = lambda request: httpx.Response(
+        200, content=body, headers={"Content-Type": "application/json", "Content-Encoding": "gzip"}
+    )
+
+    async with app.test_app() as test_app:
+        response = await test_app.test_client().get("/production.json", headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert response.headers["Content-Length"] == str(len(body))
+        assert await response.get_data() == body
+
+    assert envoy.requests[0].headers["Accept-Encoding"] == "gzip"
+
+
+@pytest.mark.parametrize("settings", [{"LOCAL_API_STREAMING": False}])
+@pytest.mark.asyncio
+async def test_proxy_buffered_response(app: Quart):
+    async with app.test_app() as test_app:
+        response = await test_app.test_client().get("/production.json")
+        assert response.status_code == 200
+        assert await response.get_json() == {"path": "/production.json"}
+
+
+@pytest.mark.parametrize("settings", [{"CACHE_TTLS": {"/production.json": 60}}])
+@pytest.mark.asyncio
+async def test_proxy_cached_response(app: Quart, envoy: FakeEnvoy):
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+        for _ in range(3):
+            response = await client.get("/production.json", query_string={"b": "2", "a": "1"})
+            assert response.status_code == 200
+            assert await response.get_json() == {"path": "/production.json"}
+
+        response = await client.get("/_/health")
+        assert (await response.get_json())["gateways"]["default"]["cache"] == {
+            "entries": 1,
+            "hits": 2,
+            "misses": 1,
+            "coalesced": 0,
+        }
+
+    assert len(envoy.requests) == 1
+    assert str(envoy.requests[0].url) == "https://envoy.local/production.json?a=1&b=2"
+
+
+@pytest.mark.parametrize("settings", [{"POLLER_PATHS": ["/production.json"], "POLLER_INTERVAL": 60}])
+@pytest.mark.asyncio
+async def test_proxy_snapshot_response(app: Quart, envoy: FakeEnvoy):
+    async with app.test_app() as test_app:
+        # wait for the poller to fetch its first snapshot
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if envoy.requests:
+                break
+        await asyncio.sleep(0.01)
+
+        client = test_app.test_client()
+        for _ in range(3):
+            response = await client.get("/production.json")
+            assert response.status_code == 200
+            assert response.headers["Age"] == "0"
+            assert await response.get_json() == {"path": "/production.json"}
+
+    assert len(envoy.requests) == 1
+
+
+@pytest.mark.parametrize("settings", [{"LIMITER_MAX_IN_FLIGHT": 0, "LIMITER_MAX_QUEUED": 0, "LIMITER_RETRY_AFTER": 3}])
+@pytest.mark.asyncio
+async def test_proxy_overloaded(app: Quart, envoy: FakeEnvoy):
+    async with app.test_app() as test_app:
+        response = await test_app.test_client().get("/production.json")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "3"
+        assert (await response.get_json())["status"] == "fail"
+
+    assert len(envoy.requests) == 0
+
+
+@pytest.mark.asyncio
+async def test_metrics(app: Quart):
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+        await client.get("/production.json")
+
+        response = await client.get("/_/metrics")
+        assert response.status_code == 200
+        assert response.headers["Content-Type"].startswith("text/plain")
+
+        metrics = (await response.get_data()).decode()
+        assert 'enphase_proxy_requests_total{path="/production.json",status="200"}' in metrics
+        assert 'enphase_proxy_upstream_in_flight{gateway="default"} 0' in metrics
+        assert 'enphase_proxy_cache{gateway="default",stat="hits"} 0' in metrics
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [
+        {
+            "REMOTE_API_URL": "https://enlighten.local/",
+            "REMOTE_API_USERNAME": "test_username",
+            "REMOTE_API_PASSWORD": "test_password",  # noqa: S105
+            "REMOTE_API_SERIALNO": "test_serialno",
+        }
+    ],
+)
+@pytest.mark.parametrize("streaming", [True, False])
+@pytest.mark.asyncio
+async def test_proxy_renews_rejected_credentials(
+    app: Quart, envoy: FakeEnvoy, monkeypatch: pytest.MonkeyPatch, streaming: bool
+):
+    app.config["LOCAL_API_STREAMING"] = streaming
+    fetches = []
+
+    async def fetch_credentials(self: CredentialsManager) -> FetchedCredentials:
+        fetches.append(self)
+        return FetchedCredentials(  # noqa: S106
+            fetched_at=datetime.now(),
+            expires_at=datetime.now() + timedelta(hours=1),
+            token="new",  # noqa: S106
+        )
+
+    monkeypatch.setattr(CredentialsManager, "_fetch_credentials", fetch_credentials)
+
+    def respond(request: httpx.Request) -> httpx.Response:
+        if request.headers["Authorization"] != "Bearer new":
+            return httpx.Response(401)
+        return httpx.Response(200, json={"authorized": True})
+
+    envoy.responses["/production.json"] = respond
+
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+
+        # a body that was already sent can't be sent again so this one isn't
+        # tried again but the credentials are still renewed
+        response = await client.put("/production.json", data=b"{}", headers={"Content-Length": "2"})
+        assert response.status_code == 401
+
+        for _ in range(2):
+            response = await client.get("/production.json")
+            assert response.status_code == 200
+            assert await response.get_json() == {"authorized": True}
+
+    assert len(fetches) == 1
+    assert [(request.method, request.headers["Authorization"]) for request in envoy.requests] == [
+        ("PUT", "Bearer test_jwt"),
+        ("GET", "Bearer new"),
+        ("GET", "Bearer new"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_stream_meter_websocket(app: Quart, envoy: FakeEnvoy):
+    envoy.responses["/stream/meter"] = lambda request: httpx.Response(200, content=b'data: {"production": 1}\n\n')
+
+    async with app.test_app() as test_app:
+        async with test_app.test_client().websocket("/_/ws/meter") as ws:
+            assert json.loads(await ws.receive()) == {"production": 1}
+
+    assert envoy.requests[0].url.path == "/stream/meter"
+    assert envoy.requests[0].headers["Authorization"] == "Bearer test_jwt"
+
+
+@pytest.mark.parametrize("settings", [{"CACHE_TTLS": {"/production.json": 60}}])
+@pytest.mark.asyncio
+async def test_proxy_conditional_and_compressed_response(app: Quart, envoy: FakeEnvoy):
+    body = {"production": [{"wNow": 1234}] * 200}
+    envoy.responses["/production.json"] = lambda request: httpx.Response(200, json=body)
+
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+
+        response = await client.get("/production.json", headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert "Accept-Encoding" in response.headers["Vary"]
+        assert json.loads(gzip.decompress(await response.get_data())) == body
+        etag = response.headers["ETag"]
+        assert etag.endswith('-gzip"')
+
+        response = await client.get("/production.json", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        assert await response.get_data() == b""
+
+        response = await client.get("/production.json", headers={"If-None-Match": '"something-else"'})
+        assert response.status_code == 200
+        assert "Content-Encoding" not in response.headers
+        assert await response.get_json() == body
+
+        # the uncompressed response has its own tag and either one still matches
+        identity = response.headers["ETag"]
+        assert identity != etag and identity == etag.replace("-gzip", "")
+        for tag in (identity, f"W/{identity}"):
+            response = await client.get("/production.json", headers={"If-None-Match": tag, "Accept-Encoding": "gzip"})
+            assert response.status_code == 304
+
+    assert len(envoy.requests) == 1
+
+
+@pytest.mark.parametrize("settings", [{"LOCAL_API_STREAMING": False}])
+@pytest.mark.asyncio
+async def test_proxy_write_is_never_conditional(app: Quart, envoy: FakeEnvoy):
+    envoy.responses["/production.json"] = lambda request: httpx.Response(200, json={"written": True})
+
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+        headers = {"If-None-Match": "*", "Accept-Encoding": "gzip", "Content-Length": "2"}
+        response = await client.put("/production.json", data=b"{}", headers=headers)
+        assert response.status_code == 200
+        assert "ETag" not in response.headers
+        assert "Content-Encoding" not in response.headers
+        assert await response.get_json() == {"written": True}
+
+    assert [request.method for request in envoy.requests] == ["PUT"]
+
+
+GATEWAYS = [
+    {"serial": "111", "url": "https://envoy-1.local/", "jwt": "jwt_1"},
+    {"serial": "222", "url": "https://envoy-2.local/", "jwt": "jwt_2"},
+]
+
+
+@pytest.mark.parametrize("settings", [{"CACHE_TTLS": {"/production.json": 60}}])
+@pytest.mark.asyncio
+async def test_summary(app: Quart, envoy: FakeEnvoy):
+    envoy.responses["/production.json"] = lambda request: httpx.Response(
+        200,
+        json={
+            "production": [{"measurementType": "production", "readingTime": 100, "wNow": 1000, "whToday": 5000}],
+            "consumption": [{"measurementType": "net-consumption", "readingTime": 100, "wNow": -250}],
+        },
+    )
+
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+        response = await client.get("/_/summary")
+        assert response.status_code == 200
+        summary = await response.get_json()
+        assert summary["gateway"] == "default"
+        assert summary["production_watts"] == 1000
+        assert summary["net_consumption_watts"] == -250
+        assert summary["production_today_kwh"] == 5
+        assert summary["battery_percent"] is None
+
+        # nothing changed so it is the same summary
+        response = await client.get("/_/summary", headers={"If-None-Match": response.headers["ETag"]})
+        assert response.status_code == 304
+
+        response = await client.get("/_/summary/nope")
+        assert response.status_code == 404
+
+    assert len(envoy.requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_summary_invalid(app: Quart, envoy: FakeEnvoy):
+    envoy.responses["/production.json"] = lambda request: httpx.Response(200, json=[])
+
+    async with app.test_app() as test_app:
+        response = await test_app.test_client().get("/_/summary")
+        assert response.status_code == 502
+        assert (await response.get_json())["status"] == "fail"
+
+
+@pytest.mark.parametrize("settings", [{"GATEWAYS": GATEWAYS, "TRACING_SERVER_TIMING": True}])
+@pytest.mark.asyncio
+async def test_proxy_gateways(app: Quart, envoy: FakeEnvoy):
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+        for path in ["/production.json", "/gw/111/production.json", "/gw/222/production.json"]:
+            response = await client.get(path)
+            assert response.status_code == 200
+            assert await response.get_json() == {"path": "/production.json"}
+
+        # every response says how long it spent
+        assert response.headers["Server-Timing"].startswith("total;dur=")
+
+        response = await client.get("/gw/333/production.json")
+        assert response.status_code == 404
+        assert (await response.get_json())["status"] == "fail"
+
+        response = await client.get("/_/health")
+        assert set((await response.get_json())["gateways"]) == {"111", "222"}
+
+    # the first gateway is the default one and each one gets its own token
+    assert [(request.url.host, request.headers["Authorization"]) for request in envoy.requests] == [
+        ("envoy-1.local", "Bearer jwt_1"),
+        ("envoy-1.local", "Bearer jwt_1"),
+        ("envoy-2.local", "Bearer jwt_2"),
+    ]
+
+
+@pytest.mark.parametrize("settings", [{"GATEWAYS": GATEWAYS, "AGGREGATE_TIMEOUT": 0.1}])
+@pytest.mark.asyncio
+async def test_aggregate(app: Quart, envoy: FakeEnvoy):
+    async def respond(request: httpx.Request) -> httpx.Response:
+        if request.url.host == "envoy-2.local":
+            await asyncio.sleep(10)
+        return httpx.Response(200, json={"wattsNow": 1234})
+
+    envoy.responses["/api/v1/production"] = respond
+
+    async with app.test_app() as test_app:
+        response = await test_app.test_client().get("/_/aggregate/api/v1/production")
+        assert response.status_code == 200
+        assert await response.get_json() == {
+            "path": "/api/v1/production",
+            "gateways": {
+                "111": {"status": 200, "headers": {"content-type": "application/json"}, "body": {"wattsNow": 1234}},
+                "222": {"status": 504, "error": "timed out after 0.1 seconds"},
+            },
+        }
+
+
+@pytest.mark.parametrize("settings", [{"HISTORY_ENABLED": True, "HISTORY_INTERVAL": 60}])
+@pytest.mark.asyncio
+async def test_history(app: Quart, envoy: FakeEnvoy):
+    envoy.responses["/production.json"] = lambda request: httpx.Response(
+        200, json={"production": [{"type": "inverters", "readingTime": 1000, "wNow": 1234}]}
+    )
+
+    async with app.test_app() as test_app:
+        # wait for the first samples to be taken
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if len(envoy.requests) == 2:
+                break
+        await asyncio.sleep(0.01)
+
+        client = test_app.test_client()
+        response = await client.get("/_/history", query_string={"series": "production_watts", "start": 0, "end": 2000})
+        assert response.status_code == 200
+        assert (await response.get_json())["series"] == {"production_watts": [[960, 1234, 1234, 1234]]}
+
+        response = await client.get("/_/history", query_string={"resolution": "-1"})
+        assert response.status_code == 400
+
+
+@pytest.mark.parametrize("settings", [{"GATEWAYS": GATEWAYS, "BATCH_MAX_PATHS": 6}])
+@pytest.mark.asyncio
+async def test_batch(app: Quart, envoy: FakeEnvoy):
+    envoy.responses["/inventory.json"] = lambda request: httpx.Response(500, text="envoy is sad")
+
+    def broken(request: httpx.Request) -> httpx.Response:
+        raise httpx.ConnectError("envoy is down")
+
+    envoy.responses["/broken"] = broken
+
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+        response = await client.post(
+            "/_/batch",
+            json=[
+                "/production.json?b=2&a=1",
+                {"path": "/production.json", "gateway": "222"},
+                "/inventory.json",
+                "/broken",
+                {"path": "/production.json", "gateway": "333"},
+                "/bad\x01path",
+            ],
+        )
+        assert response.status_code == 200
+        results = (await response.get_json())["responses"]
+        assert [(result["path"], result["status"]) for result in results] == [
+            ("/production.json?a=1&b=2", 200),
+            ("/production.json", 200),
+            ("/inventory.json", 500),
+            ("/broken", 502),
+            ("/production.json", 404),
+            ("/bad\x01path", 400),
+        ]
+        assert results[0]["gateway"] == "111"
+        assert results[0]["body"] == {"path": "/production.json"}
+        assert results[1]["gateway"] == "222"
+        assert results[2]["body"] == "envoy is sad"
+        assert results[3]["error"] == "envoy is down"
+
+        for body in [{"paths": []}, [], ["/"] * 7]:
+            response = await client.post("/_/batch", json=body)
+            assert response.status_code == 400
+
+    assert {request.url.host for request in envoy.requests} == {"envoy-1.local", "envoy-2.local"}
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [{"LOCAL_API_STREAMING": False, "BREAKER_MIN_REQUESTS": 1, "BREAKER_WINDOW": 1, "BREAKER_OPEN_SECONDS": 60}],
+)
+@pytest.mark.asyncio
+async def test_proxy_circuit_open(app: Quart, envoy: FakeEnvoy):
+    healthy = True
+
+    def respond(request: httpx.Request) -> httpx.Response:
+        if not healthy:
+            raise httpx.ConnectError("envoy is down")
+        return httpx.Response(200, json={"path": request.url.path})
+
+    envoy.responses["/production.json"] = respond
+    envoy.responses["/inventory.json"] = respond
+
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+        response = await client.get("/production.json")
+        assert response.status_code == 200
+
+        # the envoy goes away and the circuit opens
+        healthy = False
+        response = await client.get("/inventory.json")
+        assert response.status_code == 502
+
+        response = await client.get("/_/health")
+        assert (await response.get_json())["gateways"]["default"]["breaker"]["state"] == "open"
+
+        # the last good response is given back without asking the envoy
+        response = await client.get("/production.json")
+        assert response.status_code == 200
+        assert response.headers["Warning"] == '110 - "Response is Stale"'
+        assert await response.get_json() == {"path": "/production.json"}
+
+        # and anything else fails right away
+        response = await client.get("/inventory.json")
+        assert response.status_code == 503
+        assert int(response.headers["Retry-After"]) > 0
+
+    assert len(envoy.requests) == 2
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [
+        {
+            "LOCAL_API_JWT": None,
+            "REMOTE_API_URL": "https://enlighten.local/",
+            "REMOTE_API_USERNAME": "test_username",
+            "REMOTE_API_PASSWORD": "test_password",  # noqa: S105
+            "REMOTE_API_SERIALNO": "test_serialno",
+            "STARTUP_WAIT_FOR_CREDENTIALS": False,
+            "STARTUP_READY_TIMEOUT": 0.1,
+        }
+    ],
+)
+@pytest.mark.asyncio
+async def test_ready_without_credentials(app: Quart, envoy: FakeEnvoy, monkeypatch: pytest.MonkeyPatch):
+    async def fetch_credentials(self: CredentialsManager) -> FetchedCredentials:
+        raise httpx.ConnectError("enlighten is down")
+
+    monkeypatch.setattr(CredentialsManager, "_fetch_credentials", fetch_credentials)
+
+    # we start anyway and say that we are alive but not ready
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+        assert (await client.get("/_/live")).status_code == 200
+
+        response = await client.get("/_/ready")
+        assert response.status_code == 503
+        assert (await response.get_json())["status"] == "fail"
+
+        health = await (await client.get("/_/health")).get_json()
+        assert health["ready"] is False
+
+        # requests that need credentials wait a little and then give up
+        response = await client.get("/production.json")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+
+    assert len(envoy.requests) == 0
+
+
+@pytest.mark.asyncio
+async def test_ready(app: Quart):
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+        assert (await client.get("/_/live")).status_code == 200
+        assert (await client.get("/_/ready")).status_code == 200
+
+        health = await (await client.get("/_/health")).get_json()
+        assert health["ready"] is True
+        assert {"import_seconds", "config_seconds", "load_seconds", "serving_seconds"} <= set(health["startup"])
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [
+        {
+            "RATE_LIMIT_CLIENT": ["header:X-Api-Key"],
+            "RATE_LIMITS": [{"path": "*/inventory.json", "rate": 0.1}, {"path": "/_/*", "rate": 0.1}],
+        }
+    ],
+)
+@pytest.mark.asyncio
+async def test_rate_limited(app: Quart, envoy: FakeEnvoy):
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+        response = await client.get("/inventory.json", headers={"X-Api-Key": "first"})
+        assert response.status_code == 200
+
+        response = await client.get("/inventory.json", headers={"X-Api-Key": "first"})
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "10"
+        assert (await response.get_json())["status"] == "fail"
+
+        # health checks are never held back
+        for path in ["/_/health", "/_/live", "/_/ready"]:
+            assert (await client.get(path, headers={"X-Api-Key": "first"})).status_code == 200
+
+        # other clients and other paths aren't held back
+        assert (await client.get("/inventory.json", headers={"X-Api-Key": "second"})).status_code == 200
+        assert (await client.get("/production.json", headers={"X-Api-Key": "first"})).status_code == 200
+
+    assert [request.url.path for request in envoy.requests] == [
+        "/inventory.json",
+        "/inventory.json",
+        "/production.json",
+    ]
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [
+        {
+            "GATEWAYS": GATEWAYS,
+            "RATE_LIMIT_CLIENT": ["header:X-Api-Key"],
+            "RATE_LIMITS": [{"path": "*/inventory.json", "rate": 0.1}, {"path": "/gw/222/*", "rate": 0.1, "burst": 2}],
+        }
+    ],
+)
+@pytest.mark.asyncio
+async def test_rate_limited_batch_and_aggregate(app: Quart, envoy: FakeEnvoy):
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+        headers = {"X-Api-Key": "first"}
+
+        # each path in a batch counts as if it had been asked for by itself
+        paths = ["/inventory.json", "/inventory.json", "/production.json"]
+        response = await client.post("/_/batch", json=paths, headers=headers)
+        results = (await response.get_json())["responses"]
+        assert [result["status"] for result in results] == [200, 429, 200]
+        assert results[1]["retry_after"] == 10
+        assert (await client.get("/inventory.json", headers=headers)).status_code == 429
+
+        # and so does each gateway in an aggregate
+        headers = {"X-Api-Key": "second"}
+        response = await client.get("/_/aggregate/production.json", headers=headers)
+        assert {name: result["status"] for name, result in (await response.get_json())["gateways"].items()} == {
+            "111": 200,
+            "222": 200,
+        }
+        response = await client.get("/_/aggregate/inventory.json", headers=headers)
+        assert {name: result["status"] for name, result in (await response.get_json())["gateways"].items()} == {
+            "111": 200,
+            "222": 429,
+        }
+
+        # every limit that matches applies so the second gateway's own limit
+        # was used by the aggregate too, but not by the path that was held back
+        assert (await client.get("/gw/222/production.json", headers=headers)).status_code == 200
+        assert (await client.get("/gw/222/production.json", headers=headers)).status_code == 429
+
+
+@pytest.mark.parametrize("settings", [{"CACHE_TTLS": {"/production.json": 60}}])
+@pytest.mark.asyncio
+async def test_proxy_projection(app: Quart, envoy: FakeEnvoy):
+    production = {"production": [{"wNow": 1500, "whToday": 9000}], "consumption": [{"wNow": 900}, {"wNow": -600}]}
+    envoy.responses["/production.json"] = lambda request: httpx.Response(200, json=production)
+    envoy.responses["/info"] = lambda request: httpx.Response(200, text="<envoy_info/>")
+
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+        for _ in range(2):
+            response = await client.get("/production.json?_fields=production[0].wNow,consumption[*].wNow&details=1")
+            assert response.status_code == 200
+            assert response.headers["Content-Type"] == "application/json"
+            assert await response.get_json() == {"production[0].wNow": 1500, "consumption[*].wNow": [900, -600]}
+
+        # different fields come from the same cached response
+        response = await client.get("/production.json?details=1&_fields=production[0].whToday")
+        assert await response.get_json() == {"production[0].whToday": 9000}
+
+        response = await client.get("/production.json?_fields=production[0")
+        assert response.status_code == 400
+
+        # a HEAD request for a path that isn't cached gets the same headers
+        # that a GET request would have. the server leaves out the body.
+        envoy.responses["/api/v1/production"] = lambda request: httpx.Response(200, json={"wattsNow": 1234})
+        response = await client.head("/api/v1/production?_fields=wattsNow")
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "application/json"
+        assert response.headers["Content-Length"] == str(len(b'{"wattsNow":1234}'))
+
+        response = await client.get("/info?_fields=serial")
+        assert response.status_code == 502
+
+        # other methods aren't projected but still don't send our arguments
+        response = await client.post("/ivp/ss/dpel?_fields=production", data=b"{}", headers={"Content-Length": "2"})
+        assert response.status_code == 200
+
+    assert [(request.method, str(request.url)) for request in envoy.requests] == [
+        ("GET", "https://envoy.local/production.json?details=1"),
+        ("GET", "https://envoy.local/api/v1/production"),
+        ("GET", "https://envoy.local/info"),
+        ("POST", "https://envoy.local/ivp/ss/dpel"),
+    ]
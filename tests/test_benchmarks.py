@@ -0,0 +1,79 @@
+import json
+import sys
+import time
+from pathlib import Path
+
+import pytest
+from benchmarks import fakes, run
+
+
+def test_percentile():
+    latencies = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+    assert run.percentile(latencies, 0.5) == 0.5
+    assert run.percentile(latencies, 0.99) == 1.0
+    assert run.percentile(latencies, 0.0) == 0.1
+    assert run.percentile([], 0.5) == 0.0
+
+
+def test_compare():
+    baseline = {
+        "results": [
+            {
+                "concurrency": 1,
+                "requests_per_second": 100.0,
+                "latency_p50_seconds": 0.01,
+                "latency_p99_seconds": 0.02,
+                "rss_peak_bytes": 0,
+            }
+        ]
+    }
+    results = [
+        {
+            "concurrency": 1,
+            "requests_per_second": 150.0,
+            "latency_p50_seconds": 0.005,
+            "latency_p99_seconds": 0.03,
+            "rss_peak_bytes": 1000,
+        },
+        {"concurrency": 8},
+    ]
+    # levels that weren't measured before and numbers that were zero are skipped
+    assert run.compare(results, baseline) == [
+        "concurrency 1: requests_per_second +50.0%, latency_p50_seconds -50.0%, latency_p99_seconds +50.0%"
+    ]
+
+
+def test_fake_token():
+    token = fakes.make_token(60)
+    assert time.time() + 55 < fakes.token_expiry(token) <= time.time() + 60
+    assert fakes.token_expiry("not a token") == 0.0
+
+
+@pytest.mark.asyncio
+async def test_fake_envoy():
+    client = fakes.create_app(fakes.FakeSettings()).test_client()
+
+    response = await client.get("/production.json")
+    assert response.status_code == 401
+
+    headers = {"Authorization": f"Bearer {fakes.make_token(60)}"}
+    response = await client.get("/production.json", headers=headers)
+    assert response.status_code == 200
+    assert "production" in await response.get_json()
+
+    response = await client.get("/anything/else", headers=headers)
+    assert response.status_code == 200
+
+
+def test_benchmark(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    # run the whole thing, the fake and the proxy, for as short a time as we can
+    output = tmp_path / "results.json"
+    monkeypatch.setattr(sys, "argv", ["benchmark", "-c", "2", "-d", "0.5", "-w", "0", "-o", str(output)])
+    assert run.main() == 0
+
+    results = json.loads(output.read_text())["results"]
+    assert len(results) == 1
+    assert results[0]["concurrency"] == 2
+    assert results[0]["requests"] > 0
+    assert results[0]["errors"] == 0
+    assert results[0]["latency_p50_seconds"] <= results[0]["latency_p99_seconds"] <= results[0]["latency_max_seconds"]
@@ -0,0 +1,78 @@
+import pytest
+from quart import Quart
+
+from enphase_proxy.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen
+
+
+@pytest.fixture
+def breaker() -> CircuitBreaker:
+    app = Quart(__name__)
+    app.config["BREAKER_WINDOW"] = 4
+    app.config["BREAKER_MIN_REQUESTS"] = 4
+    app.config["BREAKER_ERROR_RATE"] = 0.5
+    app.config["BREAKER_SLOW_SECONDS"] = 10
+    app.config["BREAKER_OPEN_SECONDS"] = 60
+    app.config["BREAKER_TIMEOUT_MIN"] = 1
+    app.config["BREAKER_TIMEOUT_MAX"] = 100
+    return CircuitBreaker(app, "test")
+
+
+def test_opens_on_errors(breaker: CircuitBreaker):
+    for success in [True, True, False]:
+        breaker.record(breaker.allow(), success, 0.1)
+    assert breaker.state == CLOSED
+
+    # slow requests count as failures too
+    breaker.record(breaker.allow(), True, 11)
+    assert breaker.state == OPEN
+
+    with pytest.raises(CircuitOpen) as e:
+        breaker.allow()
+    assert 0 < e.value.retry_after <= 60
+    assert breaker.stats["rejected"] == 1
+    assert breaker.stats["opened"] == 1
+
+
+@pytest.mark.parametrize("success, expected", [(True, CLOSED), (False, OPEN)])
+def test_half_open(breaker: CircuitBreaker, success: bool, expected: str):
+    breaker._open()
+    breaker.opened_at -= 60
+
+    # only one request is let through to see if the envoy is back
+    probe = breaker.allow()
+    assert probe
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.allow()
+
+    breaker.record(probe, success, 0.1)
+    assert breaker.state == expected
+
+
+def test_abandoned_probe(breaker: CircuitBreaker):
+    breaker._open()
+    breaker.opened_at -= 60
+
+    breaker.abandon(breaker.allow())
+    assert breaker.allow()
+
+
+def test_late_results_ignored(breaker: CircuitBreaker):
+    probe = breaker.allow()
+    breaker._open()
+    breaker.record(probe, False, 0.1)
+    assert breaker.state == OPEN
+    assert len(breaker.outcomes) == 0
+
+
+def test_adaptive_timeout(breaker: CircuitBreaker):
+    assert breaker.timeout == 100
+
+    for seconds in [0.1, 0.2, 0.2, 2.0]:
+        breaker.record(breaker.allow(), True, seconds)
+    assert breaker.timeout == 6.0
+
+    breaker.latencies.clear()
+    for _ in range(4):
+        breaker.record(breaker.allow(), True, 0.01)
+    assert breaker.timeout == 1
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+from quart import Quart
+
+from enphase_proxy.cache import MAX_PROJECTIONS, CachedResponse, ResponseCache
+from enphase_proxy.projection import Projection
+
+
+@pytest.fixture
+def cache() -> ResponseCache:
+    app = Quart(__name__)
+    app.config["CACHE_TTLS"] = {"/production.json": 5, "/ivp/meters/*": 1}
+    app.config["CACHE_MAX_ENTRIES"] = 2
+    return ResponseCache(app)
+
+
+def loader(content: bytes, status_code: int = 200):
+    calls = []
+
+    async def load() -> CachedResponse:
+        calls.append(content)
+        await asyncio.sleep(0)
+        return CachedResponse(status_code=status_code, headers={}, content=content)
+
+    return load, calls
+
+
+def test_ttl(cache: ResponseCache):
+    assert cache.ttl("/production.json") == 5
+    assert cache.ttl("/ivp/meters/readings") == 1
+    assert cache.ttl("/inventory.json") is None
+
+
+@pytest.mark.asyncio
+async def test_fetch_hit(cache: ResponseCache):
+    load, calls = loader(b"one")
+    assert (await cache.fetch("GET", "/production.json", 5, load)).content == b"one"
+    assert (await cache.fetch("GET", "/production.json", 5, load)).content == b"one"
+    assert len(calls) == 1
+    assert cache.stats == {"entries": 1, "hits": 1, "misses": 1, "coalesced": 0}
+
+
+@pytest.mark.asyncio
+async def test_fetch_expired(cache: ResponseCache):
+    load, calls = loader(b"one")
+    await cache.fetch("GET", "/production.json", 0, load)
+    await cache.fetch("GET", "/production.json", 0, load)
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_fetch_coalesced(cache: ResponseCache):
+    load, calls = loader(b"one")
+    results = await asyncio.gather(*[cache.fetch("GET", "/production.json", 5, load) for _ in range(10)])
+    assert {result.content for result in results} == {b"one"}
+    assert len(calls) == 1
+    assert cache.stats == {"entries": 1, "hits": 0, "misses": 1, "coalesced": 9}
+
+
+@pytest.mark.asyncio
+async def test_fetch_error_not_cached(cache: ResponseCache):
+    load, calls = loader(b"error", status_code=500)
+    assert (await cache.fetch("GET", "/production.json", 5, load)).status_code == 500
+    assert (await cache.fetch("GET", "/production.json", 5, load)).status_code == 500
+    assert len(calls) == 2
+    assert cache.stats["entries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_fetch_exception_shared(cache: ResponseCache):
+    async def load() -> CachedResponse:
+        await asyncio.sleep(0)
+        raise RuntimeError("envoy is down")
+
+    results = await asyncio.gather(
+        *[cache.fetch("GET", "/production.json", 5, load) for _ in range(3)],
+        return_exceptions=True,
+    )
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert cache.pending == {}
+
+
+@pytest.mark.asyncio
+async def test_eviction(cache: ResponseCache):
+    for destination in ["/a", "/b", "/a", "/c"]:
+        load, _ = loader(destination.encode())
+        await cache.fetch("GET", destination, 5, load)
+
+    # "/b" was the least recently used when "/c" was added
+    assert list(cache.entries) == [("GET", "/a"), ("GET", "/c")]
+
+
+def test_projections_are_bounded():
+    entry = CachedResponse(status_code=200, headers={}, content=b'{"production": [{"wNow": 1}]}')
+    first = Projection("production[0].wNow")
+    assert entry.project(first) == b'{"production[0].wNow":1}'
+    assert entry.project(Projection("production[0].wNow")) is entry.project(first)
+
+    # asking for lots of different fields only keeps the latest few
+    for index in range(100):
+        entry.project(Projection(f"production[0].wNow,field{index}"))
+    assert len(entry.projected) == MAX_PROJECTIONS
+    assert first not in entry.projected
+
+    # and none of them are carried over to the next fetch of the same content
+    refetched = CachedResponse(status_code=200, headers={}, content=entry.content)
+    refetched.inherit(entry)
+    assert not refetched.projected
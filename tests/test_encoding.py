@@ -0,0 +1,55 @@
+import gzip
+
+import pytest
+
+from enphase_proxy.cache import CachedResponse
+from enphase_proxy.encoding import compute_etag, encoder, negotiate
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, expected",
+    [
+        (None, None),
+        ("", None),
+        ("identity", None),
+        ("gzip", "gzip"),
+        ("deflate, gzip;q=0.5", "gzip"),
+        ("gzip;q=0", None),
+        ("*", "gzip"),
+        ("*, gzip;q=0", None),
+        ("GZIP", "gzip"),
+        ("gzip;q=nonsense", None),
+    ],
+)
+def test_negotiate(accept_encoding, expected):
+    assert negotiate(accept_encoding, ["gzip"]) == expected
+
+
+def test_negotiate_preference():
+    assert negotiate("gzip, made-up", ["made-up", "gzip"]) == "gzip"
+    assert encoder("made-up") is None
+
+
+def test_compute_etag():
+    assert compute_etag(b"one") == compute_etag(b"one")
+    assert compute_etag(b"one") != compute_etag(b"two")
+
+
+def test_encode_once():
+    entry = CachedResponse(status_code=200, headers={}, content=b"production" * 100)
+    encoded = entry.encode("gzip")
+    assert gzip.decompress(encoded) == entry.content
+    assert entry.encode("gzip") is encoded
+
+
+def test_inherit():
+    previous = CachedResponse(status_code=200, headers={}, content=b"production" * 100)
+    encoded = previous.encode("gzip")
+
+    same = CachedResponse(status_code=200, headers={}, content=b"production" * 100)
+    same.inherit(previous)
+    assert same.encode("gzip") is encoded
+
+    different = CachedResponse(status_code=200, headers={}, content=b"consumption" * 100)
+    different.inherit(previous)
+    assert different.encoded == {}
@@ -0,0 +1,201 @@
+import json
+import os
+from pathlib import Path
+
+import httpx
+import pytest
+from quart import Quart
+
+from enphase_proxy.cache import CachedResponse
+from enphase_proxy.export import (
+    FORMATS,
+    Exporter,
+    ExportSink,
+    FileExportSink,
+    csv_line,
+    influx_line,
+)
+
+PRODUCTION = {
+    "production": [{"type": "eim", "measurementType": "production", "readingTime": 1700000000, "wNow": 1500.5}],
+    "consumption": [{"type": "eim", "measurementType": "total-consumption", "readingTime": 1700000000, "wNow": 700}],
+}
+
+
+class FakeSink:
+    # a stand-in for an http server that can be taken down
+    def __init__(self) -> None:
+        self.healthy = True
+        self.requests: list[httpx.Request] = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        if not self.healthy:
+            return httpx.Response(503)
+        self.requests.append(request)
+        return httpx.Response(204)
+
+    @property
+    def lines(self) -> list[str]:
+        return [line for request in self.requests for line in request.content.decode().splitlines()]
+
+
+@pytest.fixture
+def sink() -> FakeSink:
+    return FakeSink()
+
+
+def make_exporter(sink: FakeSink, **settings: object) -> Exporter:
+    async def loader(method: str, destination: str) -> CachedResponse:
+        payload = PRODUCTION if destination == "/production.json" else []
+        return CachedResponse(status_code=200, headers={}, content=json.dumps(payload).encode())
+
+    app = Quart(__name__)
+    app.config["EXPORT_URL"] = "http://tsdb.local/write"
+    app.config["EXPORT_HEADERS"] = {"Authorization": "Token secret"}
+    app.config.update({f"EXPORT_{name.upper()}": value for name, value in settings.items()})
+    exporter = Exporter(app, {"111": loader})
+    exporter.sink.client = httpx.AsyncClient(transport=httpx.MockTransport(sink))
+    return exporter
+
+
+def test_lines():
+    assert influx_line("enphase", "my gateway", "production_watts", 1.5, 10.0) == (
+        "enphase,gateway=my\\ gateway production_watts=10.0 1500000000\n"
+    )
+    assert csv_line("enphase", "111", "production_watts", 1.5, 10.0) == "1.5,111,production_watts,10.0\n"
+
+
+@pytest.mark.asyncio
+async def test_export(sink: FakeSink):
+    exporter = make_exporter(sink)
+
+    # the same readings are only taken once
+    await exporter._background_task()
+    await exporter._background_task()
+    assert len(exporter.buffer) == 2
+
+    await exporter.flush()
+    assert exporter.buffer == []
+    assert sorted(sink.lines) == [
+        "enphase,gateway=111 consumption_watts=700.0 1700000000000000000",
+        "enphase,gateway=111 production_watts=1500.5 1700000000000000000",
+    ]
+    assert sink.requests[0].headers["Authorization"] == "Token secret"
+    assert sink.requests[0].headers["Content-Type"] == FORMATS["influx"].content_type
+    assert exporter.stats["exported"] == 2
+
+
+@pytest.mark.asyncio
+async def test_export_batches(sink: FakeSink):
+    exporter = make_exporter(sink, format="csv", batch_size=2)
+    for timestamp in range(5):
+        exporter.add("111", "production_watts", timestamp, 1)
+    assert exporter.flush_requested.is_set()
+
+    await exporter.flush()
+    assert len(sink.requests) == 3
+    assert sink.requests[0].content.decode().splitlines() == [
+        "timestamp,gateway,name,value",
+        "0,111,production_watts,1",
+        "1,111,production_watts,1",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_export_backpressure(sink: FakeSink):
+    exporter = make_exporter(sink, max_buffer=3)
+    sink.healthy = False
+    for timestamp in range(3):
+        exporter.add("111", "production_watts", timestamp, 1)
+    assert not exporter.room.is_set()
+
+    # nothing is thrown away until there is more than the limit
+    await exporter.flush()
+    assert len(exporter.buffer) == 3
+    exporter.add("111", "production_watts", 3, 1)
+    await exporter.flush()
+    assert [line.split()[-1] for line in exporter.buffer] == ["1000000000", "2000000000", "3000000000"]
+    assert exporter.stats["dropped"] == 1
+    assert exporter.stats["failures"] == 2
+
+    sink.healthy = True
+    await exporter.flush()
+    assert exporter.room.is_set()
+    assert len(sink.lines) == 3
+
+
+@pytest.mark.asyncio
+async def test_export_spill(sink: FakeSink, tmp_path: Path):
+    exporter = make_exporter(sink, spill_path=str(tmp_path / "spill"))
+    sink.healthy = False
+    for timestamp in range(2):
+        exporter.add("111", "production_watts", timestamp, 1)
+        await exporter.flush()
+
+    # everything waiting went to disk instead of staying in memory
+    assert exporter.buffer == []
+    assert len(os.listdir(tmp_path / "spill")) == 2
+
+    sink.healthy = True
+    exporter.add("111", "production_watts", 2, 1)
+    await exporter.flush()
+    assert os.listdir(tmp_path / "spill") == []
+    assert [line.split()[-1] for line in sink.lines] == ["0", "1000000000", "2000000000"]
+
+
+@pytest.mark.asyncio
+async def test_export_spill_while_adding(sink: FakeSink, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    exporter = make_exporter(sink, spill_path=str(tmp_path / "spill"))
+    push = exporter.spill.push
+
+    async def slow_push(payload: bytes) -> int:
+        # a reading comes in while the spill is being written
+        exporter.add("111", "production_watts", 1, 1)
+        return await push(payload)
+
+    monkeypatch.setattr(exporter.spill, "push", slow_push)
+    sink.healthy = False
+    exporter.add("111", "production_watts", 0, 1)
+    await exporter.flush()
+
+    # the reading that came in late is still waiting and not lost
+    assert [line.split()[-1] for line in exporter.buffer] == ["1000000000"]
+    assert len(os.listdir(tmp_path / "spill")) == 1
+
+
+@pytest.mark.asyncio
+async def test_export_spill_unreadable(sink: FakeSink, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    exporter = make_exporter(sink, spill_path=str(tmp_path / "spill"))
+
+    async def oldest() -> None:
+        raise PermissionError("spill directory is not readable")
+
+    monkeypatch.setattr(exporter.spill, "oldest", oldest)
+    exporter.add("111", "production_watts", 0, 1)
+
+    # the readings are kept instead of the flush blowing up
+    await exporter.flush()
+    assert sink.requests == []
+    assert exporter.buffer == []
+    assert len(os.listdir(tmp_path / "spill")) == 1
+
+
+@pytest.mark.asyncio
+async def test_base_sink():
+    # the base sink takes everything and keeps nothing
+    sink = ExportSink()
+    await sink.startup()
+    assert await sink.write(b"readings") is None
+    await sink.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_file_sink(tmp_path: Path):
+    path = tmp_path / "readings.csv"
+    sink = FileExportSink(str(path), FORMATS["csv"], max_bytes=64, backups=2)
+    for index in range(4):
+        await sink.write(f"{index},111,production_watts,{'1' * 20}\n".encode())
+
+    assert sorted(os.listdir(tmp_path)) == ["readings.csv", "readings.csv.1", "readings.csv.2"]
+    assert path.read_text().splitlines()[0] == "timestamp,gateway,name,value"
+    assert path.read_text().splitlines()[1].startswith("3,")
@@ -0,0 +1,112 @@
+import json
+from array import array
+
+import pytest
+from quart import Quart
+
+from enphase_proxy.cache import CachedResponse
+from enphase_proxy.history import (
+    History,
+    Series,
+    downsample,
+    parse_meters,
+    parse_production,
+)
+from enphase_proxy.models import ProductionReport, load_meters
+
+PRODUCTION = {
+    "production": [
+        {"type": "inverters", "readingTime": 100, "wNow": 900},
+        {"type": "eim", "measurementType": "production", "readingTime": 101, "wNow": 1000.5},
+    ],
+    "consumption": [
+        {"type": "eim", "measurementType": "total-consumption", "readingTime": 101, "wNow": 400},
+        {"type": "eim", "measurementType": "net-consumption", "readingTime": 101, "wNow": -600.5},
+    ],
+}
+
+METERS = [
+    {"eid": 1, "timestamp": 102, "activePower": 1000.5, "voltage": 240.1, "current": 4.2, "freq": 60.0},
+    {"eid": 2, "timestamp": 102, "activePower": 400},
+]
+
+
+def test_parse_production():
+    assert parse_production(ProductionReport(PRODUCTION)) == {
+        "production_watts": (101.0, 1000.5),
+        "consumption_watts": (101.0, 400.0),
+        "net_consumption_watts": (101.0, -600.5),
+    }
+    assert parse_production(ProductionReport({})) == {}
+
+
+def test_parse_meters():
+    assert parse_meters(load_meters(json.dumps(METERS).encode())) == {
+        "meter_1_watts": (102.0, 1000.5),
+        "meter_1_volts": (102.0, 240.1),
+        "meter_1_amps": (102.0, 4.2),
+        "meter_1_hertz": (102.0, 60.0),
+        "meter_2_watts": (102.0, 400.0),
+    }
+
+
+def test_series_ring():
+    series = Series(4)
+    for timestamp in range(6):
+        assert series.append(timestamp, timestamp * 10)
+
+    # the oldest samples were overwritten and repeats are ignored
+    assert not series.append(5, 99)
+    assert len(series) == 4
+
+    timestamps, values = series.window(0, 100)
+    assert list(timestamps) == [2, 3, 4, 5]
+    assert list(values) == [20, 30, 40, 50]
+
+    timestamps, values = series.window(3, 5)
+    assert list(timestamps) == [3, 4]
+    assert series.window(10, 20) == (array("d"), array("d"))
+
+
+def test_downsample():
+    series = Series(100)
+    for timestamp in range(10):
+        series.append(timestamp, timestamp)
+
+    assert downsample(*series.window(0, 10), 5) == [(0, 0, 4, 2), (5, 5, 9, 7)]
+    assert downsample(*series.window(2, 4), 1) == [(2, 2, 2, 2), (3, 3, 3, 3)]
+
+
+@pytest.mark.asyncio
+async def test_sample():
+    responses = {
+        "/production.json": CachedResponse(200, {}, b'{"production": [{"type": "inverters", "wNow": 5}]}'),
+        "/ivp/meters/readings": CachedResponse(500, {}, b""),
+    }
+
+    async def loader(method: str, destination: str) -> CachedResponse:
+        return responses[destination]
+
+    app = Quart(__name__)
+    app.config["HISTORY_INTERVAL"] = 1
+    app.config["HISTORY_RETENTION"] = 60
+    history = History(app, loader)
+    await history._background_task()
+
+    assert history.stats == {"series": 1, "samples": 1, "capacity": 60}
+    result = history.query()
+    assert list(result["series"]) == ["production_watts"]
+    assert result["series"]["production_watts"][0][1:] == (5, 5, 5)
+
+
+def test_query_resolution():
+    history = History()
+    history.history_max_points = 10
+    for timestamp in range(1000):
+        history.record("watts", timestamp, timestamp)
+
+    # asking for too many points gets bigger buckets instead
+    result = history.query(["watts", "missing"], start=0, end=1000, resolution=1)
+    assert result["resolution"] == 100
+    assert len(result["series"]["watts"]) == 10
+    assert "missing" not in result["series"]
@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+from quart import Quart
+
+from enphase_proxy.limiter import UpstreamLimiter, UpstreamOverloaded
+from enphase_proxy.ratelimit import CLIENT
+
+
+@pytest.fixture
+def limiter() -> UpstreamLimiter:
+    app = Quart(__name__)
+    app.config["LIMITER_MAX_IN_FLIGHT"] = 1
+    app.config["LIMITER_MAX_QUEUED"] = 2
+    app.config["LIMITER_QUEUE_TIMEOUT"] = 0.1
+    app.config["LIMITER_RETRY_AFTER"] = 7
+    app.config["LIMITER_PRIORITIES"] = {"/production.json": 0, "/inventory.json": 2}
+    return UpstreamLimiter(app)
+
+
+def test_priority(limiter: UpstreamLimiter):
+    assert limiter.priority("/production.json?details=1") == 0
+    assert limiter.priority("/ivp/meters/readings") == 1
+    assert limiter.priority("/inventory.json") == 2
+
+
+@pytest.mark.asyncio
+async def test_acquire_and_release(limiter: UpstreamLimiter):
+    async with limiter.slot("/production.json"):
+        assert limiter.in_flight == 1
+    assert limiter.in_flight == 0
+    assert limiter.stats["admitted"] == 1
+
+
+@pytest.mark.asyncio
+async def test_priority_order(limiter: UpstreamLimiter):
+    order = []
+
+    async def request(destination: str) -> None:
+        async with limiter.slot(destination):
+            order.append(destination)
+
+    await limiter.acquire("/first")
+    tasks = [asyncio.create_task(request(destination)) for destination in ["/inventory.json", "/production.json"]]
+    await asyncio.sleep(0)
+    assert limiter.queued == 2
+
+    limiter.release()
+    await asyncio.gather(*tasks)
+    assert order == ["/production.json", "/inventory.json"]
+    assert limiter.in_flight == 0
+    assert limiter.queued == 0
+
+
+@pytest.mark.asyncio
+async def test_clients_take_turns(limiter: UpstreamLimiter):
+    limiter.max_queued = 4
+    order = []
+
+    async def request(client: str, index: int) -> None:
+        CLIENT.set(client)
+        async with limiter.slot("/ivp/meters/readings"):
+            order.append((client, index))
+
+    await limiter.acquire("/first")
+    tasks = [asyncio.create_task(request("busy", index)) for index in range(3)]
+    tasks.append(asyncio.create_task(request("quiet", 0)))
+    await asyncio.sleep(0)
+    assert limiter.queued == 4
+
+    # the quiet client doesn't wait behind everything the busy one sent
+    limiter.release()
+    await asyncio.gather(*tasks)
+    assert order == [("busy", 0), ("quiet", 0), ("busy", 1), ("busy", 2)]
+    assert not limiter.turns
+
+
+@pytest.mark.asyncio
+async def test_queue_full(limiter: UpstreamLimiter):
+    await limiter.acquire("/first")
+    tasks = [asyncio.create_task(limiter.acquire("/waiting")) for _ in range(2)]
+    await asyncio.sleep(0)
+
+    with pytest.raises(UpstreamOverloaded) as e:
+        await limiter.acquire("/rejected")
+    assert e.value.retry_after == 7
+    assert limiter.stats["rejected"] == 1
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_queue_timeout(limiter: UpstreamLimiter):
+    await limiter.acquire("/first")
+    with pytest.raises(UpstreamOverloaded):
+        await limiter.acquire("/expired")
+    assert limiter.stats["expired"] == 1
+    assert limiter.queued == 0
+
+    # the expired waiter must not be handed the slot
+    limiter.release()
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter(limiter: UpstreamLimiter):
+    await limiter.acquire("/first")
+    task = asyncio.create_task(limiter.acquire("/cancelled"))
+    await asyncio.sleep(0)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    limiter.release()
+    assert limiter.in_flight == 0
+    assert limiter.queued == 0
@@ -0,0 +1,106 @@
+import pytest
+
+from enphase_proxy.metrics import (
+    UPSTREAM_PHASES,
+    Counter,
+    Gauge,
+    Histogram,
+    Registry,
+    UpstreamTracer,
+    timed,
+)
+
+
+@pytest.fixture
+def registry() -> Registry:
+    return Registry()
+
+
+def test_counter(registry: Registry):
+    counter = registry.register(Counter("test_total", "A test counter.", ("path", "status")))
+    counter.labels("/production.json", "200").inc()
+    counter.labels("/production.json", "200").inc(2)
+    counter.labels('/weird"path', "500").inc()
+
+    assert registry.render() == (
+        "# HELP test_total A test counter.\n"
+        "# TYPE test_total counter\n"
+        'test_total{path="/production.json",status="200"} 3\n'
+        'test_total{path="/weird\\"path",status="500"} 1\n'
+    )
+
+
+def test_counter_wrong_labels(registry: Registry):
+    counter = registry.register(Counter("test_total", "A test counter.", ("path",)))
+    with pytest.raises(ValueError):
+        counter.labels("/production.json", "200")
+
+
+def test_histogram(registry: Registry):
+    histogram = registry.register(Histogram("test_seconds", "A test histogram.", buckets=(0.1, 1.0)))
+    for value in [0.05, 0.1, 0.5, 5.0]:
+        histogram.observe(value)
+
+    assert registry.render() == (
+        "# HELP test_seconds A test histogram.\n"
+        "# TYPE test_seconds histogram\n"
+        'test_seconds_bucket{le="0.1"} 2\n'
+        'test_seconds_bucket{le="1"} 3\n'
+        'test_seconds_bucket{le="+Inf"} 4\n'
+        "test_seconds_sum 5.65\n"
+        "test_seconds_count 4\n"
+    )
+
+
+def test_gauge(registry: Registry):
+    value = None
+    registry.register(Gauge("test_gauge", "A test gauge.", lambda: value))
+    assert registry.render() == "\n"
+
+    value = 1.5
+    assert registry.render() == "# HELP test_gauge A test gauge.\n# TYPE test_gauge gauge\ntest_gauge 1.5\n"
+
+    # gauges are read from their function so they have no children to label
+    assert not hasattr(Gauge("test_gauge", "A test gauge.", lambda: 1), "labels")
+
+
+def test_register_replaces(registry: Registry):
+    registry.register(Gauge("test_gauge", "A test gauge.", lambda: 1))
+    registry.register(Gauge("test_gauge", "A test gauge.", lambda: 2))
+    assert registry.render().endswith("test_gauge 2\n")
+
+
+def test_timed():
+    counter = Counter("test_total", "A test counter.", ("result",))
+    histogram = Histogram("test_seconds", "A test histogram.")
+
+    with timed(counter, histogram):
+        pass
+
+    with pytest.raises(RuntimeError), timed(counter, histogram):
+        raise RuntimeError()
+
+    assert counter.labels("success").value == 1
+    assert counter.labels("failure").value == 1
+    assert sum(histogram.labels().counts) == 2
+
+
+@pytest.mark.asyncio
+async def test_tracer():
+    before = {phase: sum(UPSTREAM_PHASES.labels(phase).counts) for phase in ["connect", "tls", "ttfb", "body"]}
+
+    tracer = UpstreamTracer()
+    for event in [
+        "connection.connect_tcp.started",
+        "connection.connect_tcp.complete",
+        "connection.start_tls.started",
+        "connection.start_tls.complete",
+        "http11.send_request_headers.started",
+        "http11.receive_response_headers.complete",
+        "http11.receive_response_body.started",
+        "http11.receive_response_body.complete",
+    ]:
+        await tracer(event, {})
+
+    for phase, count in before.items():
+        assert sum(UPSTREAM_PHASES.labels(phase).counts) == count + 1
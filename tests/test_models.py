@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+from enphase_proxy.cache import CachedResponse
+from enphase_proxy.models import ProductionReport, load_meters
+
+PRODUCTION = {
+    "production": [
+        {"type": "eim", "measurementType": "production", "readingTime": 101, "wNow": 1000.5, "whToday": 12500},
+        {"type": "inverters", "readingTime": 100, "wNow": 900},
+    ],
+    "consumption": [
+        {"type": "eim", "measurementType": "total-consumption", "readingTime": 102, "wNow": 400},
+        {"type": "eim", "measurementType": "net-consumption", "readingTime": 102, "wNow": -600.5},
+    ],
+    "storage": [{"type": "acb", "activeCount": 1, "readingTime": 0, "wNow": -200, "percentFull": 85}],
+}
+
+
+def test_production_summary():
+    assert ProductionReport(PRODUCTION).summary == {
+        "reading_time": 102.0,
+        "production_watts": 1000.5,
+        "consumption_watts": 400.0,
+        "net_consumption_watts": -600.5,
+        "production_today_kwh": 12.5,
+        "battery_percent": 85.0,
+        "battery_watts": -200.0,
+    }
+
+    # without meters there are only the inverters
+    summary = ProductionReport({"production": [PRODUCTION["production"][1]]}).summary
+    assert summary["production_watts"] == 900
+    assert summary["consumption_watts"] is None
+    assert summary["production_today_kwh"] is None
+
+
+def test_production_invalid():
+    with pytest.raises(ValueError):
+        ProductionReport.from_content(b"[]")
+    with pytest.raises(ValueError):
+        ProductionReport.from_content(b"<html>")
+
+
+def test_parse_once():
+    entry = CachedResponse(status_code=200, headers={}, content=json.dumps(PRODUCTION).encode())
+    report = entry.parse(ProductionReport.from_content)
+    assert entry.parse(ProductionReport.from_content) is report
+
+    # a new response with the same content keeps what was read from the old one
+    again = CachedResponse(status_code=200, headers={}, content=entry.content)
+    again.inherit(entry)
+    assert again.parse(ProductionReport.from_content) is report
+
+
+def test_meters():
+    meters = load_meters(b'[{"eid": 1, "timestamp": 5, "activePower": 10, "freq": 60}]')
+    assert [(meter.eid, meter.timestamp, meter.watts, meter.volts, meter.hertz) for meter in meters] == [
+        (1, 5.0, 10.0, None, 60.0)
+    ]
@@ -0,0 +1,67 @@
+import pytest
+from quart import Quart
+
+from enphase_proxy.cache import CachedResponse
+from enphase_proxy.poller import SnapshotPoller, normalize
+
+
+class FakeLoader:
+    def __init__(self) -> None:
+        self.status_code = 200
+        self.calls: list[str] = []
+
+    async def __call__(self, method: str, destination: str) -> CachedResponse:
+        self.calls.append(destination)
+        if self.status_code is None:
+            raise RuntimeError("envoy is down")
+        return CachedResponse(status_code=self.status_code, headers={}, content=f"{len(self.calls)}".encode())
+
+
+@pytest.fixture
+def loader() -> FakeLoader:
+    return FakeLoader()
+
+
+@pytest.fixture
+def poller(loader: FakeLoader) -> SnapshotPoller:
+    app = Quart(__name__)
+    app.config["POLLER_PATHS"] = ["/production.json", "/api/v1/production?b=2&a=1"]
+    app.config["POLLER_INTERVAL"] = 10
+    return SnapshotPoller(app, loader)
+
+
+def test_normalize():
+    assert normalize("/production.json") == "/production.json"
+    assert normalize("/production.json?details=1&b=2&a=") == "/production.json?a=&b=2&details=1"
+
+
+def test_init(poller: SnapshotPoller):
+    assert poller.poller_paths == ["/production.json", "/api/v1/production?a=1&b=2"]
+    assert poller.poller_refresh == 10
+    assert poller.get("/production.json") is None
+
+
+@pytest.mark.asyncio
+async def test_background_task(poller: SnapshotPoller, loader: FakeLoader):
+    await poller._background_task()
+    assert sorted(loader.calls) == ["/api/v1/production?a=1&b=2", "/production.json"]
+    assert poller.get("/production.json").status_code == 200
+    assert poller.get("/api/v1/production?a=1&b=2").status_code == 200
+
+
+@pytest.mark.parametrize("status_code", [500, None])
+@pytest.mark.asyncio
+async def test_background_task_keeps_stale_snapshot(poller: SnapshotPoller, loader: FakeLoader, status_code):
+    await poller._background_task()
+    snapshot = poller.get("/production.json")
+
+    loader.status_code = status_code
+    await poller._background_task()
+    assert poller.get("/production.json") is snapshot
+
+
+@pytest.mark.asyncio
+async def test_background_looper_stops(poller: SnapshotPoller, loader: FakeLoader):
+    poller.poller_canceled.set()
+    await poller._background_looper()
+    assert len(loader.calls) == 2
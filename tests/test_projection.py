@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+from enphase_proxy.projection import InvalidProjection, Projection, projection_for
+
+PRODUCTION = json.dumps(
+    {
+        "production": [{"type": "inverters", "wNow": 1500, "activeCount": 20}],
+        "consumption": [
+            {"measurementType": "total-consumption", "wNow": 900},
+            {"measurementType": "net-consumption", "wNow": -600},
+        ],
+    }
+).encode()
+
+
+def test_projection():
+    projection = Projection("production[0].wNow, consumption[*].wNow,consumption[-1].measurementType")
+    assert json.loads(projection(PRODUCTION)) == {
+        "production[0].wNow": 1500,
+        "consumption[*].wNow": [900, -600],
+        "consumption[-1].measurementType": "net-consumption",
+    }
+
+
+def test_projection_missing():
+    # anything that isn't there is null
+    projection = Projection("production[3].wNow,storage[*].wNow,production.wNow,production[0].wNow.value")
+    assert set(json.loads(projection(PRODUCTION)).values()) == {None}
+
+
+def test_projection_of_list():
+    projection = Projection("[*].eid,[0].activePower")
+    meters = json.dumps([{"eid": 1, "activePower": 10}, {"eid": 2, "activePower": 20}]).encode()
+    assert json.loads(projection(meters)) == {"[*].eid": [1, 2], "[0].activePower": 10}
+
+
+@pytest.mark.parametrize(
+    "fields", ["", ",", "production..wNow", "production[x]", "production[0]wNow", "wNow.", "x" * 2000]
+)
+def test_invalid_projection(fields: str):
+    with pytest.raises(InvalidProjection):
+        projection_for(fields)
+
+
+def test_projection_for():
+    assert projection_for(None) is None
+    assert projection_for("production[0].wNow") is projection_for("production[0].wNow")
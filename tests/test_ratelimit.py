@@ -0,0 +1,102 @@
+import pytest
+from quart import Quart
+
+from enphase_proxy.ratelimit import RateLimit, RateLimited, RateLimiter
+
+
+@pytest.fixture
+def rate_limiter() -> RateLimiter:
+    app = Quart(__name__)
+    app.config["RATE_LIMITS"] = [
+        {"path": "/inventory.json", "rate": 0.5, "burst": 2, "clients": ["dashboard"]},
+        {"path": "/inventory.json", "rate": 0.1},
+    ]
+    app.config["RATE_LIMIT_MAX_CLIENTS"] = 2
+    return RateLimiter(app)
+
+
+def test_bucket():
+    limit = RateLimit({"rate": 2, "burst": 3})
+    assert limit.pattern == "*"
+
+    # a full bucket lets a burst through and then one every half second
+    assert [limit.take("client", 10.0) for _ in range(3)] == [0, 0, 0]
+    assert limit.take("client", 10.0) == pytest.approx(0.5)
+    assert limit.take("client", 10.5) == 0
+    assert limit.take("client", 10.5) == pytest.approx(0.5)
+
+    # other clients have their own buckets
+    assert limit.take("other", 10.5) == 0
+
+    # nothing is remembered about a client once its bucket is full again
+    assert limit.evict(11.0, 10) == 0
+    assert limit.evict(12.0, 10) == 2
+    assert not limit.buckets
+
+
+def test_rate_limit_must_be_positive():
+    with pytest.raises(ValueError):
+        RateLimit({"rate": 0})
+
+
+def test_check(rate_limiter: RateLimiter):
+    # other paths aren't limited at all
+    for _ in range(10):
+        rate_limiter.check("/production.json", "client", 0.0)
+
+    rate_limiter.check("/inventory.json", "client", 0.0)
+    with pytest.raises(RateLimited) as e:
+        rate_limiter.check("/inventory.json", "client", 1.0)
+    assert e.value.retry_after == 9
+
+    # some clients are allowed more
+    for now in (0.0, 0.0, 2.0):
+        rate_limiter.check("/inventory.json", "dashboard", now)
+    with pytest.raises(RateLimited):
+        rate_limiter.check("/inventory.json", "dashboard", 2.0)
+
+    assert rate_limiter.stats == {"clients": 2, "allowed": 4, "limited": 2, "evicted": 0}
+
+
+def test_check_combines_limits():
+    app = Quart(__name__)
+    app.config["RATE_LIMITS"] = [{"path": "/inventory.json", "rate": 1, "burst": 5}, {"rate": 1, "burst": 2}]
+    rate_limiter = RateLimiter(app)
+
+    # every limit that matches applies so the tighter one wins
+    for _ in range(2):
+        rate_limiter.check("/inventory.json", "client", 0.0)
+    with pytest.raises(RateLimited) as e:
+        rate_limiter.check("/inventory.json", "client", 0.0)
+    assert str(e.value) == "too many requests for *"
+
+    # a request that is turned away doesn't count against any of them
+    assert rate_limiter.limits[0].buckets["client"] == 2.0
+    with pytest.raises(RateLimited):
+        rate_limiter.check("/production.json", "client", 0.0)
+
+
+def test_check_forgets_clients(rate_limiter: RateLimiter):
+    for client in ("first", "second", "third", "fourth"):
+        rate_limiter.check("/inventory.json", client, 0.0)
+
+    # only the clients that were seen most recently are kept
+    assert list(rate_limiter.limits[1].buckets) == ["third", "fourth"]
+    assert rate_limiter.stats["evicted"] == 2
+
+    # and the first client is treated as if we had never seen it
+    rate_limiter.check("/inventory.json", "first", 1.0)
+
+
+@pytest.mark.asyncio
+async def test_identify():
+    app = Quart(__name__)
+    app.config["RATE_LIMIT_CLIENT"] = ["header:X-Api-Key", "forwarded", "ip"]
+    rate_limiter = RateLimiter(app)
+
+    async with app.test_request_context("/", headers={"X-Api-Key": "secret", "X-Forwarded-For": "10.0.0.1, 10.0.0.2"}):
+        assert rate_limiter.identify() == "secret"
+    async with app.test_request_context("/", headers={"X-Forwarded-For": "10.0.0.1, 10.0.0.2"}):
+        assert rate_limiter.identify() == "10.0.0.1"
+    async with app.test_request_context("/"):
+        assert rate_limiter.identify() == "unknown"
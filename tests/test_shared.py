@@ -0,0 +1,114 @@
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+from quart import Quart
+
+from enphase_proxy.cache import CachedResponse
+from enphase_proxy.poller import SnapshotPoller
+from enphase_proxy.shared import SharedCache
+
+
+def make_shared(path: Path) -> SharedCache:
+    app = Quart(__name__)
+    app.config["SHARED_CACHE_PATH"] = str(path)
+    app.config["SHARED_CACHE_SLOTS"] = 4
+    app.config["SHARED_CACHE_SLOT_SIZE"] = 1024
+    shared = SharedCache(app)
+    shared.attach()
+    return shared
+
+
+@pytest.fixture
+def workers(tmp_path: Path) -> Iterator[tuple[SharedCache, SharedCache]]:
+    # each of these stands in for a different worker process
+    first, second = make_shared(tmp_path / "cache"), make_shared(tmp_path / "cache")
+    yield first, second
+    first.detach()
+    second.detach()
+
+
+def test_disabled():
+    shared = SharedCache(Quart(__name__))
+    assert not shared.enabled
+    assert not shared.elect()
+    assert shared.get("default:/production.json") is None
+
+
+def test_election(workers: tuple[SharedCache, SharedCache]):
+    first, second = workers
+    assert first.elect()
+    assert first.elect()
+    assert not second.elect()
+
+    # the leader goes away and someone else takes over
+    first.detach()
+    assert second.elect()
+
+
+def test_publish(workers: tuple[SharedCache, SharedCache]):
+    first, second = workers
+    assert second.get("default:/production.json") is None
+
+    entry = CachedResponse(status_code=200, headers={"content-type": "application/json"}, content=b'{"a": 1}')
+    assert first.publish("default:/production.json", entry)
+
+    shared = second.get("default:/production.json")
+    assert shared == CachedResponse(200, {"content-type": "application/json"}, b'{"a": 1}', shared.fetched_at)
+    assert shared.age < 1
+
+    # nothing changed so the same response is given back
+    assert second.get("default:/production.json") is shared
+    assert second.get("other:/production.json") is None
+
+    entry = CachedResponse(status_code=200, headers={}, content=b'{"a": 2}')
+    assert first.publish("default:/production.json", entry)
+    assert second.get("default:/production.json").content == b'{"a": 2}'
+
+
+def test_publish_oversized(workers: tuple[SharedCache, SharedCache]):
+    first, second = workers
+    assert first.publish("default:/production.json", CachedResponse(status_code=200, headers={}, content=b"old"))
+    assert second.get("default:/production.json").content == b"old"
+
+    # the new response doesn't fit so the old one mustn't be handed out anymore
+    big = CachedResponse(status_code=200, headers={}, content=b"x" * 1024)
+    assert not first.publish("default:/production.json", big)
+    assert first.get("default:/production.json") is None
+    assert second.get("default:/production.json") is None
+
+    # and it can be shared again once it fits
+    assert first.publish("default:/production.json", CachedResponse(status_code=200, headers={}, content=b"new"))
+    assert second.get("default:/production.json").content == b"new"
+
+
+def test_publish_limits(workers: tuple[SharedCache, SharedCache]):
+    first, second = workers
+    assert not first.publish("big", CachedResponse(status_code=200, headers={}, content=b"x" * 1024))
+    assert first.stats["oversized"] == 1
+
+    # there are only four slots
+    for index in range(4):
+        assert first.publish(f"path{index}", CachedResponse(status_code=200, headers={}, content=b"x"))
+    assert not first.publish("path4", CachedResponse(status_code=200, headers={}, content=b"x"))
+    assert [second.get(f"path{index}").content for index in range(4)] == [b"x"] * 4
+
+
+@pytest.mark.asyncio
+async def test_poller_followers(workers: tuple[SharedCache, SharedCache]):
+    calls = []
+
+    async def loader(method: str, destination: str) -> CachedResponse:
+        calls.append(destination)
+        return CachedResponse(status_code=200, headers={}, content=b"reading")
+
+    app = Quart(__name__)
+    app.config["POLLER_PATHS"] = ["/production.json"]
+    leader, follower = [SnapshotPoller(app, loader, shared, "111") for shared in workers]
+
+    # only the leader asks the envoy and the follower gets what it got
+    await leader._background_task()
+    await follower._background_task()
+    assert calls == ["/production.json"]
+    assert follower.get("/production.json").content == b"reading"
+    assert follower.snapshots == {}
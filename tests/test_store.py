@@ -0,0 +1,115 @@
+import asyncio
+import os
+import stat
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from enphase_proxy.store import FetchedCredentials, FileTokenStore
+from enphase_proxy.updater import CredentialsManager
+
+
+@pytest.fixture
+def store(tmp_path) -> FileTokenStore:
+    return FileTokenStore(str(tmp_path / "credentials.json"))
+
+
+@pytest.fixture
+def credentials() -> FetchedCredentials:
+    return FetchedCredentials(  # noqa: S106
+        fetched_at=datetime.now().replace(microsecond=0),
+        expires_at=datetime.now().replace(microsecond=0) + timedelta(hours=1),
+        token="stored_token",  # noqa: S106
+    )
+
+
+@pytest.mark.asyncio
+async def test_load_missing(store: FileTokenStore):
+    assert await store.load() is None
+
+
+@pytest.mark.asyncio
+async def test_load_unreadable(store: FileTokenStore):
+    with open(store.path, "w") as f:
+        f.write("{not json")
+    assert await store.load() is None
+
+
+@pytest.mark.asyncio
+async def test_save_and_load(store: FileTokenStore, credentials: FetchedCredentials, tmp_path):
+    await store.save(credentials)
+    assert await store.load() == credentials
+
+    # only the credentials file is left behind and only we can read it
+    assert sorted(os.listdir(tmp_path)) == ["credentials.json"]
+    assert stat.S_IMODE(os.stat(store.path).st_mode) == 0o600
+
+
+@pytest.mark.asyncio
+async def test_lock(store: FileTokenStore):
+    events = []
+
+    async def hold(name: str) -> None:
+        async with store.lock():
+            events.append(f"{name} start")
+            await asyncio.sleep(0.05)
+            events.append(f"{name} end")
+
+    await asyncio.gather(hold("a"), hold("b"))
+    assert events in (
+        ["a start", "a end", "b start", "b end"],
+        ["b start", "b end", "a start", "a end"],
+    )
+
+
+@patch.object(CredentialsManager, "_fetch_credentials")
+@pytest.mark.asyncio
+async def test_manager_uses_stored_credentials(
+    mock_fetch_credentials: MagicMock, store: FileTokenStore, credentials: FetchedCredentials
+):
+    await store.save(credentials)
+    manager = CredentialsManager(store=store)
+    assert await manager.credentials == "stored_token"
+    mock_fetch_credentials.assert_not_called()
+
+
+@patch.object(CredentialsManager, "_fetch_credentials")
+@pytest.mark.asyncio
+async def test_manager_saves_fetched_credentials(
+    mock_fetch_credentials: MagicMock, store: FileTokenStore, credentials: FetchedCredentials
+):
+    await store.save(credentials)
+    mock_fetch_credentials.return_value = FetchedCredentials(  # noqa: S106
+        fetched_at=datetime.now().replace(microsecond=0) + timedelta(seconds=1),
+        expires_at=datetime.now().replace(microsecond=0) + timedelta(hours=2),
+        token="new_token",  # noqa: S106
+    )
+
+    # the stored token was rejected so it must not be reused
+    manager = CredentialsManager(store=store)
+    manager.data = credentials
+    assert await manager.renew("stored_token") == "new_token"
+    mock_fetch_credentials.assert_called_once()
+    assert (await store.load()).token == "new_token"  # noqa: S105
+
+
+@patch.object(CredentialsManager, "_fetch_credentials")
+@pytest.mark.asyncio
+async def test_manager_ignores_expired_stored_credentials(mock_fetch_credentials: MagicMock, store: FileTokenStore):
+    await store.save(
+        FetchedCredentials(  # noqa: S106
+            fetched_at=datetime.now() - timedelta(hours=2),
+            expires_at=datetime.now() - timedelta(hours=1),
+            token="expired_token",  # noqa: S106
+        )
+    )
+    mock_fetch_credentials.return_value = FetchedCredentials(  # noqa: S106
+        fetched_at=datetime.now(),
+        expires_at=datetime.now() + timedelta(hours=1),
+        token="new_token",  # noqa: S106
+    )
+
+    manager = CredentialsManager(store=store)
+    assert await manager.credentials == "new_token"
+    mock_fetch_credentials.assert_called_once()
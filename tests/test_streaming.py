@@ -0,0 +1,99 @@
+import asyncio
+
+import httpx
+import pytest
+from quart import Quart
+
+from enphase_proxy.streaming import MeterStream, parse_records
+
+
+class FakeFeed:
+    def __init__(self, *chunks: bytes, failures: int = 0) -> None:
+        self.chunks = chunks
+        self.failures = failures
+        self.opened = 0
+
+    async def __call__(self, path: str) -> httpx.Response:
+        self.opened += 1
+        if self.opened <= self.failures:
+            raise httpx.ConnectError("envoy is down")
+
+        async def content():
+            for chunk in self.chunks:
+                yield chunk
+            # then stay open like the real thing
+            await asyncio.Event().wait()
+
+        return httpx.Response(200, content=content(), request=httpx.Request("GET", f"https://envoy.local{path}"))
+
+
+def make_stream(feed: FakeFeed, queue_size: int = 16) -> MeterStream:
+    app = Quart(__name__)
+    app.config["STREAM_QUEUE_SIZE"] = queue_size
+    app.config["STREAM_BACKOFF_MIN"] = 0.01
+    app.config["STREAM_BACKOFF_MAX"] = 0.01
+    return MeterStream(app, feed)
+
+
+def test_parse_records():
+    buffer = bytearray()
+    assert parse_records(buffer, b'data: {"a": 1}\n\ndata: {"b"') == [b'{"a": 1}']
+    assert parse_records(buffer, b": 2}\n") == [b'{"b": 2}']
+    assert parse_records(buffer, b'event: ping\n{"c": 3}\n') == [b'{"c": 3}']
+    assert buffer == bytearray()
+
+
+@pytest.mark.asyncio
+async def test_subscribe():
+    feed = FakeFeed(b'data: {"a": 1}\n', b'data: {"a": 2}\n')
+    stream = make_stream(feed)
+
+    async def receive(count: int) -> list[bytes]:
+        records = []
+        async with stream.subscribe() as subscription:
+            async for record in subscription:
+                records.append(record)
+                if len(records) == count:
+                    break
+        return records
+
+    results = await asyncio.gather(receive(2), receive(2), receive(2))
+    assert results == [[b'{"a": 1}', b'{"a": 2}']] * 3
+
+    # everyone shared one connection and it was closed when they all left
+    assert feed.opened == 1
+    assert stream.reader is None
+    assert stream.subscribers == set()
+
+
+@pytest.mark.asyncio
+async def test_reconnect():
+    feed = FakeFeed(b'data: {"a": 1}\n', failures=2)
+    stream = make_stream(feed)
+
+    async with stream.subscribe() as subscription:
+        async for record in subscription:
+            assert record == b'{"a": 1}'
+            break
+
+    assert feed.opened == 3
+    assert stream.stats["connections"] == 1
+
+
+@pytest.mark.asyncio
+async def test_slow_client_dropped():
+    stream = make_stream(FakeFeed(), queue_size=2)
+
+    async with stream.subscribe() as slow, stream.subscribe() as fast:
+        for index in range(3):
+            stream.broadcast(f"{index}".encode())
+            if index < 2:
+                assert await fast.queue.get() == f"{index}".encode()
+
+        assert slow.closed
+        assert not fast.closed
+        assert stream.subscribers == {fast}
+        assert stream.stats["dropped"] == 1
+
+        # the slow client is disconnected right away
+        assert [record async for record in slow] == []
@@ -3,7 +3,7 @@ import os
 import pytest
 from quart import Quart
 
-from enphase_proxy.tools import load_configuration
+from enphase_proxy.tools import GatewayConfiguration, load_configuration, load_gateways
 
 
 @pytest.fixture
@@ -53,3 +53,46 @@ def test_load_configuration_with_path():
     result = load_configuration(app, path="../src/configurations", environment="production")
     assert result == "production"
     assert app.config["ENVIRONMENT"] == "production"
+
+
+def test_load_gateways_default():
+    app = Quart(__name__)
+    app.config["LOCAL_API_URL"] = "https://envoy.local/"
+    assert load_gateways(app) == [GatewayConfiguration(name="default", url="https://envoy.local/")]
+
+    app.config["REMOTE_API_SERIALNO"] = "111"
+    assert load_gateways(app)[0].name == "111"
+
+    # serial numbers from the environment are read as json numbers
+    app.config["REMOTE_API_SERIALNO"] = 222
+    assert load_gateways(app)[0].name == "222"
+
+
+def test_load_gateways():
+    app = Quart(__name__)
+    app.config["REMOTE_API_TOKEN_STORE"] = "/tmp/{serial}.json"  # noqa: S105, S108
+    app.config["GATEWAYS"] = [
+        {"serial": 111, "url": "https://envoy-1.local/"},
+        {"serial": "222", "url": "https://envoy-2.local/", "jwt": "jwt_2"},
+    ]
+
+    gateways = load_gateways(app)
+    assert [gateway.name for gateway in gateways] == ["111", "222"]
+    assert [gateway.token_store for gateway in gateways] == ["/tmp/111.json", "/tmp/222.json"]  # noqa: S108
+    assert gateways[1].jwt == "jwt_2"
+
+
+def test_load_gateways_invalid():
+    app = Quart(__name__)
+    app.config["REMOTE_API_TOKEN_STORE"] = "/tmp/credentials.json"  # noqa: S105, S108
+    app.config["GATEWAYS"] = [
+        {"serial": "111", "url": "https://envoy-1.local/"},
+        {"serial": "222", "url": "https://envoy-2.local/"},
+    ]
+    with pytest.raises(ValueError):
+        load_gateways(app)
+
+    del app.config["REMOTE_API_TOKEN_STORE"]
+    app.config["GATEWAYS"][1]["serial"] = "111"
+    with pytest.raises(ValueError):
+        load_gateways(app)
@@ -0,0 +1,84 @@
+import json
+import logging
+
+import pytest
+from quart import Quart
+
+from enphase_proxy.metrics import UpstreamTracer
+from enphase_proxy.tracing import CURRENT, RequestTracer, Timing, record
+
+
+def test_timing_header():
+    timing = Timing()
+    timing.add("envoy", 0.25)
+    timing.add("envoy", 0.25)
+    timing.add("body", 0.001)
+
+    phases = timing.header().split(", ")
+    assert phases[:2] == ["envoy;dur=500.0", "body;dur=1.0"]
+    assert phases[2].startswith("total;dur=")
+
+
+@pytest.mark.asyncio
+async def test_record_from_upstream():
+    # nothing happens when no request is being timed
+    record("envoy", 1)
+
+    timing = Timing()
+    token = CURRENT.set(timing)
+    try:
+        tracer = UpstreamTracer()
+        for event in [
+            "connection.connect_tcp.started",
+            "connection.connect_tcp.complete",
+            "http11.send_request_headers.started",
+            "http11.receive_response_headers.complete",
+        ]:
+            await tracer(event, {})
+    finally:
+        CURRENT.reset(token)
+
+    assert set(timing.phases) == {"connect", "envoy"}
+
+
+@pytest.mark.parametrize("sample_rate, spans", [(0, 0), (1, 1)])
+@pytest.mark.asyncio
+async def test_request_spans(caplog: pytest.LogCaptureFixture, sample_rate: float, spans: int):
+    app = Quart(__name__)
+    app.config["TRACING_EXPORTER"] = "log"
+    app.config["TRACING_SAMPLE_RATE"] = sample_rate
+    app.config["TRACING_SERVER_TIMING"] = True
+    RequestTracer(app)
+
+    @app.route("/")
+    async def index() -> str:
+        record("envoy", 0.1)
+        return "ok"
+
+    traceparent = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+    with caplog.at_level(logging.INFO, logger="enphase_proxy.tracing"):
+        response = await app.test_client().get("/", headers={"traceparent": traceparent})
+    assert "envoy;dur=100.0" in response.headers["Server-Timing"]
+
+    messages = [json.loads(record.message) for record in caplog.records]
+    assert len(messages) == spans
+    for message in messages:
+        assert message["name"] == "GET /"
+        assert message["trace_id"] == "0af7651916cd43dd8448eb211c80319c"
+        assert message["parent_id"] == "b7ad6b7169203331"
+        assert message["status"] == 200
+        assert message["phases_ms"] == {"envoy": 100.0}
+
+
+@pytest.mark.asyncio
+async def test_disabled():
+    # nothing is sent to clients unless it is asked for
+    app = Quart(__name__)
+    RequestTracer(app)
+
+    @app.route("/")
+    async def index() -> str:
+        return "ok"
+
+    response = await app.test_client().get("/")
+    assert "Server-Timing" not in response.headers
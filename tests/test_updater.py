@@ -1,9 +1,18 @@
+import asyncio
+import base64
+import json
 from datetime import datetime, timedelta
 from unittest.mock import MagicMock, patch
 
 import pytest
 
-from enphase_proxy.updater import CredentialsManager, FetchedCredentials
+from enphase_proxy.updater import (
+    CredentialsManager,
+    CredentialsUnavailable,
+    CredentialsUpdater,
+    FetchedCredentials,
+    decode_expiry,
+)
 
 
 @pytest.fixture
@@ -138,3 +147,185 @@ async def test_credentials_fetch(mock_fetch_credentials: MagicMock):
     assert manager.data.fetched_at == starting_timestamp - timedelta(hours=10)
     assert manager.data.expires_at == starting_timestamp + timedelta(hours=1)
     assert mock_fetch_credentials.call_count == 0
+
+
+def make_jwt(expires_at: datetime) -> str:
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": int(expires_at.timestamp())}).encode()).rstrip(b"=")
+    return f"header.{payload.decode()}.signature"
+
+
+def test_decode_expiry():
+    expires_at = datetime.now().replace(microsecond=0) + timedelta(days=1)
+    assert decode_expiry(make_jwt(expires_at)) == expires_at
+    assert decode_expiry("test_jwt") is None
+    assert decode_expiry("header.!!!.signature") is None
+
+
+@patch.object(CredentialsManager, "_fetch_credentials")
+@pytest.mark.asyncio
+async def test_credentials_expired_local_token(
+    mock_fetch_credentials: MagicMock, credentials_manager: CredentialsManager
+):
+    credentials_manager.enphase_jwt = make_jwt(datetime.now() - timedelta(days=1))
+    credentials_manager.enphase_jwt_expires_at = decode_expiry(credentials_manager.enphase_jwt)
+    mock_fetch_credentials.return_value = FetchedCredentials(  # noqa: S106
+        fetched_at=datetime.now(),
+        expires_at=datetime.now() + timedelta(hours=1),
+        token="new_token",  # noqa: S106
+    )
+    assert await credentials_manager.credentials == "new_token"
+    mock_fetch_credentials.assert_called_once()
+
+
+@patch.object(CredentialsManager, "_fetch_credentials")
+@pytest.mark.asyncio
+async def test_credentials_expired_local_token_without_login(mock_fetch_credentials: MagicMock):
+    token = make_jwt(datetime.now() - timedelta(days=1))
+    manager = CredentialsManager(jwt=token)
+    assert await manager.credentials == token
+    assert await manager.renew(token) == token
+    mock_fetch_credentials.assert_not_called()
+
+
+@patch.object(CredentialsManager, "_fetch_credentials")
+@pytest.mark.asyncio
+async def test_renew_single_flight(mock_fetch_credentials: MagicMock, test_credentials: CredentialsManager):
+    async def fetch() -> FetchedCredentials:
+        await asyncio.sleep(0)
+        return FetchedCredentials(  # noqa: S106
+            fetched_at=datetime.now(),
+            expires_at=datetime.now() + timedelta(hours=1),
+            token="new_token",  # noqa: S106
+        )
+
+    mock_fetch_credentials.side_effect = fetch
+    results = await asyncio.gather(*[test_credentials.renew("old_token") for _ in range(10)])
+    assert results == ["new_token"] * 10
+    mock_fetch_credentials.assert_called_once()
+
+    # a late rejection of the old token doesn't cause another fetch
+    assert await test_credentials.renew("old_token") == "new_token"
+    mock_fetch_credentials.assert_called_once()
+
+
+def test_refresh_at(test_credentials: CredentialsManager):
+    data = test_credentials.data
+    assert test_credentials.refresh_at(0.5) == data.fetched_at + (data.expires_at - data.fetched_at) / 2
+    assert CredentialsManager().refresh_at(0.5) is None
+
+
+def test_background_delay(test_credentials: CredentialsManager):
+    updater = CredentialsUpdater()
+    updater.data_managers = {"default": test_credentials}
+
+    # the test credentials are halfway through their two hour lifetime
+    updater.updater_fraction = 0.75
+    assert 1790 < updater._background_delay("default") <= 1800
+
+    # credentials that are already due are refreshed soon but not right away
+    updater.updater_fraction = 0.25
+    assert updater._background_delay("default") == updater.updater_refresh_min
+
+    # each gateway has its own schedule
+    updater.data_managers["other"] = CredentialsManager(jwt="test_jwt")
+    assert updater._background_delay("other") == updater.updater_refresh
+
+
+@patch.object(CredentialsManager, "_fetch_credentials")
+@pytest.mark.asyncio
+async def test_refresh_at_for_old_credentials(mock_fetch_credentials: MagicMock):
+    # enlighten hands back a token that it made ten hours ago and that expires
+    # in two hours so it is already past its refresh point when we get it
+    mock_fetch_credentials.return_value = FetchedCredentials(  # noqa: S106
+        fetched_at=datetime.now() - timedelta(hours=10),
+        expires_at=datetime.now() + timedelta(hours=2),
+        token="old_token",  # noqa: S106
+    )
+    manager = CredentialsManager(url="https://example.com/", username="u", password="p", serialno="s")  # noqa: S106
+    assert await manager.credentials == "old_token"
+
+    # it is refreshed halfway through what was left of it when we got it
+    refresh_at = manager.refresh_at(0.5)
+    assert datetime.now() + timedelta(minutes=59) < refresh_at <= datetime.now() + timedelta(hours=1)
+
+    updater = CredentialsUpdater()
+    updater.data_managers = {"default": manager}
+    updater.ready = {"default": asyncio.Event()}
+    assert 3500 < updater._background_delay("default") <= 3600
+
+    # and the looper doesn't log in again and again
+    task = asyncio.create_task(updater._background_looper())
+    await asyncio.sleep(0.2)
+    updater.updater_canceled.set()
+    await task
+    mock_fetch_credentials.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_failing_gateway_does_not_hold_up_others():
+    async def failing() -> FetchedCredentials:
+        raise RuntimeError("login failed")
+
+    # this gateway's credentials are due and it can't get new ones
+    bad = CredentialsManager(url="https://example.com/", username="u", password="p", serialno="s")  # noqa: S106
+    bad._fetch_credentials = failing
+
+    updater = CredentialsUpdater()
+    updater.data_managers = {"bad": bad, "good": CredentialsManager(jwt="test_jwt")}
+    updater.ready = {name: asyncio.Event() for name in updater.data_managers}
+    updater.updater_refresh = 0.01
+    updater.updater_refresh_min = 0
+
+    stored = []
+    store = updater._store
+
+    def record(name: str, token: str) -> None:
+        stored.append(name)
+        store(name, token)
+
+    updater._store = record
+
+    # the good gateway is ready and keeps being refreshed while the bad one
+    # is still trying to get its first credentials
+    task = asyncio.create_task(updater._background_startup())
+    await asyncio.sleep(0.2)
+    assert updater.ready["good"].is_set()
+    assert not updater.ready["bad"].is_set()
+    assert not updater.is_ready
+    assert stored.count("good") > 1
+
+    # and once the bad one has credentials that are due its retries still
+    # don't hold up the good one
+    bad.data = FetchedCredentials(  # noqa: S106
+        fetched_at=datetime.now() - timedelta(hours=2),
+        expires_at=datetime.now() + timedelta(hours=1),
+        token="old_token",  # noqa: S106
+    )
+    task.cancel()
+    await task
+    task = asyncio.create_task(updater._background_looper())
+    stored.clear()
+    await asyncio.sleep(0.2)
+    assert stored.count("good") > 1
+    assert "bad" not in stored
+    task.cancel()
+    await task
+
+
+@pytest.mark.asyncio
+async def test_wait_ready():
+    updater = CredentialsUpdater()
+    updater.data_managers = {"default": CredentialsManager(jwt="test_jwt")}
+    updater.ready = {"default": asyncio.Event()}
+    updater.updater_ready_timeout = 0.01
+    assert not updater.is_ready
+
+    with pytest.raises(CredentialsUnavailable) as e:
+        await updater.wait_ready("default")
+    assert e.value.retry_after == 1
+
+    # once the credentials are stored nobody waits anymore
+    await updater._initial("default")
+    assert updater.is_ready
+    assert updater.credentials_for("default") == "test_jwt"
+    await updater.wait_ready("default")
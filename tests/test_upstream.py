@@ -0,0 +1,134 @@
+import asyncio
+import gc
+
+import httpx
+import pytest
+from quart import Quart
+
+from enphase_proxy.limiter import UpstreamLimiter
+from enphase_proxy.upstream import (
+    CLOSING,
+    REQUEST_HEADERS,
+    RESPONSE_HEADERS,
+    StreamedBody,
+    UpstreamClient,
+    create_client,
+)
+
+
+@pytest.fixture
+def app() -> Quart:
+    app = Quart(__name__)
+    app.config["LOCAL_API_URL"] = "https://envoy.local/"
+    return app
+
+
+@pytest.mark.asyncio
+async def test_create_client_defaults(app: Quart):
+    client = create_client(app.config, app.config["LOCAL_API_URL"])
+    assert client.base_url == "https://envoy.local/"
+    assert client.timeout == httpx.Timeout(300, connect=10, pool=300)
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_create_client_with_configuration(app: Quart):
+    app.config["LOCAL_API_TIMEOUT"] = 30
+    app.config["LOCAL_API_CONNECT_TIMEOUT"] = 5
+    app.config["LOCAL_API_POOL_TIMEOUT"] = 15
+    client = create_client(app.config, app.config["LOCAL_API_URL"])
+    assert client.timeout == httpx.Timeout(30, connect=5, pool=15)
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_client_lifecycle(app: Quart):
+    upstream = UpstreamClient(app)
+    assert upstream.client is None
+
+    async with app.test_app():
+        client = upstream.client
+        assert client is not None
+        assert not client.is_closed
+
+    assert upstream.client is None
+    assert client.is_closed
+
+
+@pytest.mark.asyncio
+async def test_request_without_client(app: Quart):
+    upstream = UpstreamClient(app)
+    with pytest.raises(RuntimeError):
+        await upstream.request("GET", "/production.json")
+
+
+def test_header_allowlists(app: Quart):
+    client = UpstreamClient(app)
+    assert client.request_headers == REQUEST_HEADERS
+    assert client.response_headers == RESPONSE_HEADERS
+
+    # the credentials and the connection are never passed along
+    app.config["FORWARD_REQUEST_HEADERS"] = ["X-Request-Id", "Authorization", "Host", "Content-Type", "content-type"]
+    app.config["FORWARD_RESPONSE_HEADERS"] = ["Content-Type", "Transfer-Encoding"]
+    client = UpstreamClient(app)
+    assert client.request_headers == ("x-request-id", "content-type")
+    assert client.response_headers == ("content-type",)
+
+
+async def open_stream() -> tuple[httpx.AsyncClient, httpx.Response]:
+    def respond(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, stream=httpx.ByteStream(b"production"))
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(respond), base_url="https://envoy.local/")
+    response = await client.send(client.build_request("GET", "/production.json"), stream=True)
+    return client, response
+
+
+@pytest.mark.asyncio
+async def test_streamed_body():
+    limiter = UpstreamLimiter()
+    await limiter.acquire("/production.json")
+    client, response = await open_stream()
+
+    body = StreamedBody(response, limiter.release)
+    assert [chunk async for chunk in body] == [b"production"]
+    assert response.is_closed
+    assert limiter.in_flight == 0
+
+    # closing it again doesn't give back a slot that we no longer have
+    await body.aclose()
+    assert limiter.in_flight == 0
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_streamed_body_closed_before_reading():
+    limiter = UpstreamLimiter()
+    await limiter.acquire("/production.json")
+    client, response = await open_stream()
+
+    # like when the client goes away before we start sending the body
+    await StreamedBody(response, limiter.release).aclose()
+    assert response.is_closed
+    assert limiter.in_flight == 0
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_streamed_body_never_closed():
+    limiter = UpstreamLimiter()
+    await limiter.acquire("/production.json")
+    client, response = await open_stream()
+
+    # like when the server never got as far as the body. the connection goes
+    # back to the pool once the body is thrown away.
+    body = StreamedBody(response, limiter.release)
+    del body
+    gc.collect()
+    assert len(CLOSING) == 1
+    await asyncio.wait(set(CLOSING))
+    await asyncio.sleep(0)
+    assert response.is_closed
+    assert not CLOSING
+    assert limiter.in_flight == 0
+    await client.aclose()